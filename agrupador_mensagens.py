@@ -0,0 +1,139 @@
+# agrupador_mensagens.py
+"""
+Agrupa mensagens curtas do mesmo diálogo ("oi" / "tenho uma dúvida" / "sobre a coleta")
+numa pergunta só antes de chamar o assistant: uma chamada e uma resposta em vez de
+várias respostas desencontradas.
+
+O grupo fecha quando o diálogo fica AGRUPAR_JANELA_S sem mensagem nova, quando a
+primeira mensagem completa AGRUPAR_ESPERA_MAX_S (latência limitada) ou quando junta
+AGRUPAR_MAX_MENSAGENS.
+"""
+import os, time, threading, logging
+
+log = logging.getLogger("agrupador_mensagens")
+
+AGRUPAR_ATIVO         = os.getenv("AGRUPAR_ATIVO", "0") == "1"
+AGRUPAR_JANELA_S      = float(os.getenv("AGRUPAR_JANELA_S", "2.0"))
+AGRUPAR_ESPERA_MAX_S  = float(os.getenv("AGRUPAR_ESPERA_MAX_S", "6.0"))
+AGRUPAR_MAX_MENSAGENS = int(os.getenv("AGRUPAR_MAX_MENSAGENS", "10"))
+
+
+class _Grupo:
+    __slots__ = ("textos", "primeira", "ultima")
+
+    def __init__(self, agora: float):
+        self.textos = []
+        self.primeira = agora
+        self.ultima = agora
+
+
+class AgrupadorMensagens:
+    """
+    Estado dos grupos por dialog_id. No modo síncrono, uma thread fecha os grupos
+    vencidos e chama `despachar(dialog_id, texto)`; no app_async quem espera o
+    prazo é uma tarefa por grupo (`prazo` / `retirar`).
+    """
+
+    def __init__(self, despachar=None, janela_s: float = AGRUPAR_JANELA_S,
+                 espera_max_s: float = AGRUPAR_ESPERA_MAX_S, max_mensagens: int = AGRUPAR_MAX_MENSAGENS):
+        self.despachar = despachar
+        self.janela_s = janela_s
+        self.espera_max_s = max(janela_s, espera_max_s)
+        self.max_mensagens = max(1, max_mensagens)
+        self._grupos = {}                      # dialog_id -> _Grupo
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self.mensagens = 0
+        self.chamadas = 0
+        self.maior_grupo = 0
+
+    # ---------- estado ----------
+    def adicionar(self, dialog_id: str, texto: str) -> bool:
+        """Acrescenta a mensagem ao grupo do diálogo. True se abriu um grupo novo."""
+        agora = time.time()
+        with self._cond:
+            grupo = self._grupos.get(dialog_id)
+            novo = grupo is None
+            if novo:
+                grupo = self._grupos[dialog_id] = _Grupo(agora)
+            grupo.textos.append(texto)
+            grupo.ultima = agora
+            self.mensagens += 1
+            self._cond.notify()
+            return novo
+
+    def prazo(self, dialog_id: str):
+        """Instante em que o grupo do diálogo fecha, ou None se não há grupo aberto."""
+        with self._cond:
+            grupo = self._grupos.get(dialog_id)
+            return self._prazo(grupo) if grupo else None
+
+    def _prazo(self, grupo: _Grupo) -> float:
+        if len(grupo.textos) >= self.max_mensagens:
+            return grupo.ultima
+        return min(grupo.ultima + self.janela_s, grupo.primeira + self.espera_max_s)
+
+    def retirar(self, dialog_id: str):
+        """Fecha o grupo do diálogo agora e devolve o texto combinado (ou None)."""
+        with self._cond:
+            grupo = self._grupos.pop(dialog_id, None)
+            if grupo is None:
+                return None
+            self.chamadas += 1
+            self.maior_grupo = max(self.maior_grupo, len(grupo.textos))
+        if len(grupo.textos) > 1:
+            log.info(f"🧩 {len(grupo.textos)} mensagens do diálogo {dialog_id} agrupadas "
+                     f"({time.time() - grupo.primeira:.1f}s).")
+        return "\n".join(grupo.textos)
+
+    # ---------- modo síncrono ----------
+    def enviar(self, dialog_id: str, texto: str):
+        """Adiciona a mensagem; a thread do agrupador despacha o grupo quando ele fechar."""
+        self._garantir_thread()
+        self.adicionar(dialog_id, texto)
+
+    def _garantir_thread(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+        with self._cond:
+            if self._pid == pid and self._thread is not None:
+                return
+            if self._pid is not None and self._pid != pid:
+                self._grupos.clear()   # grupos herdados do pai pertencem ao processo dele
+            self._pid = pid
+            self._thread = threading.Thread(target=self._loop, name="agrupador", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                agora = time.time()
+                prazos = {d: self._prazo(g) for d, g in self._grupos.items()}
+                vencidos = [d for d, p in prazos.items() if p <= agora]
+                if not vencidos:
+                    self._cond.wait(min(prazos.values()) - agora if prazos else None)
+                    continue
+            for dialog_id in vencidos:
+                texto = self.retirar(dialog_id)
+                if texto is None:
+                    continue
+                try:
+                    self.despachar(dialog_id, texto)
+                except Exception as e:
+                    log.exception(f"Erro despachando grupo do diálogo {dialog_id}: {e}")
+
+    def metricas(self) -> dict:
+        with self._cond:
+            return {
+                "ativo": AGRUPAR_ATIVO,
+                "janela_s": self.janela_s,
+                "espera_max_s": self.espera_max_s,
+                "grupos_abertos": len(self._grupos),
+                "mensagens": self.mensagens,
+                "chamadas": self.chamadas,
+                "chamadas_economizadas": self.mensagens - self.chamadas - sum(
+                    len(g.textos) for g in self._grupos.values()),
+                "maior_grupo": self.maior_grupo,
+            }
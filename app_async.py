@@ -0,0 +1,358 @@
+# app_async.py
+"""
+Modo de serviço assíncrono (ASGI): mesmas rotas `/`, `/install` e `/handler` do
+main.py, mas cada conversa é uma tarefa asyncio em vez de um worker/thread preso
+esperando a OpenAI. Um processo segura centenas de conversas simultâneas.
+
+    uvicorn app_async:app --host 0.0.0.0 --port $PORT
+
+O modo síncrono (gunicorn main:app) continua disponível; as regras de negócio
+(interpretação do evento, horário, cache de respostas) são as do main.py.
+"""
+import os, json, time, asyncio, logging
+from urllib.parse import parse_qsl
+
+from main import (
+    WELCOME_MESSAGE, MENSAGEM_LIMITE, EVENTOS_TRATADOS, AGRUPAR_ATIVO,
+    cache_respostas, dedup, agrupador, limpar_marcadores_de_citacao, _registrar_evento,
+    _interpretar_evento, _fora_do_horario, _registro_do_bot,
+    _resposta_do_cache, _guardar_resposta, _send_imbot_message_async, _chamar_bitrix_async,
+    BOT_ID, ENTREGA_PROGRESSIVA, EntregaProgressivaAsync, teto_entrega, fila_bitrix, _destinos_aquecimento,
+    _token_admin_valido,
+)
+from chamar_openai_com import chamar_openai_com_async, cache_threads, limiar_hedge, memoria
+from processar_arquivo import processar_arquivos_do_bitrix_async, cache_arquivos
+from cliente_http import cliente_async, timeout_async, fechar_clientes_async, aquecer_async
+from limitador_openai import limitador
+from disjuntor_openai import disjuntor
+from metricas_prometheus import metricas, TIPO_CONTEUDO as TIPO_METRICAS
+import logs_estruturados
+from logs_estruturados import novo_id_evento
+from perfilador import perfil
+from armazenamento_sqlite import fora_do_loop
+
+log = logging.getLogger("app_async")
+
+# Conversas em andamento por processo; acima disso o Bitrix recebe 503 + Retry-After
+ASYNC_MAX_CONCORRENCIA = int(os.getenv("ASYNC_MAX_CONCORRENCIA", "500"))
+# No shutdown, quanto esperar as conversas em andamento antes de fechar os clientes
+ASYNC_ESPERA_SHUTDOWN_S = float(os.getenv("ASYNC_ESPERA_SHUTDOWN_S", "30"))
+
+_tarefas = set()
+_stats = {"concluidas": 0, "rejeitadas": 0, "falhas": 0}
+
+
+# =========================
+# Processamento
+# =========================
+async def _responder_texto_async(dialog_id: str, text: str, ao_texto=None) -> str:
+    resposta = _resposta_do_cache(text)
+    if resposta is not None:
+        return resposta
+    resposta = limpar_marcadores_de_citacao(await chamar_openai_com_async(text, dialog_id=dialog_id,
+                                                                          ao_texto=ao_texto))
+    _guardar_resposta(text, resposta)
+    return resposta
+
+async def _enviar_seguro_async(dialog_id: str, text: str, contexto: str):
+    try:
+        await _send_imbot_message_async(dialog_id, text)
+    except Exception as e:
+        log.error(f"Falha ao enviar {contexto}: {e}")
+
+async def _processar_mensagem_async(dialog_id: str, text: str, arquivos=None):
+    """Equivalente async de main._processar_mensagem."""
+    with metricas.medir("processamento_total"):
+        await _gerar_e_enviar_async(dialog_id, text, arquivos)
+
+async def _gerar_e_enviar_async(dialog_id: str, text: str, arquivos=None):
+    entrega = None
+    if ENTREGA_PROGRESSIVA:
+        entrega = EntregaProgressivaAsync(dialog_id, BOT_ID, _chamar_bitrix_async,
+                                          formatar=limpar_marcadores_de_citacao)
+        await entrega.digitando()
+
+    if arquivos:
+        log.info(f"📂 {len(arquivos)} arquivo(s) detectado(s)! Enviando ao processador de arquivo...")
+        try:
+            with metricas.medir("resposta_arquivo"):
+                resposta_ia = await processar_arquivos_do_bitrix_async(arquivos, dialog_id)
+        except Exception as e:
+            log.error(f"processar_arquivos_do_bitrix_async erro: {e}")
+            resposta_ia = "❌ O tipo de arquivo não é reconhecido como imagem compatível para análise."
+    elif text:
+        log.info("💬 Mensagem de texto detectada! Enviando ao GPT...")
+        try:
+            with metricas.medir("resposta_texto"):
+                resposta_ia = await _responder_texto_async(dialog_id, text,
+                                                           ao_texto=entrega.parcial if entrega else None)
+        except Exception as e:
+            log.error(f"chamar_openai_com_async erro: {e}")
+            resposta_ia = "❗Erro ao processar com a IA. Tente novamente."
+    else:
+        resposta_ia = "❗Mensagem vazia ou sem arquivo. Por favor, envie um texto ou anexo válido."
+
+    if entrega is None:
+        await _enviar_seguro_async(dialog_id, resposta_ia, "ao Bitrix")
+        return
+    try:
+        await entrega.finalizar(resposta_ia)
+    except Exception as e:
+        log.error(f"Falha ao enviar ao Bitrix: {e}")
+
+async def _esperar_grupo(dialog_id: str):
+    """Tarefa dona do grupo de mensagens do diálogo: espera o grupo fechar e processa."""
+    while True:
+        prazo = agrupador.prazo(dialog_id)
+        if prazo is None:
+            return
+        espera = prazo - time.time()
+        if espera <= 0:
+            break
+        await asyncio.sleep(espera)
+    texto = agrupador.retirar(dialog_id)
+    if texto:
+        await _processar_mensagem_async(dialog_id, texto)
+
+def _disparar(coro) -> bool:
+    """Agenda a conversa como tarefa. Retorna False (e descarta `coro`) se o processo está no limite."""
+    if len(_tarefas) >= ASYNC_MAX_CONCORRENCIA:
+        coro.close()
+        _stats["rejeitadas"] += 1
+        return False
+    tarefa = asyncio.create_task(perfil.envolver_async(coro, "processamento"))
+    _tarefas.add(tarefa)
+    tarefa.add_done_callback(_tarefa_concluida)
+    return True
+
+def _tarefa_concluida(tarefa: asyncio.Task):
+    _tarefas.discard(tarefa)
+    if tarefa.cancelled() or tarefa.exception() is not None:
+        _stats["falhas"] += 1
+        if not tarefa.cancelled():
+            log.error(f"Tarefa de conversa falhou: {tarefa.exception()!r}")
+    else:
+        _stats["concluidas"] += 1
+
+
+# =========================
+# ASGI
+# =========================
+async def _ler_corpo(receive) -> bytes:
+    partes = []
+    while True:
+        msg = await receive()
+        partes.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(partes)
+
+def _form_para_dict(corpo: bytes) -> dict:
+    """Mesmo formato de main._flatten_form_all: chaves repetidas viram lista."""
+    out = {}
+    for k, v in parse_qsl(corpo.decode("utf-8", "replace"), keep_blank_values=True):
+        if k in out:
+            out[k] = out[k] + [v] if isinstance(out[k], list) else [out[k], v]
+        else:
+            out[k] = v
+    return out
+
+def _payload(corpo: bytes, content_type: str) -> dict:
+    if "json" in content_type:
+        try:
+            dados = json.loads(corpo or b"null")
+            if isinstance(dados, dict) and dados:
+                return dados
+        except ValueError:
+            pass
+    return _form_para_dict(corpo)
+
+async def _enviar_resposta(send, corpo, status: int = 200, headers=(), tipo: bytes = None):
+    if isinstance(corpo, (dict, list)):
+        dados, tipo = json.dumps(corpo, ensure_ascii=False).encode(), tipo or b"application/json"
+    elif isinstance(corpo, bytes):
+        dados, tipo = corpo, tipo or b"application/octet-stream"
+    else:
+        dados, tipo = str(corpo).encode(), tipo or b"text/html; charset=utf-8"
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", tipo), (b"content-length", str(len(dados)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": dados})
+
+def _ocupado():
+    return {"status": "ocupado"}, 503, [(b"retry-after", b"5")]
+
+async def _rota_install(query: bytes):
+    data = dict(parse_qsl(query.decode("utf-8", "replace")))
+    log.info(f"📦 Dados recebidos na instalação: {data}")
+    webhook_url, payload = _registro_do_bot(data)
+    if not webhook_url:
+        return {"erro": "Domain não especificado", "status": "Erro interno"}, 500, []
+    try:
+        response = await cliente_async("bitrix").post(webhook_url, json=payload, timeout=timeout_async(20))
+        try:
+            bitrix_result = response.json()
+        except Exception:
+            bitrix_result = {"raw": response.text}
+        log.info(f"🛰️ Resposta do Bitrix: {bitrix_result}")
+        return {"status": "Instalação recebida com sucesso", "bitrix_response": bitrix_result}, 200, []
+    except Exception as e:
+        log.error(f"Erro na instalação: {e}")
+        return {"erro": str(e), "status": "Erro interno"}, 500, []
+
+async def _rota_handler(corpo: bytes, content_type: str):
+    """Mesmo fluxo do main.bitrix_handler; IA e envio viram tarefas, o Bitrix recebe 200 na hora."""
+    novo_id_evento()   # as tarefas criadas daqui herdam o contexto (id nos logs)
+    try:
+        with metricas.medir("payload_parse"):
+            payload = _payload(corpo, content_type)
+        log.debug("[HANDLER] ct=%s payload=%s", content_type, payload)
+
+        evt, dialog_id, text, arquivos = _interpretar_evento(payload)
+        log.info(f"[HANDLER] evt={evt} dialog={dialog_id} texto={len(text)} chars anexos={len(arquivos)}")
+        if not dialog_id:
+            return {"status": "no_dialog"}, 200, []
+
+        if _fora_do_horario():
+            if not _disparar(_enviar_seguro_async(dialog_id, MENSAGEM_LIMITE, "msg de limite")):
+                return _ocupado()
+            return {"status": "fora_do_horario"}, 200, []
+
+        if evt in ("ONIMBOTJOINCHAT", "ONIMBOTWELCOMEMESSAGE"):
+            if not _disparar(_enviar_seguro_async(dialog_id, WELCOME_MESSAGE, "welcome")):
+                return _ocupado()
+            return {"status": "welcome_sent"}, 200, []
+
+        if evt not in EVENTOS_TRATADOS:
+            return {"status": "ignored", "event": evt}, 200, []
+
+        novo, chave = await fora_do_loop(dedup, _registrar_evento, payload, dialog_id, text, arquivos)
+        if not novo:
+            return {"status": "duplicado"}, 200, []
+
+        if AGRUPAR_ATIVO and text and not arquivos:
+            if agrupador.adicionar(dialog_id, text) and not _disparar(_esperar_grupo(dialog_id)):
+                agrupador.retirar(dialog_id)
+                if chave:
+                    await fora_do_loop(dedup, dedup.liberar, chave)
+                return _ocupado()
+            return {"status": "agrupando"}, 200, []
+        if AGRUPAR_ATIVO:
+            pendente = agrupador.retirar(dialog_id)
+            if pendente and not _disparar(_processar_mensagem_async(dialog_id, pendente)):
+                log.error(f"Limite de concorrência: grupo de mensagens do diálogo {dialog_id} descartado.")
+
+        if not _disparar(_processar_mensagem_async(dialog_id, text, arquivos)):
+            if chave:
+                await fora_do_loop(dedup, dedup.liberar, chave)
+            return _ocupado()
+        return {"status": "enfileirado"}, 200, []
+
+    except Exception as e:
+        log.error(f"Erro no /handler: {e}")
+        return {"status": "error", "message": str(e)}, 500, []
+
+def _perfil_forcado(headers: dict):
+    """Equivalente de main._perfil_forcado com os headers do scope ASGI."""
+    modo = headers.get(b"x-perfil")
+    if not modo or not _token_admin_valido(headers.get(b"x-admin-token", b"").decode("latin-1")):
+        return None
+    return modo.decode("latin-1")
+
+async def _rota_admin_perfil(metodo: str, caminho: str, headers: dict, parametros: dict):
+    """Mesmas rotas /admin/perfil do main.py."""
+    if not _token_admin_valido(headers.get(b"x-admin-token", b"").decode("latin-1")):
+        return {"erro": "não autorizado"}, 401, []
+    if caminho == "/admin/perfil" and metodo == "POST":
+        try:
+            return {"status": "armado", **perfil.armar(parametros.get("n", "1"), parametros.get("modo"))}, 200, []
+        except ValueError as e:
+            return {"erro": str(e)}, 400, []
+    if caminho == "/admin/perfil":
+        return {**perfil.metricas(), "capturas": await asyncio.to_thread(perfil.listar)}, 200, []
+    arquivo = caminho[len("/admin/perfil/"):]
+    local = perfil.caminho(arquivo)
+    if local is None:
+        return {"erro": "captura não encontrada"}, 404, []
+    with open(local, "rb") as f:
+        dados = await asyncio.to_thread(f.read)
+    return dados, 200, [(b"content-disposition", f'attachment; filename="{arquivo}"'.encode())]
+
+def _status_fila() -> dict:
+    return {"assincrono": True, "modo": "asgi", "em_andamento": len(_tarefas),
+            "max_concorrencia": ASYNC_MAX_CONCORRENCIA, **_stats, "dedup": dedup.metricas(),
+            "agrupamento": agrupador.metricas(), "openai": limitador.metricas(),
+            "hedge": limiar_hedge.metricas(), "entrega": teto_entrega.metricas(),
+            "envio_bitrix": fila_bitrix.metricas(), "logs": logs_estruturados.metricas()}
+
+def _status_cache() -> dict:
+    return {"respostas": cache_respostas.metricas(), "threads": cache_threads.metricas(),
+            "memoria": memoria.metricas(), "arquivos": cache_arquivos.metricas()}
+
+_aquecimento = None   # referência forte à tarefa de warm-up
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            global _aquecimento
+            _aquecimento = asyncio.create_task(aquecer_async(_destinos_aquecimento()))   # não segura o startup
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            if _tarefas:
+                log.info(f"Aguardando {len(_tarefas)} conversas em andamento...")
+                await asyncio.wait(set(_tarefas), timeout=ASYNC_ESPERA_SHUTDOWN_S)
+            await asyncio.to_thread(fila_bitrix.drenar)
+            await fechar_clientes_async()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    metodo, caminho = scope["method"], scope["path"]
+    if metodo == "GET" and caminho == "/":
+        return await _enviar_resposta(send, "Ana Lis - Agente IA está online!")
+    if metodo == "GET" and caminho == "/status/fila":
+        return await _enviar_resposta(send, _status_fila())
+    if metodo == "GET" and caminho == "/status/disjuntor":
+        return await _enviar_resposta(send, disjuntor.metricas())
+    if metodo == "GET" and caminho == "/metrics":
+        texto = await asyncio.to_thread(metricas.texto)   # com METRICAS_DB, lê o SQLite
+        return await _enviar_resposta(send, texto, tipo=TIPO_METRICAS.encode())
+    if metodo == "GET" and caminho == "/status/cache":
+        return await _enviar_resposta(send, await asyncio.to_thread(_status_cache))   # ARQUIVOS_DB conta no SQLite
+    if metodo == "POST" and caminho == "/admin/cache/invalidar":
+        headers = dict(scope.get("headers") or [])
+        await _ler_corpo(receive)
+        if not _token_admin_valido(headers.get(b"x-admin-token", b"").decode("latin-1")):
+            return await _enviar_resposta(send, {"erro": "não autorizado"}, 401)
+        cache_respostas.invalidar()
+        return await _enviar_resposta(send, {"status": "cache_invalidado"})
+    if (caminho == "/admin/perfil" and metodo in ("GET", "POST")) or \
+            (caminho.startswith("/admin/perfil/") and metodo == "GET"):
+        headers = dict(scope.get("headers") or [])
+        parametros = _form_para_dict(scope.get("query_string", b"") + b"&" + await _ler_corpo(receive))
+        return await _enviar_resposta(send, *await _rota_admin_perfil(metodo, caminho, headers, parametros))
+    if metodo == "POST" and caminho == "/install":
+        await _ler_corpo(receive)
+        return await _enviar_resposta(send, *await _rota_install(scope.get("query_string", b"")))
+    if metodo == "POST" and caminho == "/handler":
+        headers = dict(scope.get("headers") or [])
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        corpo = await _ler_corpo(receive)
+        t0 = time.perf_counter()
+        captura = perfil.pedir(_perfil_forcado(headers), exclusivo=True)
+        if captura is None:
+            resposta, status, extras = await _rota_handler(corpo, content_type)
+        else:
+            with perfil.trecho(captura, "handler"):
+                resposta, status, extras = await _rota_handler(corpo, content_type)
+        metricas.etapa("handler", time.perf_counter() - t0)
+        metricas.contar("lis_handler_total", desfecho=resposta.get("status", str(status)))
+        return await _enviar_resposta(send, resposta, status, extras)
+    await _enviar_resposta(send, {"erro": "rota não encontrada"}, 404)
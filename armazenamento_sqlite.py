@@ -0,0 +1,47 @@
+# armazenamento_sqlite.py
+"""
+Conexão SQLite compartilhada pelos caches/estados que precisam sobreviver a
+restart ou ser vistos por todos os workers do gunicorn (mesmo arquivo em disco).
+"""
+import os, sqlite3, asyncio, threading
+
+def conectar(caminho: str) -> sqlite3.Connection:
+    """Conexão única por objeto, usada sob lock pelo chamador (check_same_thread=False)."""
+    pasta = os.path.dirname(os.path.abspath(caminho))
+    os.makedirs(pasta, exist_ok=True)
+    conn = sqlite3.connect(caminho, timeout=5, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")       # leitores não bloqueiam o escritor
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class BancoCompartilhado:
+    """
+    Conexão preguiçosa + lock. Reabre após fork (cada worker do gunicorn precisa
+    da sua própria conexão).
+    """
+
+    def __init__(self, caminho: str, ddl: str):
+        self.caminho = caminho
+        self.ddl = ddl
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+
+    def conn(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if self._conn is None or self._pid != pid:
+            self._conn = conectar(self.caminho)
+            self._conn.executescript(self.ddl)
+            self._pid = pid
+        return self._conn
+
+
+async def fora_do_loop(objeto, fn, *args):
+    """
+    fn(*args) vindo de código async: se `objeto` tem banco (_db), roda numa thread
+    para o SQLite (lock + disco) não travar o event loop; só em memória, roda direto.
+    """
+    if getattr(objeto, "_db", None) is not None:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: requests.get solto (1 conexão TCP+TLS por chamada) x sessão
+compartilhada do cliente_http (keep-alive), contra o stub local em HTTPS.
+
+Gera um certificado autoassinado temporário com o `openssl` do sistema; sem ele,
+roda em HTTP puro (mede só o custo do TCP).
+
+Uso:
+  python bench/bench_http_pool.py --chamadas 200
+"""
+import argparse, os, shutil, statistics, subprocess, sys, tempfile, time, warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import requests  # noqa: E402
+from stub_servidor import iniciar_stub  # noqa: E402
+from cliente_http import sessao_openai, timeout  # noqa: E402
+
+
+def gerar_certificado(pasta: str):
+    if not shutil.which("openssl"):
+        return None
+    pem = os.path.join(pasta, "stub.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-keyout", pem, "-out", pem + ".crt"],
+        check=True, capture_output=True,
+    )
+    with open(pem, "a") as f, open(pem + ".crt") as crt:
+        f.write(crt.read())
+    return pem
+
+
+def medir(servidor, url, chamar, chamadas: int):
+    servidor.estado.zerar_contadores()
+    tempos = []
+    for _ in range(chamadas):
+        t0 = time.perf_counter()
+        chamar(url).raise_for_status()
+        tempos.append(time.perf_counter() - t0)
+    return tempos, servidor.estado.conexoes
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chamadas", type=int, default=200)
+    args = ap.parse_args()
+    warnings.filterwarnings("ignore")   # certificado autoassinado (verify=False)
+
+    with tempfile.TemporaryDirectory() as pasta:
+        pem = gerar_certificado(pasta)
+        servidor, base = iniciar_stub(duracao_run=0, certificado=pem)
+        url = f"{base}/models"
+        sessao = sessao_openai()
+        modos = (
+            ("requests.get", lambda u: requests.get(u, verify=False, timeout=timeout(5))),
+            ("sessão pool", lambda u: sessao.get(u, verify=False, timeout=timeout(5))),
+        )
+        print(f"{args.chamadas} chamadas sequenciais em {base.split(':')[0].upper()}")
+        print(f"{'modo':<14}{'média':>10}{'p50':>10}{'p95':>10}{'conexões':>10}")
+        for nome, chamar in modos:
+            tempos, conexoes = medir(servidor, url, chamar, args.chamadas)
+            p95 = statistics.quantiles(tempos, n=20)[-1]
+            print(f"{nome:<14}{statistics.mean(tempos) * 1000:>8.2f}ms{statistics.median(tempos) * 1000:>8.2f}ms"
+                  f"{p95 * 1000:>8.2f}ms{conexoes:>10}")
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark de partida a frio (o plano free do Render dorme e acorda no primeiro webhook).
+
+1) `python -X importtime -c "import main"` (e `app_async`): tempo total do import e
+   os pacotes que mais pesam (tempo próprio somado por pacote). Pega regressões como
+   um módulo voltando a importar o SDK da OpenAI, o Pillow ou o NumPy no topo.
+2) Sobe o servidor contra o stub local e mede, a partir do Popen, o primeiro 200 no
+   POST /handler e a chegada da resposta no imbot.message.add do stub.
+   Modos: sync (gunicorn.conf.py: preload + warm-up), sync-sem-preload e async (uvicorn).
+
+Uso:
+  python bench/bench_partida.py
+  python bench/bench_partida.py --modos sync,sync-sem-preload --repeticoes 5 --top 15
+"""
+import argparse, os, statistics, subprocess, sys, time
+from collections import Counter
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import requests  # noqa: E402
+from stub_servidor import iniciar_stub  # noqa: E402
+from carga_sync_vs_async import porta_livre  # noqa: E402
+from gerador_carga import payload_mensagem  # noqa: E402
+
+
+def importtime(modulo: str, env: dict):
+    """(segundos do `import modulo`, Counter pacote -> segundos de tempo próprio)."""
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+                       cwd=RAIZ, env=env, capture_output=True, text=True, check=True)
+    total, por_pacote = 0.0, Counter()
+    for linha in r.stderr.splitlines():
+        if not linha.startswith("import time:") or "self [us]" in linha:
+            continue
+        proprio, cumulativo, nome = linha[len("import time:"):].split("|")
+        por_pacote[nome.strip().split(".")[0]] += int(proprio) / 1e6
+        if nome.strip() == modulo and nome.startswith(" ") and not nome.startswith("  "):
+            total = int(cumulativo) / 1e6
+    return total, por_pacote
+
+
+def subir(modo: str, porta: int, env: dict, workers: int):
+    if modo.startswith("sync"):
+        cmd = ["gunicorn", "-c", "gunicorn.conf.py", "main:app", "--bind", f"127.0.0.1:{porta}",
+               "--workers", str(workers), "--log-level", "warning"]
+        env = {**env, "GUNICORN_PRELOAD": "0" if modo == "sync-sem-preload" else "1"}
+    else:
+        cmd = ["uvicorn", "app_async:app", "--host", "127.0.0.1", "--port", str(porta),
+               "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(cmd, cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def primeira_resposta(modo: str, servidor, env: dict, args, n: int):
+    """(s até o 1º 200 no /handler, s até a resposta chegar ao Bitrix) a partir do Popen."""
+    porta = porta_livre()
+    dialog_id = f"partida{modo}{n}"
+    dados = payload_mensagem(dialog_id, 7000 + n, 700000 + n, "Qual o horário de coleta no sábado?", [],
+                             servidor.base_raiz)
+    t0 = time.time()
+    proc = subir(modo, porta, env, args.workers)
+    try:
+        ok = None
+        while ok is None and time.time() - t0 < args.timeout:
+            try:
+                if requests.post(f"http://127.0.0.1:{porta}/handler", data=dados, timeout=5).status_code == 200:
+                    ok = time.time() - t0
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.01)
+        resposta = None
+        while ok is not None and resposta is None and time.time() - t0 < args.timeout:
+            resposta = next((instante - t0 for d, _, instante in list(servidor.estado.mensagens_bitrix)
+                             if d == dialog_id), None)
+            time.sleep(0.01)
+        return ok, resposta
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--modos", default="sync,async", help="sync, sync-sem-preload, async")
+    ap.add_argument("--repeticoes", type=int, default=3)
+    ap.add_argument("--workers", type=int, default=2, help="processos do gunicorn (modo sync)")
+    ap.add_argument("--top", type=int, default=10, help="pacotes mais caros listados no importtime")
+    ap.add_argument("--duracao-run", type=float, default=0.5)
+    ap.add_argument("--timeout", type=float, default=60)
+    args = ap.parse_args()
+
+    servidor, base = iniciar_stub(duracao_run=args.duracao_run)
+    servidor.base_raiz = base.rsplit("/v1", 1)[0]
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": base, "OPENAI_API_KEY": "sk-stub", "API_KEY": "sk-stub",
+        "ASSISTANT_ID": "asst_stub", "BITRIX_WEBHOOK": servidor.base_raiz + "/rest/1/stub",
+        "AGRUPAR_ATIVO": "0", "RESP_CACHE_ATIVO": "0",
+    }
+
+    for modulo in ("main", "app_async"):
+        medidas = [importtime(modulo, env) for _ in range(args.repeticoes)]
+        total = statistics.median(t for t, _ in medidas)
+        print(f"import {modulo}: {total * 1000:.0f} ms (mediana de {args.repeticoes})")
+        for pacote, s in medidas[-1][1].most_common(args.top):
+            print(f"  {pacote:<28}{s * 1000:>8.1f} ms")
+
+    print(f"\n{'modo':<18}{'1º 200':>10}{'resposta':>10}   (mediana de {args.repeticoes}, a partir do Popen)")
+    for modo in args.modos.split(","):
+        modo = modo.strip()
+        medidas = [primeira_resposta(modo, servidor, env, args, n) for n in range(args.repeticoes)]
+        ok = [a for a, _ in medidas if a is not None]
+        resposta = [b for _, b in medidas if b is not None]
+        fmt = lambda v: f"{statistics.median(v):>9.2f}s" if v else f"{'—':>10}"
+        print(f"{modo:<18}{fmt(ok)}{fmt(resposta)}")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Compara streaming (SSE) x polling em chamar_openai_com contra o stub local.
+
+Uso:
+  python bench/bench_streaming.py --perguntas 10 --duracao-run 1.2
+"""
+import argparse, os, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_servidor import iniciar_stub  # noqa: E402
+
+
+def medir(modulo, servidor, streaming: bool, perguntas: int):
+    import cliente_assistants
+    cliente_assistants.OPENAI_STREAMING = streaming
+    servidor.estado.zerar_contadores()
+    tempos = []
+    for i in range(perguntas):
+        t0 = time.perf_counter()
+        modulo.chamar_openai_com(f"pergunta {i}")
+        tempos.append(time.perf_counter() - t0)
+    reqs = servidor.estado.requisicoes["total"] / perguntas
+    return tempos, reqs
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--perguntas", type=int, default=10)
+    ap.add_argument("--duracao-run", type=float, default=1.2)
+    args = ap.parse_args()
+
+    servidor, base = iniciar_stub(duracao_run=args.duracao_run)
+    os.environ.update({"OPENAI_BASE_URL": base, "OPENAI_API_KEY": "sk-stub", "ASSISTANT_ID": "asst_stub"})
+    import chamar_openai_com as modulo
+
+    print(f"run simulado de {args.duracao_run:.2f}s, {args.perguntas} perguntas por modo")
+    print(f"{'modo':<10}{'média':>10}{'p50':>10}{'máx':>10}{'req/pergunta':>15}")
+    for nome, streaming in (("polling", False), ("streaming", True)):
+        tempos, reqs = medir(modulo, servidor, streaming, args.perguntas)
+        print(f"{nome:<10}{statistics.mean(tempos):>9.3f}s{statistics.median(tempos):>9.3f}s"
+              f"{max(tempos):>9.3f}s{reqs:>15.1f}")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
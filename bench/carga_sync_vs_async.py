@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Teste de carga ponta a ponta: gunicorn main:app (sync + fila) x uvicorn app_async:app,
+ambos contra o stub local da OpenAI/Bitrix.
+
+Para cada modo, sobe o servidor num subprocesso, dispara N webhooks de diálogos
+distintos ao mesmo tempo e mede, por conversa, o tempo entre o POST /handler e a
+chegada da resposta no imbot.message.add do stub.
+
+Uso:
+  python bench/carga_sync_vs_async.py --conversas 200 --duracao-run 2
+  python bench/carga_sync_vs_async.py --modos async --conversas 1000
+"""
+import argparse, os, socket, statistics, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import requests  # noqa: E402
+from stub_servidor import iniciar_stub  # noqa: E402
+
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def subir_servidor(modo: str, porta: int, env: dict, workers: int):
+    if modo == "sync":
+        cmd = ["gunicorn", "main:app", "--bind", f"127.0.0.1:{porta}", "--workers", str(workers),
+               "--log-level", "warning"]
+    else:
+        cmd = ["uvicorn", "app_async:app", "--host", "127.0.0.1", "--port", str(porta),
+               "--log-level", "warning", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{porta}"
+    for _ in range(200):
+        try:
+            requests.get(url + "/", timeout=0.5)
+            return proc, url
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"servidor {modo} não subiu")
+
+
+def medir(modo: str, servidor, args):
+    porta = porta_livre()
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": servidor.base_openai, "OPENAI_API_KEY": "sk-stub", "API_KEY": "sk-stub",
+        "ASSISTANT_ID": "asst_stub", "BITRIX_WEBHOOK": servidor.base_bitrix,
+        "RESP_CACHE_ATIVO": "0", "FILA_WORKERS": str(args.fila_workers),
+        "FILA_MAX": str(args.conversas * 2), "ASYNC_MAX_CONCORRENCIA": str(args.conversas * 2),
+    }
+    proc, url = subir_servidor(modo, porta, env, args.workers)
+    estado = servidor.estado
+    try:
+        estado.zerar_contadores()
+        enviados = {}
+
+        def webhook(i: int):
+            dialog_id = f"chat{modo}{i}"
+            enviados[dialog_id] = time.time()
+            r = requests.post(f"{url}/handler", timeout=30, data={
+                "event": "ONIMBOTMESSAGEADD",
+                "data[PARAMS][DIALOG_ID]": dialog_id,
+                "data[PARAMS][MESSAGE]": f"pergunta de carga {i}",
+            })
+            return r.status_code
+
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=min(args.conversas, 200)) as ex:
+            codigos = list(ex.map(webhook, range(args.conversas)))
+        ack = time.time() - t0
+
+        limite = time.time() + args.timeout
+        while len(estado.mensagens_bitrix) < args.conversas and time.time() < limite:
+            time.sleep(0.05)
+        total = time.time() - t0
+        latencias = sorted(instante - enviados[d] for d, _, instante in list(estado.mensagens_bitrix)
+                           if d in enviados)
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+    def pct(p):
+        return latencias[min(len(latencias) - 1, int(p * len(latencias)))] if latencias else float("nan")
+
+    return {
+        "modo": modo, "respondidas": len(latencias), "aceitas": codigos.count(200),
+        "ack_s": ack, "total_s": total, "vazao": len(latencias) / total if total else 0,
+        "p50": pct(0.50), "p95": pct(0.95), "max": latencias[-1] if latencias else float("nan"),
+        "media": statistics.mean(latencias) if latencias else float("nan"),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--conversas", type=int, default=200)
+    ap.add_argument("--duracao-run", type=float, default=2.0)
+    ap.add_argument("--modos", default="sync,async")
+    ap.add_argument("--workers", type=int, default=2, help="processos do gunicorn (modo sync)")
+    ap.add_argument("--fila-workers", type=int, default=4, help="threads da fila por processo (modo sync)")
+    ap.add_argument("--timeout", type=float, default=300)
+    args = ap.parse_args()
+
+    servidor, base = iniciar_stub(duracao_run=args.duracao_run)
+    servidor.base_openai = base
+    servidor.base_bitrix = base.rsplit("/v1", 1)[0] + "/rest/1/stub"
+
+    print(f"{args.conversas} conversas simultâneas, run simulado de {args.duracao_run:.1f}s")
+    print(f"{'modo':<7}{'respondidas':>12}{'ack':>9}{'total':>9}{'conv/s':>9}"
+          f"{'p50':>9}{'p95':>9}{'máx':>9}")
+    for modo in args.modos.split(","):
+        r = medir(modo.strip(), servidor, args)
+        print(f"{r['modo']:<7}{r['respondidas']:>7}/{args.conversas:<4}{r['ack_s']:>8.2f}s{r['total_s']:>8.2f}s"
+              f"{r['vazao']:>9.1f}{r['p50']:>8.2f}s{r['p95']:>8.2f}s{r['max']:>8.2f}s")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Gerador de carga do /handler com webhooks ONIMBOTMESSAGEADD realistas (form-urlencoded,
+como o Bitrix envia), contra o stub local da OpenAI/Bitrix.
+
+Mede por requisição o ack do /handler e o tempo até a resposta aparecer no Bitrix
+(imbot.message.add no stub) e imprime p50/p95/p99 e req/s.
+
+  - carga aberta (--taxa): chegadas de Poisson na taxa pedida; a latência conta a
+    partir do instante agendado, então fila no cliente também aparece nos percentis;
+  - carga fechada (--concorrencia, sem --taxa): N clientes enviando sem pausa.
+
+Sobe o servidor (--modo sync: gunicorn main:app; --modo async: uvicorn app_async:app)
+ou usa um já rodando (--url, apontado para o stub em --stub-porta).
+
+Uso:
+  python bench/gerador_carga.py --modo sync --taxa 20 --duracao 30
+  python bench/gerador_carga.py --modo async --taxa 100 --duracao-run lognormal:1.5,0.5 --erro-runs 0.05
+  python bench/gerador_carga.py --url http://127.0.0.1:5000 --stub-porta 8099 --concorrencia 50
+"""
+import argparse, itertools, os, random, re, sys, tempfile, threading, time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import requests  # noqa: E402
+from stub_servidor import iniciar_stub, adicionar_argumentos, opcoes_do_stub  # noqa: E402
+from carga_sync_vs_async import porta_livre, subir_servidor  # noqa: E402
+
+PERGUNTAS_FREQUENTES = [
+    "Qual o horário de funcionamento do laboratório?",
+    "Preciso de jejum para o exame de glicemia?",
+    "Como faço para pegar o resultado do hemograma?",
+    "Vocês atendem convênio Unimed?",
+    "Qual o prazo do resultado de urina tipo 1?",
+]
+PERGUNTAS_VARIADAS = [
+    "O paciente {n} pode colher o exame de TSH depois de tomar o remédio?",
+    "Quanto tempo de jejum para o perfil lipídico do pedido {n}?",
+    "O resultado do protocolo {n} já saiu?",
+    "Pode remarcar a coleta domiciliar do pedido {n} para amanhã cedo?",
+    "Qual o valor particular do exame de vitamina D para o orçamento {n}?",
+    "A amostra {n} chegou hemolisada, precisa recoletar?",
+]
+
+
+class Cenario:
+    """Sorteia mensagens: diálogos recorrentes, perguntas repetidas (cache) e anexos de imagem."""
+
+    def __init__(self, dialogos: int, repetidas: float, anexos: float, base_stub: str, semente=None,
+                 imagens_por_anexo: int = 1):
+        self.rng = random.Random(semente)
+        self.dialogos = max(1, dialogos)
+        self.repetidas = repetidas
+        self.anexos = anexos
+        self.imagens_por_anexo = max(1, imagens_por_anexo)
+        self.base_stub = base_stub
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def proxima(self) -> tuple:
+        """(dialog_id, payload do form)."""
+        with self.lock:
+            n = next(self.ids)
+            usuario = 1000 + self.rng.randrange(self.dialogos)
+            sorteio = self.rng.random()
+            if sorteio < self.anexos:
+                texto, arquivos = "", [f"exame_{n}_{i}.png" for i in range(self.imagens_por_anexo)]
+            elif sorteio < self.anexos + self.repetidas:
+                texto, arquivos = self.rng.choice(PERGUNTAS_FREQUENTES), []
+            else:
+                texto, arquivos = self.rng.choice(PERGUNTAS_VARIADAS).format(n=n), []
+        return str(usuario), payload_mensagem(str(usuario), usuario, 500000 + n, texto, arquivos, self.base_stub)
+
+
+def payload_mensagem(dialog_id: str, usuario: int, message_id: int, texto: str, arquivos: list, base_stub: str):
+    """Campos de um ONIMBOTMESSAGEADD de chat privado, como chegam do Bitrix (form-urlencoded)."""
+    chat_id = 40000 + usuario
+    dados = {
+        "event": "ONIMBOTMESSAGEADD",
+        "event_handler_id": "7",
+        "data[BOT][136][BOT_ID]": "136",
+        "data[BOT][136][BOT_CODE]": "ana_lis",
+        "data[PARAMS][FROM_USER_ID]": str(usuario),
+        "data[PARAMS][MESSAGE]": texto,
+        "data[PARAMS][TO_CHAT_ID]": str(chat_id),
+        "data[PARAMS][MESSAGE_TYPE]": "P",
+        "data[PARAMS][SYSTEM]": "N",
+        "data[PARAMS][DIALOG_ID]": dialog_id,
+        "data[PARAMS][CHAT_ID]": str(chat_id),
+        "data[PARAMS][MESSAGE_ID]": str(message_id),
+        "data[PARAMS][CHAT_TYPE]": "P",
+        "data[PARAMS][LANGUAGE]": "br",
+        "data[USER][ID]": str(usuario),
+        "data[USER][NAME]": f"Usuário {usuario}",
+        "data[USER][IS_EXTRANET]": "N",
+        "ts": str(int(time.time())),
+        "auth[domain]": "laboratoriocac.bitrix24.com.br",
+        "auth[client_endpoint]": "https://laboratoriocac.bitrix24.com.br/rest/",
+        "auth[member_id]": "stub",
+        "auth[application_token]": "stub",
+    }
+    for i, arquivo in enumerate(arquivos):
+        fid = str(message_id * 100 + i)
+        dados.update({
+            f"data[PARAMS][FILES][{fid}][id]": fid,
+            f"data[PARAMS][FILES][{fid}][name]": arquivo,
+            f"data[PARAMS][FILES][{fid}][type]": "image",
+            f"data[PARAMS][FILES][{fid}][extension]": "png",
+            f"data[PARAMS][FILES][{fid}][urlDownload]": f"{base_stub}/arquivos/{arquivo}",
+        })
+    return dados
+
+
+class Registro:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.envios = []   # (dialog_id, agendado, ack, status_http, status_json)
+
+    def adicionar(self, *linha):
+        with self.lock:
+            self.envios.append(linha)
+
+
+def enviar(url: str, cenario: Cenario, registro: Registro, agendado: float):
+    dialog_id, dados = cenario.proxima()
+    try:
+        r = requests.post(f"{url}/handler", data=dados, timeout=30)
+        codigo = r.status_code
+        status = (r.json() if "json" in r.headers.get("Content-Type", "") else {}).get("status")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        codigo, status = type(e).__name__, None
+    registro.adicionar(dialog_id, agendado, time.time(), codigo, status)
+
+
+def carga_aberta(url: str, cenario: Cenario, registro: Registro, taxa: float, duracao: float, conexoes: int):
+    rng = random.Random()
+    fim = time.time() + duracao
+    proximo = time.time()
+    with ThreadPoolExecutor(max_workers=conexoes) as ex:
+        while proximo < fim:
+            espera = proximo - time.time()
+            if espera > 0:
+                time.sleep(espera)
+            ex.submit(enviar, url, cenario, registro, proximo)
+            proximo += rng.expovariate(taxa)
+
+
+def carga_fechada(url: str, cenario: Cenario, registro: Registro, concorrencia: int, duracao: float):
+    fim = time.time() + duracao
+
+    def cliente():
+        while time.time() < fim:
+            enviar(url, cenario, registro, time.time())
+
+    threads = [threading.Thread(target=cliente) for _ in range(concorrencia)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def percentis(valores: list) -> dict:
+    valores = sorted(valores)
+    if not valores:
+        return {p: float("nan") for p in ("p50", "p95", "p99", "máx")}
+    escolher = lambda q: valores[min(len(valores) - 1, int(q * len(valores)))]
+    return {"p50": escolher(0.50), "p95": escolher(0.95), "p99": escolher(0.99), "máx": valores[-1]}
+
+
+def tempos_ate_resposta(envios: list, eventos_bitrix: list) -> list:
+    """
+    Casa, por diálogo, a k-ésima mensagem aceita com a k-ésima imbot.message.add do stub
+    (o processamento é serializado por diálogo, então a ordem se mantém).
+    """
+    respostas = defaultdict(list)
+    for tipo, dialog_id, _, instante in eventos_bitrix:
+        if tipo == "add":
+            respostas[dialog_id].append(instante)
+    aceitas = defaultdict(list)
+    for dialog_id, agendado, _, codigo, status in sorted(envios, key=lambda e: e[1]):
+        if codigo == 200 and status in ("enfileirado", "ok"):
+            aceitas[dialog_id].append(agendado)
+    tempos = []
+    for dialog_id, enviados in aceitas.items():
+        for agendado, respondido in zip(enviados, sorted(respostas.get(dialog_id, []))):
+            tempos.append(respondido - agendado)
+    return tempos
+
+
+def medias_por_etapa(url: str) -> dict:
+    """Média de cada etapa de lis_etapa_segundos no /metrics do servidor."""
+    try:
+        texto = requests.get(f"{url}/metrics", timeout=10).text
+    except requests.exceptions.RequestException:
+        return {}
+    somas, contagens = {}, {}
+    for nome, etapa, valor in re.findall(r'^lis_etapa_segundos_(sum|count)\{etapa="([^"]+)"\} (\S+)$', texto, re.M):
+        (somas if nome == "sum" else contagens)[etapa] = float(valor)
+    return {e: (somas[e] / c, int(c)) for e, c in contagens.items() if c and e in somas}
+
+
+def imprimir_linha(nome: str, valores: list):
+    p = percentis(valores)
+    print(f"{nome:<22}{len(valores):>8}" + "".join(f"{p[k]:>9.3f}s" for k in ("p50", "p95", "p99", "máx")))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--modo", choices=("sync", "async"), default="sync", help="servidor a subir (sem --url)")
+    ap.add_argument("--url", help="servidor já rodando (apontado para o stub em --stub-porta)")
+    ap.add_argument("--stub-porta", type=int, default=0)
+    ap.add_argument("--taxa", type=float, default=0, help="requisições/s (carga aberta, chegadas de Poisson)")
+    ap.add_argument("--concorrencia", type=int, default=20, help="clientes simultâneos (carga fechada)")
+    ap.add_argument("--duracao", type=float, default=20, help="segundos de envio")
+    ap.add_argument("--conexoes", type=int, default=256, help="envios simultâneos no máximo (carga aberta)")
+    ap.add_argument("--dialogos", type=int, default=200, help="usuários distintos conversando")
+    ap.add_argument("--repetidas", type=float, default=0.2, help="fração de perguntas frequentes (cache)")
+    ap.add_argument("--anexos", type=float, default=0.0, help="fração de mensagens com imagem")
+    ap.add_argument("--imagens-por-anexo", type=int, default=1, help="imagens em cada mensagem com anexo")
+    ap.add_argument("--espera", type=float, default=60, help="quanto aguardar as respostas depois do envio")
+    ap.add_argument("--workers", type=int, default=2, help="processos do gunicorn (modo sync)")
+    ap.add_argument("--fila-workers", type=int, default=8, help="threads da fila por processo (modo sync)")
+    adicionar_argumentos(ap)
+    args = ap.parse_args()
+
+    servidor, base = iniciar_stub(args.stub_porta, **opcoes_do_stub(args))
+    base_stub = base.rsplit("/v1", 1)[0]
+    estado = servidor.estado
+    cenario = Cenario(args.dialogos, args.repetidas, args.anexos, base_stub, args.semente, args.imagens_por_anexo)
+    registro = Registro()
+
+    proc = None
+    url = args.url
+    if not url:
+        db_metricas = os.path.join(tempfile.mkdtemp(prefix="carga_"), "metricas.sqlite3")
+        env = {
+            **os.environ,
+            "OPENAI_BASE_URL": base, "OPENAI_API_KEY": "sk-stub", "API_KEY": "sk-stub",
+            "ASSISTANT_ID": "asst_stub", "BITRIX_WEBHOOK": f"{base_stub}/rest/1/stub",
+            "AGRUPAR_ATIVO": "0", "FILA_WORKERS": str(args.fila_workers), "FILA_MAX": "100000",
+            "ASYNC_MAX_CONCORRENCIA": "100000",
+            "METRICAS_DB": db_metricas, "METRICAS_FLUSH_S": "1",
+        }
+        proc, url = subir_servidor(args.modo, porta_livre(), env, args.workers)
+    else:
+        print(f"Stub em {base} — o servidor em {url} precisa apontar para ele.")
+
+    modo = f"{args.taxa:g} req/s (aberta)" if args.taxa > 0 else f"{args.concorrencia} clientes (fechada)"
+    print(f"{args.modo if not args.url else url}: {modo} por {args.duracao:g}s, run {args.duracao_run}, "
+          f"{args.dialogos} diálogos, {args.repetidas:.0%} repetidas, {args.anexos:.0%} com anexo")
+    try:
+        estado.zerar_contadores()
+        t0 = time.time()
+        if args.taxa > 0:
+            carga_aberta(url, cenario, registro, args.taxa, args.duracao, args.conexoes)
+        else:
+            carga_fechada(url, cenario, registro, args.concorrencia, args.duracao)
+        envio_s = time.time() - t0
+
+        envios = list(registro.envios)
+        aceitas = sum(1 for e in envios if e[3] == 200 and e[4] in ("enfileirado", "ok"))
+        limite = time.time() + args.espera
+        while time.time() < limite:
+            if sum(1 for e in list(estado.eventos_bitrix) if e[0] == "add") >= aceitas:
+                break
+            time.sleep(0.1)
+        time.sleep(1.5)   # os outros workers gravam o acumulado no METRICAS_DB
+        etapas = medias_por_etapa(url)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+        servidor.shutdown()
+
+    acks = [e[2] - e[1] for e in envios]
+    respostas = tempos_ate_resposta(envios, list(estado.eventos_bitrix))
+    print(f"\n{len(envios)} requisições em {envio_s:.1f}s = {len(envios) / envio_s:.1f} req/s; "
+          f"HTTP {dict(Counter(e[3] for e in envios))}; {dict(Counter(e[4] for e in envios))}")
+    print(f"{'':<22}{'n':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'máx':>10}")
+    imprimir_linha("ack do /handler", acks)
+    imprimir_linha("resposta no Bitrix", respostas)
+    print(f"respondidas: {len(respostas)}/{aceitas} aceitas")
+
+    req = estado.requisicoes
+    erros = {k.split(".", 1)[1]: v for k, v in req.items() if k.startswith("erros.")}
+    print(f"stub: {req['threads.runs.create'] + req['runs.create']} runs, {req['runs.retrieve']} polls, "
+          f"{req['chat.completions']} chat completions, {req['files.create']} uploads, "
+          f"{req['bitrix.batch']} batches no Bitrix; erros injetados: {erros or 'nenhum'}")
+    if etapas:
+        print("\netapas (/metrics, média):")
+        for etapa, (media, n) in sorted(etapas.items(), key=lambda x: -x[1][0]):
+            print(f"  {etapa:<22}{media:>9.3f}s  n={n}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Servidor falso da OpenAI (Assistants v2) e do REST do Bitrix para medir o bot sem rede.
+
+Uso:
+  python bench/stub_servidor.py --porta 8099 --duracao-run lognormal:2,0.4 --erro-runs 0.05
+  export OPENAI_BASE_URL=http://127.0.0.1:8099/v1
+  export BITRIX_WEBHOOK=http://127.0.0.1:8099/rest/1/stub
+
+Ou, dentro de um script de benchmark:
+  servidor, base = iniciar_stub(duracao_run=1.0)
+
+Latências aceitam um número (segundos fixos) ou uma distribuição:
+  uniforme:MIN,MAX   normal:MEDIA,DESVIO   lognormal:MEDIANA,SIGMA   exp:MEDIA
+Taxas de erro (0 a 1) por grupo de rotas: "runs" (threads/runs/messages), "chat",
+"files" e "bitrix" respondem HTTP 500; "run_falho" faz o run terminar em `failed`.
+O stub também serve uma imagem PNG em /arquivos/<nome> (download de anexos).
+"""
+import argparse, itertools, json, math, random, re, ssl, struct, threading, time, zlib
+from urllib.parse import parse_qsl
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPOSTA_PADRAO = "Resposta de teste da Ana Lis."
+GRUPOS_ERRO = ("runs", "chat", "files", "bitrix", "run_falho")
+
+
+def distribuicao(spec, rng: random.Random = None):
+    """Função sem argumentos que sorteia uma latência (s) conforme `spec` (ver docstring do módulo)."""
+    rng = rng or random.Random()
+    if spec is None:
+        return lambda: 0.0
+    if isinstance(spec, (int, float)):
+        return lambda: float(spec)
+    nome, _, args = str(spec).partition(":")
+    if not args:
+        return lambda: float(nome)
+    a, _, b = args.partition(",")
+    a, b = float(a), float(b or 0)
+    if nome == "uniforme":
+        return lambda: rng.uniform(a, b)
+    if nome == "normal":
+        return lambda: max(0.0, rng.gauss(a, b))
+    if nome == "lognormal":
+        return lambda: rng.lognormvariate(math.log(a), b)
+    if nome == "exp":
+        return lambda: rng.expovariate(1 / a) if a > 0 else 0.0
+    raise ValueError(f"distribuição desconhecida: {spec!r}")
+
+
+def _png(largura: int = 64, altura: int = 48) -> bytes:
+    """PNG RGB válido (gradiente), gerado sem Pillow."""
+    def bloco(tipo: bytes, dados: bytes) -> bytes:
+        return struct.pack(">I", len(dados)) + tipo + dados + struct.pack(">I", zlib.crc32(tipo + dados))
+    linhas = b"".join(b"\x00" + b"".join(bytes((x * 4 % 256, y * 5 % 256, 128)) for x in range(largura))
+                      for y in range(altura))
+    return (b"\x89PNG\r\n\x1a\n" + bloco(b"IHDR", struct.pack(">IIBBBBB", largura, altura, 8, 2, 0, 0, 0))
+            + bloco(b"IDAT", zlib.compress(linhas)) + bloco(b"IEND", b""))
+
+
+IMAGEM_PNG = _png()
+
+
+class EstadoStub:
+    def __init__(self, duracao_run=1.0, duracao_chat=None, latencia_api=None, latencia_bitrix=None,
+                 erros: dict = None, semente: int = None):
+        self.rng = random.Random(semente)
+        self.duracao_run = distribuicao(duracao_run, self.rng)
+        self.duracao_chat = distribuicao(duracao_run if duracao_chat is None else duracao_chat, self.rng)
+        self.latencia_api = distribuicao(latencia_api, self.rng)        # cada chamada à "OpenAI"
+        self.latencia_bitrix = distribuicao(latencia_bitrix, self.rng)  # cada chamada ao "Bitrix"
+        self.erros = {g: 0.0 for g in GRUPOS_ERRO}
+        self.erros.update(erros or {})
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.threads = {}       # thread_id -> [mensagens]
+        self.runs = {}          # run_id -> dict
+        self.requisicoes = Counter()
+        self.conexoes = 0
+        self.mensagens_bitrix = []   # (dialog_id, texto, instante) enviados via imbot.message.add
+        self.eventos_bitrix = []     # (método, dialog_id ou MESSAGE_ID, texto, instante): add/update/sendTyping
+        self.recusas_bitrix = 0      # próximos `batch` recusados com QUERY_LIMIT_EXCEEDED (teste de backoff)
+        self.cortes_stream = 0       # próximos runs com stream: aceita o POST e encerra sem nenhum evento
+        self.atraso_stream = 0.0     # espera (s) entre aceitar o POST com stream e o thread.run.created
+
+    def novo_id(self, prefixo: str) -> str:
+        return f"{prefixo}_{next(self.ids)}"
+
+    def zerar_contadores(self):
+        with self.lock:
+            self.requisicoes.clear()
+            self.conexoes = 0
+            self.mensagens_bitrix.clear()
+            self.eventos_bitrix.clear()
+
+    def status_run(self, run: dict) -> str:
+        if run["status"] in ("completed", "cancelled"):
+            return run["status"]
+        if run["status"] == "failed":
+            return "failed"
+        if time.time() - run["criado"] >= run["duracao"]:
+            self.finalizar_run(run)
+            return run["status"]
+        return "in_progress"
+
+    def sortear_erro(self, grupo: str) -> bool:
+        return self.erros.get(grupo, 0) > 0 and self.rng.random() < self.erros[grupo]
+
+    def finalizar_run(self, run: dict):
+        with self.lock:
+            if run["status"] in ("completed", "failed"):
+                return
+            if run["falhar"]:
+                run["status"] = "failed"
+                run["last_error"] = {"code": "server_error", "message": "falha simulada pelo stub"}
+                self.requisicoes["erros.run_falho"] += 1
+                return
+            run["status"] = "completed"
+            msg = {
+                "id": self.novo_id("msg"), "object": "thread.message", "role": "assistant",
+                "run_id": run["id"], "thread_id": run["thread_id"],
+                "content": [{"type": "text", "text": {"value": RESPOSTA_PADRAO, "annotations": []}}],
+            }
+            self.threads.setdefault(run["thread_id"], []).append(msg)
+            run["mensagem"] = msg
+
+
+class HandlerStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive: permite medir reuso de conexão
+    disable_nagle_algorithm = True  # cabeçalho e corpo saem em writes separados
+    estado: EstadoStub = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # cliente fechou o stream assim que recebeu o run.completed
+
+    def setup(self):
+        super().setup()
+        with self.estado.lock:
+            self.estado.conexoes += 1
+
+    # ---------- utilitários ----------
+    def _corpo(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        if not n:
+            return {}
+        try:
+            return json.loads(self.rfile.read(n))
+        except ValueError:
+            return {}
+
+    def _json(self, obj, status=200):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sse_inicio(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _sse_evento(self, evento: str, dados):
+        payload = dados if isinstance(dados, str) else json.dumps(dados)
+        bloco = f"event: {evento}\ndata: {payload}\n\n".encode()
+        self.wfile.write(f"{len(bloco):X}\r\n".encode() + bloco + b"\r\n")
+        self.wfile.flush()
+
+    def _sse_fim(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _contar(self, rota: str):
+        with self.estado.lock:
+            self.estado.requisicoes[rota] += 1
+            self.estado.requisicoes["total"] += 1
+
+    def _simular(self, grupo: str) -> bool:
+        """Latência de rede/servidor do grupo e erro sorteado. True se já respondeu com HTTP 500."""
+        atraso = (self.estado.latencia_bitrix if grupo == "bitrix" else self.estado.latencia_api)()
+        if atraso > 0:
+            time.sleep(atraso)
+        if not self.estado.sortear_erro(grupo):
+            return False
+        self._contar(f"erros.{grupo}")
+        if grupo == "bitrix":
+            self._json({"error": "INTERNAL_SERVER_ERROR", "error_description": "erro simulado pelo stub"}, 500)
+        else:
+            self._json({"error": {"message": "erro simulado pelo stub", "type": "server_error"}}, 500)
+        return True
+
+    # ---------- rotas ----------
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+        if path == "/v1/models":
+            self._contar("models.list")
+            return self._json({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+        if path.startswith("/arquivos/"):
+            self._contar("arquivos.download")
+            if self._simular("bitrix"):
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(IMAGEM_PNG)))
+            self.end_headers()
+            return self.wfile.write(IMAGEM_PNG)
+        m = re.fullmatch(r"/v1/threads/([^/]+)/runs/([^/]+)", path)
+        if m:
+            self._contar("runs.retrieve")
+            if self._simular("runs"):
+                return
+            run = self.estado.runs.get(m.group(2))
+            if not run:
+                return self._json({"error": {"message": "run não encontrado"}}, 404)
+            return self._json(self._run_obj(run, self.estado.status_run(run)))
+        m = re.fullmatch(r"/v1/threads/([^/]+)/messages", path)
+        if m:
+            self._contar("messages.list")
+            if self._simular("runs"):
+                return
+            msgs = list(self.estado.threads.get(m.group(1), []))
+            if params.get("order", "desc") == "desc":
+                msgs.reverse()
+            if "run_id" in params:
+                msgs = [x for x in msgs if x.get("run_id") == params["run_id"]]
+            return self._json({"object": "list", "data": msgs[: int(params.get("limit", 20))]})
+        self._json({"error": {"message": f"rota desconhecida {path}"}}, 404)
+
+    def do_DELETE(self):
+        path = self.path.partition("?")[0]
+        m = re.fullmatch(r"/v1/files/([^/]+)", path)
+        if m:
+            self._contar("files.delete")
+            return self._json({"id": m.group(1), "object": "file", "deleted": True})
+        self._json({"error": {"message": f"rota desconhecida {path}"}}, 404)
+
+    def do_POST(self):
+        path = self.path.partition("?")[0]
+        if path == "/v1/files":
+            self._contar("files.create")
+            n = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(n)
+            if self._simular("files"):
+                return
+            return self._json({"id": self.estado.novo_id("file"), "object": "file", "bytes": n,
+                               "created_at": int(time.time()), "filename": "upload", "purpose": "assistants",
+                               "status": "processed"})
+        corpo = self._corpo()
+        if path.startswith("/v1/threads") and self._simular("runs"):
+            return
+        if path == "/v1/threads":
+            self._contar("threads.create")
+            tid = self.estado.novo_id("thread")
+            self.estado.threads[tid] = []
+            return self._json({"id": tid, "object": "thread"})
+        m = re.fullmatch(r"/v1/threads/([^/]+)/messages", path)
+        if m:
+            self._contar("messages.create")
+            msg = {"id": self.estado.novo_id("msg"), "role": corpo.get("role", "user"),
+                   "content": corpo.get("content")}
+            self.estado.threads.setdefault(m.group(1), []).append(msg)
+            return self._json(msg)
+        if path == "/v1/threads/runs":
+            self._contar("threads.runs.create")
+            tid = self.estado.novo_id("thread")
+            self.estado.threads[tid] = [
+                {"id": self.estado.novo_id("msg"), "role": m.get("role", "user"), "content": m.get("content")}
+                for m in (corpo.get("thread") or {}).get("messages", [])
+            ]
+            return self._criar_run(tid, corpo)
+        m = re.fullmatch(r"/v1/threads/([^/]+)/runs/([^/]+)/cancel", path)
+        if m:
+            self._contar("runs.cancel")
+            run = self.estado.runs.get(m.group(2))
+            if not run:
+                return self._json({"error": {"message": "run não encontrado"}}, 404)
+            run["status"] = "cancelled"
+            return self._json({"id": run["id"], "object": "thread.run", "thread_id": run["thread_id"],
+                               "status": "cancelling"})
+        m = re.fullmatch(r"/v1/threads/([^/]+)/runs", path)
+        if m:
+            self._contar("runs.create")
+            tid = m.group(1)
+            if tid not in self.estado.threads:
+                return self._json({"error": {"message": f"No thread found with id '{tid}'."}}, 404)
+            for msg in corpo.get("additional_messages") or []:
+                self.estado.threads[tid].append(
+                    {"id": self.estado.novo_id("msg"), "role": msg.get("role", "user"), "content": msg.get("content")})
+            return self._criar_run(tid, corpo)
+        if path.startswith("/rest/") and path.endswith("/batch.json"):
+            self._contar("bitrix.batch")
+            if self._simular("bitrix"):
+                return
+            with self.estado.lock:
+                recusar = self.estado.recusas_bitrix > 0
+                self.estado.recusas_bitrix -= recusar
+            if recusar:
+                return self._json({"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"}, 503)
+            resultados = {}
+            for chave, linha in (corpo.get("cmd") or {}).items():
+                metodo, _, query = linha.partition("?")
+                resultados[chave] = self._bitrix(metodo, dict(parse_qsl(query)))
+            return self._json({"result": {"result": resultados, "result_error": []}})
+        m = re.fullmatch(r"/rest/.+/([\w.]+)\.json", path)
+        if m and m.group(1).startswith(("imbot.", "im.")):
+            if self._simular("bitrix"):
+                return
+            return self._json({"result": self._bitrix(m.group(1), corpo)})
+        if path == "/v1/chat/completions":
+            self._contar("chat.completions")
+            if self._simular("chat"):
+                return
+            time.sleep(self.estado.duracao_chat())
+            return self._json({"choices": [{"message": {"role": "assistant", "content": RESPOSTA_PADRAO}}]})
+        self._json({"error": {"message": f"rota desconhecida {path}"}}, 404)
+
+    def _bitrix(self, metodo: str, params: dict):
+        """Executa um comando REST do Bitrix (direto ou dentro de um `batch`) e devolve o `result`."""
+        self._contar(f"bitrix.{metodo}")
+        agora = time.time()
+        with self.estado.lock:
+            if metodo == "imbot.message.add":
+                message_id = next(self.estado.ids)
+                self.estado.mensagens_bitrix.append((params.get("DIALOG_ID"), params.get("MESSAGE"), agora))
+                self.estado.eventos_bitrix.append(("add", params.get("DIALOG_ID"), params.get("MESSAGE"), agora))
+                return message_id
+            if metodo == "imbot.message.update":
+                self.estado.eventos_bitrix.append(("update", params.get("MESSAGE_ID"), params.get("MESSAGE"), agora))
+            elif metodo == "imbot.chat.sendTyping":
+                self.estado.eventos_bitrix.append(("typing", params.get("DIALOG_ID"), None, agora))
+        return True
+
+    @staticmethod
+    def _run_obj(run: dict, status: str) -> dict:
+        obj = {"id": run["id"], "object": "thread.run", "thread_id": run["thread_id"], "status": status}
+        if status == "failed":
+            obj["last_error"] = run.get("last_error")
+        return obj
+
+    def _criar_run(self, thread_id: str, corpo: dict):
+        run = {"id": self.estado.novo_id("run"), "thread_id": thread_id, "status": "in_progress",
+               "criado": time.time(), "duracao": self.estado.duracao_run(),
+               "falhar": self.estado.sortear_erro("run_falho")}
+        self.estado.runs[run["id"]] = run
+        base = {"id": run["id"], "object": "thread.run", "thread_id": thread_id}
+        if not corpo.get("stream"):
+            return self._json({**base, "status": "queued"})
+
+        self._sse_inicio()
+        with self.estado.lock:
+            cortar = self.estado.cortes_stream > 0
+            self.estado.cortes_stream -= cortar
+        if cortar:
+            return self._sse_fim()   # o run existe, mas o cliente não chega a saber o id
+        if self.estado.atraso_stream:
+            time.sleep(self.estado.atraso_stream)
+        self._sse_evento("thread.run.created", {**base, "status": "queued"})
+        self._sse_evento("thread.run.in_progress", {**base, "status": "in_progress"})
+        # steps como no run real com file_search: uma tool call concluída antes da mensagem
+        step = {"object": "thread.run.step", "run_id": run["id"], "thread_id": thread_id}
+        busca = {**step, "id": self.estado.novo_id("step"), "type": "tool_calls"}
+        self._sse_evento("thread.run.step.created", {**busca, "status": "in_progress"})
+        self._sse_evento("thread.run.step.completed", {**busca, "status": "completed"})
+        mensagem = {**step, "id": self.estado.novo_id("step"), "type": "message_creation"}
+        self._sse_evento("thread.run.step.created", {**mensagem, "status": "in_progress"})
+        # deltas espalhados ao longo do run, como tokens sendo gerados
+        pedacos = RESPOSTA_PADRAO.split(" ")
+        inicio = time.time()
+        for i, pedaco in enumerate(pedacos):
+            quando = inicio + run["duracao"] * (i + 1) / len(pedacos)
+            while time.time() < quando:
+                if run["status"] == "cancelled":
+                    self._sse_evento("thread.run.cancelled", {**base, "status": "cancelled"})
+                    self._sse_evento("done", "[DONE]")
+                    return self._sse_fim()
+                time.sleep(min(0.02, max(0.0, quando - time.time())))
+            self._sse_evento("thread.message.delta",
+                             {"delta": {"content": [{"type": "text", "text": {"value": pedaco + " "}}]}})
+        self.estado.finalizar_run(run)
+        if run["status"] == "failed":
+            self._sse_evento("thread.run.failed", self._run_obj(run, "failed"))
+            self._sse_evento("done", "[DONE]")
+            return self._sse_fim()
+        self._sse_evento("thread.message.completed", run["mensagem"])
+        self._sse_evento("thread.run.step.completed", {**mensagem, "status": "completed"})
+        self._sse_evento("thread.run.completed", {**base, "status": "completed"})
+        self._sse_evento("done", "[DONE]")
+        self._sse_fim()
+
+
+def iniciar_stub(porta: int = 0, duracao_run=1.0, certificado: str = None, duracao_chat=None,
+                 latencia_api=None, latencia_bitrix=None, erros: dict = None, semente: int = None):
+    """
+    Sobe o stub numa thread daemon. Retorna (servidor, base_url_openai).
+    `duracao_run` / `duracao_chat` / `latencia_*`: segundos ou distribuição (ver docstring do módulo);
+    `duracao_chat` é a latência do /chat/completions (padrão: a mesma do run).
+    `erros`: {grupo: taxa}, com grupos em GRUPOS_ERRO.
+    `certificado`: PEM com cert + chave para servir HTTPS (mede custo de handshake TLS).
+    """
+    estado = EstadoStub(duracao_run=duracao_run, duracao_chat=duracao_chat, latencia_api=latencia_api,
+                        latencia_bitrix=latencia_bitrix, erros=erros, semente=semente)
+    handler = type("HandlerStubConfigurado", (HandlerStub,), {"estado": estado})
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), handler)
+    esquema = "http"
+    if certificado:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certificado)
+        servidor.socket = ctx.wrap_socket(servidor.socket, server_side=True)
+        esquema = "https"
+    servidor.daemon_threads = True
+    servidor.estado = estado
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"{esquema}://127.0.0.1:{servidor.server_address[1]}/v1"
+
+
+def adicionar_argumentos(ap: argparse.ArgumentParser):
+    """Opções de latência e erro do stub, compartilhadas com os scripts de carga."""
+    ap.add_argument("--duracao-run", default="1.0", help="até o run completar: segundos ou distribuição")
+    ap.add_argument("--duracao-chat", default=None, help="latência do /chat/completions (padrão: a do run)")
+    ap.add_argument("--latencia-api", default=None, help="atraso de cada chamada à OpenAI")
+    ap.add_argument("--latencia-bitrix", default=None, help="atraso de cada chamada ao Bitrix")
+    for grupo in GRUPOS_ERRO:
+        ap.add_argument(f"--erro-{grupo.replace('_', '-')}", type=float, default=0.0, dest=f"erro_{grupo}",
+                        help=f"taxa de erro (0 a 1) em {grupo}")
+    ap.add_argument("--semente", type=int, default=None, help="semente do sorteio (execuções reprodutíveis)")
+
+
+def opcoes_do_stub(args) -> dict:
+    return {
+        "duracao_run": args.duracao_run, "duracao_chat": args.duracao_chat,
+        "latencia_api": args.latencia_api, "latencia_bitrix": args.latencia_bitrix,
+        "erros": {g: getattr(args, f"erro_{g}") for g in GRUPOS_ERRO}, "semente": args.semente,
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--porta", type=int, default=8099)
+    adicionar_argumentos(ap)
+    args = ap.parse_args()
+    servidor, base = iniciar_stub(args.porta, **opcoes_do_stub(args))
+    print(f"Stub OpenAI em {base} (Ctrl+C para sair)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
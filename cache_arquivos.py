@@ -0,0 +1,273 @@
+# cache_arquivos.py
+"""
+Cache endereçado por conteúdo (SHA-256) para anexos:
+  - hash -> file_id da OpenAI        (pula o re-upload)
+  - hash + prompt -> texto da análise (pula a re-análise)
+
+Arquivos despejados (LRU) ou vencidos (TTL) são apagados na OpenAI em segundo
+plano, para não acumular uploads órfãos.
+
+Com ARQ_CACHE_DB, a camada hash -> file_id (com a hora do upload) fica num
+SQLite compartilhado e a limpeza parte do banco: todos os workers reaproveitam
+os mesmos uploads, e os enviados por um worker já reciclado também são
+apagados. Cada exclusão fica na tabela `exclusoes` até a OpenAI confirmar.
+"""
+import os, time, queue, sqlite3, hashlib, threading, logging
+from collections import OrderedDict
+
+from armazenamento_sqlite import BancoCompartilhado
+from metricas_prometheus import metricas
+
+log = logging.getLogger("cache_arquivos")
+
+ARQ_CACHE_MAX_ARQUIVOS = int(os.getenv("ARQ_CACHE_MAX_ARQUIVOS", "300"))
+ARQ_CACHE_MAX_ANALISES = int(os.getenv("ARQ_CACHE_MAX_ANALISES", "1000"))
+# Por quanto tempo mantemos (e reaproveitamos) um upload antes de apagá-lo na OpenAI.
+ARQ_CACHE_TTL_S = float(os.getenv("ARQ_CACHE_TTL_S", str(7 * 24 * 3600)))
+ARQ_CACHE_DB = os.getenv("ARQ_CACHE_DB", "")   # ex.: /var/data/arquivos.sqlite3
+_INTERVALO_VARREDURA_S = 60
+_REAGENDAR_EXCLUSAO_S = 600   # exclusão que ninguém confirmou (worker morreu, erro) volta para a fila
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS arquivos (
+    digest    TEXT PRIMARY KEY,
+    file_id   TEXT NOT NULL,
+    criado_em REAL NOT NULL,
+    usado_em  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS arquivos_criado_em ON arquivos(criado_em);
+CREATE INDEX IF NOT EXISTS arquivos_usado_em ON arquivos(usado_em);
+CREATE TABLE IF NOT EXISTS exclusoes (
+    file_id     TEXT PRIMARY KEY,
+    agendado_em REAL NOT NULL
+);
+"""
+
+
+def hash_conteudo(buf) -> str:
+    """SHA-256 do conteúdo de um BytesIO/bytes, sem copiar."""
+    dados = buf.getbuffer() if hasattr(buf, "getbuffer") else buf
+    try:
+        return hashlib.sha256(dados).hexdigest()
+    finally:
+        if isinstance(dados, memoryview):
+            dados.release()
+
+
+class CacheArquivos:
+    def __init__(self, excluir_remoto=None, max_arquivos: int = ARQ_CACHE_MAX_ARQUIVOS,
+                 max_analises: int = ARQ_CACHE_MAX_ANALISES, ttl_s: float = ARQ_CACHE_TTL_S,
+                 caminho_db: str = ARQ_CACHE_DB):
+        self.excluir_remoto = excluir_remoto      # fn(file_id), ex.: openai_client.files.delete
+        self.max_arquivos = max(1, max_arquivos)
+        self.max_analises = max(1, max_analises)
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._arquivos = OrderedDict()            # hash -> (file_id, criado_em) (só sem ARQ_CACHE_DB)
+        self._analises = OrderedDict()            # (hash, prompt) -> (texto, criado_em)
+        self._ultima_varredura = time.time()
+        self._exclusoes = queue.Queue()
+        self._thread_exclusao = None
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        self.stats = {"uploads_evitados": 0, "analises_evitadas": 0, "faltas_arquivo": 0,
+                      "faltas_analise": 0, "exclusoes_remotas": 0, "falhas_exclusao": 0}
+
+    # ---------- file_id ----------
+    def file_id(self, digest: str):
+        agora = time.time()
+        self._varrer_se_preciso(agora)
+        if self._db:
+            file_id = self._file_id_db(digest, agora)
+        else:
+            with self._lock:
+                item = self._arquivos.get(digest)
+                file_id = item[0] if item and agora - item[1] <= self.ttl_s else None
+                if file_id:
+                    self._arquivos.move_to_end(digest)
+        with self._lock:
+            self.stats["uploads_evitados" if file_id else "faltas_arquivo"] += 1
+        metricas.contar("lis_cache_total", cache="arquivos", resultado="hit" if file_id else "miss")
+        return file_id
+
+    def guardar_file_id(self, digest: str, file_id: str):
+        if self._db:
+            self._guardar_file_id_db(digest, file_id, time.time())
+            return
+        with self._lock:
+            antigo = self._arquivos.pop(digest, None)
+            if antigo and antigo[0] != file_id:
+                self._agendar_exclusao(antigo[0])
+            self._arquivos[digest] = (file_id, time.time())
+            while len(self._arquivos) > self.max_arquivos:
+                _, (fid, _) = self._arquivos.popitem(last=False)
+                self._agendar_exclusao(fid)
+
+    def descartar_file_id(self, digest: str):
+        """O file_id deixou de funcionar (ex.: apagado fora daqui): esquece sem tentar excluir."""
+        with self._lock:
+            self._arquivos.pop(digest, None)
+        if self._db:
+            try:
+                with self._db.lock:
+                    self._db.conn().execute("DELETE FROM arquivos WHERE digest = ?", (digest,))
+            except sqlite3.Error as e:
+                log.warning(f"Cache de arquivos SQLite falhou ao descartar {digest[:12]}: {e}")
+
+    # ---------- file_id no SQLite (ARQ_CACHE_DB) ----------
+    def _file_id_db(self, digest: str, agora: float):
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                row = conn.execute("SELECT file_id, criado_em FROM arquivos WHERE digest = ?",
+                                   (digest,)).fetchone()
+                if not row or agora - row[1] > self.ttl_s:
+                    return None   # o vencido sai na próxima varredura, junto com o arquivo remoto
+                conn.execute("UPDATE arquivos SET usado_em = ? WHERE digest = ?", (agora, digest))
+                return row[0]
+        except sqlite3.Error as e:
+            log.warning(f"Cache de arquivos SQLite falhou ({e}); enviando o anexo de novo.")
+            return None
+
+    def _guardar_file_id_db(self, digest: str, file_id: str, agora: float):
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # outro worker subiu o mesmo conteúdo antes: o upload antigo vai para a fila de exclusão
+                    conn.execute("INSERT OR IGNORE INTO exclusoes(file_id, agendado_em) "
+                                 "SELECT file_id, 0 FROM arquivos WHERE digest = ? AND file_id <> ?",
+                                 (digest, file_id))
+                    conn.execute(
+                        "INSERT INTO arquivos(digest, file_id, criado_em, usado_em) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(digest) DO UPDATE SET file_id=excluded.file_id, "
+                        "criado_em=excluded.criado_em, usado_em=excluded.usado_em",
+                        (digest, file_id, agora, agora),
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            # sem registro, o upload não é reaproveitado nem apagado por aqui: melhor apagar já
+            log.warning(f"Cache de arquivos SQLite falhou ao guardar {file_id}: {e}")
+            with self._lock:
+                self._agendar_exclusao(file_id)
+
+    # ---------- análises ----------
+    def analise(self, digest: str, prompt: str):
+        chave = (digest, prompt)
+        with self._lock:
+            item = self._analises.get(chave)
+            if item and time.time() - item[1] <= self.ttl_s:
+                self._analises.move_to_end(chave)
+                self.stats["analises_evitadas"] += 1
+                metricas.contar("lis_cache_total", cache="analises", resultado="hit")
+                return item[0]
+            self._analises.pop(chave, None)
+            self.stats["faltas_analise"] += 1
+            metricas.contar("lis_cache_total", cache="analises", resultado="miss")
+            return None
+
+    def guardar_analise(self, digest: str, prompt: str, texto: str):
+        with self._lock:
+            self._analises[(digest, prompt)] = (texto, time.time())
+            self._analises.move_to_end((digest, prompt))
+            while len(self._analises) > self.max_analises:
+                self._analises.popitem(last=False)
+
+    # ---------- limpeza ----------
+    def _varrer_se_preciso(self, agora: float):
+        with self._lock:
+            if agora - self._ultima_varredura < _INTERVALO_VARREDURA_S:
+                return
+            self._ultima_varredura = agora
+            vencidos = [d for d, (_, criado) in self._arquivos.items() if agora - criado > self.ttl_s]
+            for d in vencidos:
+                fid, _ = self._arquivos.pop(d)
+                self._agendar_exclusao(fid)
+            for chave in [k for k, (_, criado) in self._analises.items() if agora - criado > self.ttl_s]:
+                del self._analises[chave]
+        if self._db:
+            self._varrer_db(agora)
+
+    def _varrer_db(self, agora: float):
+        """Vencidos e excedentes do LRU vão para `exclusoes`; pega as exclusões livres para este worker."""
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    sair = ("SELECT digest FROM arquivos WHERE criado_em < ? UNION "
+                            "SELECT digest FROM (SELECT digest FROM arquivos ORDER BY usado_em DESC LIMIT -1 OFFSET ?)")
+                    params = (agora - self.ttl_s, self.max_arquivos)
+                    conn.execute("INSERT OR IGNORE INTO exclusoes(file_id, agendado_em) "
+                                 f"SELECT file_id, 0 FROM arquivos WHERE digest IN ({sair})", params)
+                    conn.execute(f"DELETE FROM arquivos WHERE digest IN ({sair})", params)
+                    # inclui as agendadas por workers que sumiram antes de a OpenAI confirmar
+                    limite = agora - _REAGENDAR_EXCLUSAO_S
+                    file_ids = [r[0] for r in conn.execute(
+                        "SELECT file_id FROM exclusoes WHERE agendado_em < ?", (limite,))]
+                    conn.execute("UPDATE exclusoes SET agendado_em = ? WHERE agendado_em < ?", (agora, limite))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            log.warning(f"Varredura do cache de arquivos no SQLite falhou: {e}")
+            return
+        with self._lock:
+            for fid in file_ids:
+                self._agendar_exclusao(fid)
+
+    def _agendar_exclusao(self, file_id: str):
+        if not self.excluir_remoto:
+            return
+        if self._thread_exclusao is None or not self._thread_exclusao.is_alive():
+            self._thread_exclusao = threading.Thread(target=self._loop_exclusao, name="exclusao-arquivos",
+                                                     daemon=True)
+            self._thread_exclusao.start()
+        self._exclusoes.put(file_id)
+
+    def _loop_exclusao(self):
+        while True:
+            file_id = self._exclusoes.get()
+            try:
+                self.excluir_remoto(file_id)
+                self.stats["exclusoes_remotas"] += 1
+            except Exception as e:
+                if getattr(e, "status_code", None) != 404:   # 404: já não existe, exclusão cumprida
+                    self.stats["falhas_exclusao"] += 1
+                    log.warning(f"Não consegui apagar o arquivo {file_id} na OpenAI: {e}")
+                    continue   # com SQLite, fica em `exclusoes` e volta após _REAGENDAR_EXCLUSAO_S
+            if self._db:
+                try:
+                    with self._db.lock:
+                        self._db.conn().execute("DELETE FROM exclusoes WHERE file_id = ?", (file_id,))
+                except sqlite3.Error as e:
+                    log.warning(f"Não consegui confirmar a exclusão de {file_id} no SQLite: {e}")
+
+    def _contar_db(self):
+        """(arquivos, exclusões pendentes) no SQLite, ou (None, None) se o banco falhar."""
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                return (conn.execute("SELECT COUNT(*) FROM arquivos").fetchone()[0],
+                        conn.execute("SELECT COUNT(*) FROM exclusoes").fetchone()[0])
+        except sqlite3.Error as e:
+            log.warning(f"Cache de arquivos SQLite falhou ao contar: {e}")
+            return None, None
+
+    def metricas(self) -> dict:
+        arquivos_db, exclusoes_db = self._contar_db() if self._db else (None, None)
+        with self._lock:
+            return {
+                "persistente": bool(self._db),
+                "arquivos": arquivos_db if self._db else len(self._arquivos),
+                "analises": len(self._analises),
+                "max_arquivos": self.max_arquivos,
+                "max_analises": self.max_analises,
+                "ttl_s": self.ttl_s,
+                "exclusoes_pendentes": exclusoes_db if self._db else self._exclusoes.qsize(),
+                **self.stats,
+            }
@@ -0,0 +1,164 @@
+# cache_respostas.py
+"""
+Cache de respostas para perguntas operacionais repetidas, na frente do chamar_openai_com.
+
+Camada 1 (exata): texto normalizado (caixa, acentos, espaços e pontuação).
+Camada 2 (opcional, RESP_CACHE_SEMANTICO=1): quase-duplicatas por cosseno sobre
+vetores de n-gramas com hashing, numa matriz NumPy local (sem serviço externo).
+"""
+import os, re, time, threading, unicodedata, zlib, logging
+from collections import OrderedDict
+
+from metricas_prometheus import metricas
+
+np = None   # NumPy só é importado com a camada semântica ligada (partida mais rápida)
+
+log = logging.getLogger("cache_respostas")
+
+RESP_CACHE_ATIVO     = os.getenv("RESP_CACHE_ATIVO", "1") != "0"
+RESP_CACHE_MAX       = int(os.getenv("RESP_CACHE_MAX", "500"))
+RESP_CACHE_TTL_S     = float(os.getenv("RESP_CACHE_TTL_S", str(6 * 3600)))
+RESP_CACHE_SEMANTICO = os.getenv("RESP_CACHE_SEMANTICO", "0") == "1"
+RESP_CACHE_LIMIAR    = float(os.getenv("RESP_CACHE_LIMIAR", "0.92"))
+RESP_CACHE_DIM       = int(os.getenv("RESP_CACHE_DIM", "2048"))
+# Mensagens curtas ("sim", "e amanhã?") dependem do contexto da conversa: não entram no cache.
+RESP_CACHE_MIN_PALAVRAS = int(os.getenv("RESP_CACHE_MIN_PALAVRAS", "3"))
+
+_RE_PONTUACAO = re.compile(r"[^\w\s]")
+_RE_ESPACOS = re.compile(r"\s+")
+
+
+def normalizar(texto: str) -> str:
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    texto = _RE_PONTUACAO.sub(" ", texto)
+    return _RE_ESPACOS.sub(" ", texto).strip()
+
+
+def _vetor(normalizado: str, dim: int):
+    """Trigramas de caracteres + palavras, com hashing estável (crc32) em `dim` posições, norma L2."""
+    v = np.zeros(dim, dtype=np.float32)
+    s = f" {normalizado} "
+    for i in range(len(s) - 2):
+        v[zlib.crc32(s[i:i + 3].encode()) % dim] += 1.0
+    for palavra in normalizado.split():
+        v[zlib.crc32(b"w:" + palavra.encode()) % dim] += 2.0
+    n = np.linalg.norm(v)
+    return v / n if n else v
+
+
+def _carregar_numpy() -> bool:
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # camada semântica fica indisponível
+            return False
+        np = numpy
+    return True
+
+
+class CacheRespostas:
+    def __init__(self, max_itens: int = RESP_CACHE_MAX, ttl_s: float = RESP_CACHE_TTL_S,
+                 semantico: bool = RESP_CACHE_SEMANTICO, limiar: float = RESP_CACHE_LIMIAR,
+                 dim: int = RESP_CACHE_DIM):
+        self.max_itens = max(1, max_itens)
+        self.ttl_s = ttl_s
+        self.limiar = limiar
+        self.dim = dim
+        self.semantico = semantico and _carregar_numpy()
+        if semantico and not self.semantico:
+            log.warning("RESP_CACHE_SEMANTICO=1 mas NumPy não está instalado; só a camada exata fica ativa.")
+        self._lock = threading.Lock()
+        self._itens = OrderedDict()   # chave -> (resposta, criado_em, linha_na_matriz)
+        if self.semantico:
+            self._matriz = np.zeros((self.max_itens, dim), dtype=np.float32)
+            self._chaves_linha = [None] * self.max_itens
+            self._linhas_livres = list(range(self.max_itens - 1, -1, -1))
+        self.acertos_exatos = 0
+        self.acertos_semanticos = 0
+        self.faltas = 0
+        self.invalidacoes = 0
+
+    def _chave(self, pergunta: str):
+        n = normalizar(pergunta)
+        if len(n.split()) < RESP_CACHE_MIN_PALAVRAS:
+            return None
+        return n
+
+    def obter(self, pergunta: str):
+        chave = self._chave(pergunta)
+        if chave is None:
+            return None
+        agora = time.time()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item and agora - item[1] > self.ttl_s:
+                self._remover(chave)
+                item = None
+            if item:
+                self._itens.move_to_end(chave)
+                self.acertos_exatos += 1
+                metricas.contar("lis_cache_total", cache="respostas", resultado="hit_exato")
+                return item[0]
+            if self.semantico and self._itens:
+                similares = self._matriz @ _vetor(chave, self.dim)
+                linha = int(similares.argmax())
+                alvo = self._chaves_linha[linha]
+                if alvo is not None and similares[linha] >= self.limiar:
+                    resposta, criado, _ = self._itens[alvo]
+                    if agora - criado <= self.ttl_s:
+                        self._itens.move_to_end(alvo)
+                        self.acertos_semanticos += 1
+                        metricas.contar("lis_cache_total", cache="respostas", resultado="hit_semantico")
+                        log.info(f"Cache semântico: {chave!r} ~ {alvo!r} ({similares[linha]:.3f})")
+                        return resposta
+                    self._remover(alvo)
+            self.faltas += 1
+            metricas.contar("lis_cache_total", cache="respostas", resultado="miss")
+            return None
+
+    def guardar(self, pergunta: str, resposta: str):
+        chave = self._chave(pergunta)
+        if chave is None or not resposta:
+            return
+        with self._lock:
+            if chave in self._itens:
+                self._remover(chave)
+            while len(self._itens) >= self.max_itens:
+                self._remover(next(iter(self._itens)))
+            linha = None
+            if self.semantico:
+                linha = self._linhas_livres.pop()
+                self._matriz[linha] = _vetor(chave, self.dim)
+                self._chaves_linha[linha] = chave
+            self._itens[chave] = (resposta, time.time(), linha)
+
+    def _remover(self, chave: str):
+        _, _, linha = self._itens.pop(chave)
+        if linha is not None:
+            self._matriz[linha] = 0.0
+            self._chaves_linha[linha] = None
+            self._linhas_livres.append(linha)
+
+    def invalidar(self):
+        """Esvazia o cache. Chamar quando a base de conhecimento do assistant mudar (/admin/cache/invalidar)."""
+        with self._lock:
+            for chave in list(self._itens):
+                self._remover(chave)
+            self.invalidacoes += 1
+        log.info("Cache de respostas invalidado.")
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "ativo": RESP_CACHE_ATIVO,
+                "semantico": self.semantico,
+                "itens": len(self._itens),
+                "max_itens": self.max_itens,
+                "ttl_s": self.ttl_s,
+                "acertos_exatos": self.acertos_exatos,
+                "acertos_semanticos": self.acertos_semanticos,
+                "faltas": self.faltas,
+                "invalidacoes": self.invalidacoes,
+            }
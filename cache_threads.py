@@ -0,0 +1,271 @@
+# cache_threads.py
+import os, time, uuid, asyncio, sqlite3, threading, logging
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+
+from armazenamento_sqlite import BancoCompartilhado
+from metricas_prometheus import metricas
+
+log = logging.getLogger("cache_threads")
+
+THREAD_CACHE_MAX   = int(os.getenv("THREAD_CACHE_MAX", "2000"))
+THREAD_CACHE_TTL_S = float(os.getenv("THREAD_CACHE_TTL_S", str(12 * 3600)))  # ociosidade
+THREAD_CACHE_DB    = os.getenv("THREAD_CACHE_DB", "")   # ex.: /var/data/threads.sqlite3
+# Com THREAD_CACHE_DB, a trava do diálogo também vale entre workers: uma linha em `travas`
+# com prazo (se o worker morrer segurando, outro assume depois de THREAD_TRAVA_TTL_S)
+THREAD_TRAVA_TTL_S = float(os.getenv("THREAD_TRAVA_TTL_S", "120"))
+_TRAVA_ESPERA_S = 0.05   # intervalo entre tentativas quando outro worker tem a trava
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS threads (
+    dialog_id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    usado_em  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS threads_usado_em ON threads(usado_em);
+CREATE TABLE IF NOT EXISTS travas (
+    dialog_id TEXT PRIMARY KEY,
+    dono      TEXT NOT NULL,
+    expira_em REAL NOT NULL
+);
+"""
+
+
+class CacheThreads:
+    """
+    dialog_id (Bitrix) -> thread_id (OpenAI), com LRU, TTL de ociosidade e
+    persistência opcional em SQLite (sobrevive a restart e é visto por todos
+    os workers apontando para o mesmo arquivo).
+
+    `travar(dialog_id)` serializa mensagens do mesmo diálogo: uma thread só
+    aceita um run ativo por vez. Com SQLite, entre todos os workers (tabela `travas`).
+    Falhas do SQLite não derrubam a resposta: o cache segue só em memória.
+    """
+
+    def __init__(self, max_itens: int = THREAD_CACHE_MAX, ttl_s: float = THREAD_CACHE_TTL_S,
+                 caminho_db: str = THREAD_CACHE_DB):
+        self.max_itens = max(1, max_itens)
+        self.ttl_s = ttl_s
+        self._itens = OrderedDict()      # dialog_id -> (thread_id, usado_em)
+        self._lock = threading.Lock()
+        self._locks_dialogo = {}         # dialog_id -> [Lock, usuários]
+        self._locks_dialogo_async = {}   # dialog_id -> [asyncio.Lock, usuários] (modo ASGI)
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        self.acertos = 0
+        self.faltas = 0
+        self.expirados = 0
+        self.despejados = 0
+        self.esperas_trava = 0   # vezes em que outro worker estava com o diálogo
+        self.erros_db = 0
+
+    # ---------- lock por diálogo ----------
+    @contextmanager
+    def travar(self, dialog_id: str):
+        with self._lock:
+            entrada = self._locks_dialogo.setdefault(dialog_id, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                dono = self._travar_db(dialog_id)
+                try:
+                    yield
+                finally:
+                    self._soltar_db(dialog_id, dono)
+        finally:
+            with self._lock:
+                entrada[1] -= 1
+                if entrada[1] == 0:
+                    self._locks_dialogo.pop(dialog_id, None)
+
+    @asynccontextmanager
+    async def travar_async(self, dialog_id: str):
+        """Mesmo papel de `travar`, para o event loop do app_async."""
+        entrada = self._locks_dialogo_async.setdefault(dialog_id, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                dono = await self._travar_db_async(dialog_id)
+                try:
+                    yield
+                finally:
+                    if dono:
+                        await asyncio.to_thread(self._soltar_db, dialog_id, dono)
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                self._locks_dialogo_async.pop(dialog_id, None)
+
+    # ---------- trava entre workers (SQLite) ----------
+    def _tentar_trava_db(self, dialog_id: str, dono: str) -> bool:
+        """Uma tentativa: pega a trava se está livre ou vencida. Levanta sqlite3.Error."""
+        agora = time.time()
+        with self._db.lock:
+            cur = self._db.conn().execute(
+                "INSERT INTO travas(dialog_id, dono, expira_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(dialog_id) DO UPDATE SET dono=excluded.dono, expira_em=excluded.expira_em "
+                "WHERE travas.expira_em < ?",
+                (dialog_id, dono, agora + THREAD_TRAVA_TTL_S, agora),
+            )
+            return cur.rowcount == 1
+
+    def _travar_db(self, dialog_id: str):
+        """Espera a trava do diálogo no SQLite. Retorna o dono (para soltar) ou None sem SQLite/com erro."""
+        if not self._db:
+            return None
+        dono = f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        esperou = False
+        try:
+            while not self._tentar_trava_db(dialog_id, dono):
+                esperou = True
+                time.sleep(_TRAVA_ESPERA_S)
+        except sqlite3.Error as e:
+            self._erro_db("travar", e)
+            return None
+        if esperou:
+            with self._lock:
+                self.esperas_trava += 1
+        return dono
+
+    async def _travar_db_async(self, dialog_id: str):
+        if not self._db:
+            return None
+        dono = f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        esperou = False
+        try:
+            while not await self._tentar_trava_db_async(dialog_id, dono):
+                esperou = True
+                await asyncio.sleep(_TRAVA_ESPERA_S)
+        except sqlite3.Error as e:
+            self._erro_db("travar", e)
+            return None
+        if esperou:
+            with self._lock:
+                self.esperas_trava += 1
+        return dono
+
+    async def _tentar_trava_db_async(self, dialog_id: str, dono: str) -> bool:
+        """
+        _tentar_trava_db numa thread. Se a tarefa for cancelada no meio (hedge),
+        a thread segue e pode pegar a trava: solta assim que ela terminar, senão
+        o diálogo fica preso até THREAD_TRAVA_TTL_S.
+        """
+        tentativa = asyncio.ensure_future(asyncio.to_thread(self._tentar_trava_db, dialog_id, dono))
+        try:
+            return await asyncio.shield(tentativa)
+        except asyncio.CancelledError:
+            def soltar_se_pegou(f):
+                if not f.cancelled() and f.exception() is None and f.result():
+                    self._soltar_db(dialog_id, dono)
+            tentativa.add_done_callback(soltar_se_pegou)
+            raise
+
+    def _soltar_db(self, dialog_id: str, dono):
+        if not (self._db and dono):
+            return
+        try:
+            with self._db.lock:
+                self._db.conn().execute("DELETE FROM travas WHERE dialog_id = ? AND dono = ?", (dialog_id, dono))
+        except sqlite3.Error as e:
+            self._erro_db("soltar", e)   # a trava vence sozinha em THREAD_TRAVA_TTL_S
+
+    def _erro_db(self, operacao: str, e: Exception):
+        with self._lock:
+            self.erros_db += 1
+        log.warning(f"SQLite do cache de threads falhou ({operacao}): {e}; seguindo só com a memória.")
+
+    # ---------- cache ----------
+    def obter(self, dialog_id: str):
+        agora = time.time()
+        with self._lock:
+            item = self._itens.get(dialog_id)
+            if item and agora - item[1] > self.ttl_s:
+                del self._itens[dialog_id]
+                self.expirados += 1
+                item = None
+            if item:
+                self._itens[dialog_id] = (item[0], agora)
+                self._itens.move_to_end(dialog_id)
+                self.acertos += 1
+                metricas.contar("lis_cache_total", cache="threads", resultado="hit")
+                return item[0]
+        thread_id = self._obter_db(dialog_id, agora)
+        with self._lock:
+            if thread_id:
+                self.acertos += 1
+                self._inserir(dialog_id, thread_id, agora)
+            else:
+                self.faltas += 1
+        metricas.contar("lis_cache_total", cache="threads", resultado="hit" if thread_id else "miss")
+        return thread_id
+
+    def guardar(self, dialog_id: str, thread_id: str):
+        agora = time.time()
+        with self._lock:
+            self._inserir(dialog_id, thread_id, agora)
+        if not self._db:
+            return
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                conn.execute(
+                    "INSERT INTO threads(dialog_id, thread_id, usado_em) VALUES (?, ?, ?) "
+                    "ON CONFLICT(dialog_id) DO UPDATE SET thread_id=excluded.thread_id, usado_em=excluded.usado_em",
+                    (dialog_id, thread_id, agora),
+                )
+                conn.execute("DELETE FROM threads WHERE usado_em < ?", (agora - self.ttl_s,))
+                conn.execute(
+                    "DELETE FROM threads WHERE dialog_id NOT IN "
+                    "(SELECT dialog_id FROM threads ORDER BY usado_em DESC LIMIT ?)",
+                    (self.max_itens,),
+                )
+        except sqlite3.Error as e:
+            self._erro_db("guardar", e)   # a resposta já saiu; só este worker lembra da thread
+
+    def remover(self, dialog_id: str):
+        with self._lock:
+            self._itens.pop(dialog_id, None)
+        if not self._db:
+            return
+        try:
+            with self._db.lock:
+                self._db.conn().execute("DELETE FROM threads WHERE dialog_id = ?", (dialog_id,))
+        except sqlite3.Error as e:
+            self._erro_db("remover", e)
+
+    def _inserir(self, dialog_id: str, thread_id: str, agora: float):
+        self._itens[dialog_id] = (thread_id, agora)
+        self._itens.move_to_end(dialog_id)
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+            self.despejados += 1
+
+    def _obter_db(self, dialog_id: str, agora: float):
+        if not self._db:
+            return None
+        try:
+            with self._db.lock:
+                row = self._db.conn().execute(
+                    "SELECT thread_id, usado_em FROM threads WHERE dialog_id = ?", (dialog_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            self._erro_db("obter", e)
+            return None
+        if row and agora - row[1] <= self.ttl_s:
+            return row[0]
+        return None
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "itens": len(self._itens),
+                "max_itens": self.max_itens,
+                "ttl_s": self.ttl_s,
+                "persistente": bool(self._db),
+                "acertos": self.acertos,
+                "faltas": self.faltas,
+                "expirados": self.expirados,
+                "despejados": self.despejados,
+                "dialogos_travados": len(self._locks_dialogo) + len(self._locks_dialogo_async),
+                "esperas_trava": self.esperas_trava,
+                "erros_db": self.erros_db,
+            }
@@ -1,5 +1,19 @@
 # chamar_openai_com.py
-import os, time, requests, logging
+import os, time, asyncio, requests, logging, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+
+import cliente_assistants
+from cliente_assistants import ErroRun, ControleRun, descrever_erro_http, executar_run, executar_run_async
+from cache_threads import CacheThreads
+from memoria_conversa import MemoriaConversa
+from armazenamento_sqlite import fora_do_loop
+from cliente_http import sessao_openai, timeout, cliente_async, timeout_async, FILA_WORKERS
+from limitador_openai import limitador, LimiteExcedido, estimar_tokens, OPENAI_TOKENS_RUN
+from hedge_fallback import LimiarAdaptativo, HEDGE_ATIVO
+from disjuntor_openai import disjuntor
+from metricas_prometheus import metricas
+from perfilador import perfil
 
 log = logging.getLogger("chamar_openai_com")
 
@@ -7,152 +21,400 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ASSISTANT_ID   = os.getenv("ASSISTANT_ID")          # ex.: asst_...
 FALLBACK_MODEL = os.getenv("FALLBACK_MODEL", "gpt-4o-mini")
 
-def _headers():
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY ausente.")
-    return {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-        "OpenAI-Beta": "assistants=v2",  # OBRIGATÓRIO p/ Threads/Runs
-    }
+# Reusa a thread da OpenAI por diálogo do Bitrix (contexto + 1 round trip a menos).
+THREAD_REUSO = os.getenv("THREAD_REUSO", "1") != "0"
+cache_threads = CacheThreads()
+# A thread pode ter ficado com um run ativo: a próxima mensagem do diálogo começa noutra
+STATUS_RUN_PENDURADO = ("timeout", "stream_interrompido")
+# Histórico curto por diálogo: o fallback responde com contexto (ver memoria_conversa.py)
+memoria = MemoriaConversa()
 
-def _headers_no_beta():
-    # para Chat Completions (não usa o Beta header)
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY ausente.")
+# Hedge: run lento demais -> fallback em paralelo, vence quem responder primeiro (ver hedge_fallback.py)
+limiar_hedge = LimiarAdaptativo()
+HEDGE_THREADS = int(os.getenv("HEDGE_THREADS", str(2 * FILA_WORKERS + 2)))
+_pool_hedge = None
+_pool_hedge_pid = None
+
+MSG_ERRO_IA = "❗Erro ao processar com a IA. Tente novamente."
+MSG_IA_OCUPADA = "⚠️ A IA está com muitas solicitações agora. Por favor, tente novamente em instantes."
+# Respostas do fallback que não vencem o hedge (None: cancelado porque o run já venceu)
+_FALLBACK_SEM_RESPOSTA = (MSG_ERRO_IA, MSG_IA_OCUPADA, None)
+
+def _corpo_fallback(user_text: str, historico: list = ()) -> dict:
     return {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
+        "model": FALLBACK_MODEL,
+        "messages": [
+            {"role": "system", "content": "Você é a Ana Lis - Agente IA, assistente objetiva e cordial."},
+            *historico,
+            {"role": "user", "content": user_text}
+        ],
+        "temperature": 0.4,
+        "max_tokens": 500
     }
 
-def _fallback_completion(user_text: str) -> str:
-    """Se a Assistants API falhar, usa Chat Completions para responder."""
+def _fallback_completion(user_text: str, dialog_id: str = None, origem: str = "falha",
+                         cancelado: threading.Event = None) -> str:
+    """
+    Se a Assistants API falhar, usa Chat Completions para responder. `origem` (falha,
+    hedge, disjuntor) só rotula a métrica lis_fallback_total. Com `cancelado` marcado
+    (o run do hedge venceu) antes da chamada, não chama a OpenAI e devolve None.
+    """
+    t0 = time.perf_counter()
+    resposta = _fallback_completion_medido(user_text, dialog_id, cancelado)
+    _registrar_fallback(origem, resposta, t0)
+    return resposta
+
+def _registrar_fallback(origem: str, resposta: str, t0: float):
+    metricas.etapa("fallback", time.perf_counter() - t0)
+    resultado = {MSG_ERRO_IA: "erro", MSG_IA_OCUPADA: "sem_vaga", None: "cancelado"}.get(resposta, "ok")
+    metricas.contar("lis_fallback_total", origem=origem, resultado=resultado)
+
+def _fallback_completion_medido(user_text: str, dialog_id: str = None, cancelado: threading.Event = None) -> str:
+    if cancelado is not None and cancelado.is_set():
+        return None
+    if not disjuntor.permitir("chat"):
+        log.warning("Disjuntor do chat completions aberto; fallback indisponível.")
+        return MSG_ERRO_IA
+    historico = memoria.mensagens(dialog_id)
+    tokens = estimar_tokens(user_text) + sum(estimar_tokens(m["content"], 0) for m in historico)
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=_headers_no_beta(),
-            json={
-                "model": FALLBACK_MODEL,
-                "messages": [
-                    {"role": "system", "content": "Você é a Ana Lis - Agente IA, assistente objetiva e cordial."},
-                    {"role": "user", "content": user_text}
-                ],
-                "temperature": 0.4,
-                "max_tokens": 500
-            },
-            timeout=20
-        )
-        r.raise_for_status()
+        with limitador.vaga(dialog_id, tokens), disjuntor.medir("chat"):
+            if cancelado is not None and cancelado.is_set():
+                return None   # a vaga saiu depois que o run venceu
+            r = sessao_openai().post(
+                f"{cliente_assistants.OPENAI_BASE_URL}/chat/completions",
+                headers=cliente_assistants._headers_no_beta(),
+                json=_corpo_fallback(user_text, historico),
+                timeout=timeout(20)
+            )
+            r.raise_for_status()
         data = r.json()
+        limitador.devolver_tokens(tokens, (data.get("usage") or {}).get("total_tokens"))
         txt = data["choices"][0]["message"]["content"].strip()
         return txt
+    except LimiteExcedido as e:
+        log.warning(f"Fallback sem vaga: {e}")
+        return MSG_IA_OCUPADA
     except requests.exceptions.RequestException as e:
-        detail = ""
-        if getattr(e, "response", None) is not None:
-            try:
-                detail = f" | OpenAI {e.response.status_code}: {e.response.text[:400]}"
-            except Exception:
-                detail = f" | OpenAI {e.response.status_code}"
-        log.error(f"Fallback (chat completions) falhou: {e}{detail}")
-        return "❗Erro ao processar com a IA. Tente novamente."
+        log.error(f"Fallback (chat completions) falhou: {e}{descrever_erro_http(e)}")
+        return MSG_ERRO_IA
+
+def _thread_inutilizavel(e, thread_id) -> bool:
+    """HTTP 400/404 ao rodar numa thread reaproveitada: apagada ou com run ativo preso."""
+    resp = getattr(e, "response", None)
+    return bool(thread_id) and resp is not None and resp.status_code in (400, 404)
+
+def _usa_thread_do_dialogo(dialog_id) -> bool:
+    return bool(THREAD_REUSO and dialog_id)
 
-def chamar_openai_com(user_text: str, timeout_s: int = 25) -> str:
+def _travar_dialogo(dialog_id):
+    """Lock do diálogo (uma thread aceita um run ativo por vez); nada a travar sem reuso de thread."""
+    return cache_threads.travar(dialog_id) if _usa_thread_do_dialogo(dialog_id) else nullcontext()
+
+def _travar_dialogo_async(dialog_id):
+    return cache_threads.travar_async(dialog_id) if _usa_thread_do_dialogo(dialog_id) else nullcontext()
+
+def _executar_no_dialogo(user_text: str, dialog_id, timeout_s: int, controle: ControleRun = None,
+                         ao_texto=None) -> str:
+    """
+    Roda o assistant na thread do diálogo (se houver); chamado já sob o lock do diálogo.
+    Se a thread em cache não serve mais (apagada, run ativo preso), recomeça numa nova.
+    """
+    if not _usa_thread_do_dialogo(dialog_id):
+        return executar_run(user_text, assistant_id=ASSISTANT_ID, timeout_s=timeout_s, controle=controle,
+                            ao_texto=ao_texto).texto
+
+    thread_id = cache_threads.obter(dialog_id)
+    try:
+        res = executar_run(user_text, thread_id=thread_id, assistant_id=ASSISTANT_ID, timeout_s=timeout_s,
+                           controle=controle, ao_texto=ao_texto)
+    except requests.exceptions.HTTPError as e:
+        if not _thread_inutilizavel(e, thread_id):
+            raise
+        log.warning(f"Thread {thread_id} do diálogo {dialog_id} inutilizável "
+                    f"({e.response.status_code}); criando outra.")
+        cache_threads.remover(dialog_id)
+        res = executar_run(user_text, assistant_id=ASSISTANT_ID, timeout_s=timeout_s, controle=controle,
+                           ao_texto=ao_texto)
+    except ErroRun as e:
+        # run pendurado (timeout, stream cortado) ou falho: a thread pode ter ficado com run ativo
+        if e.status in STATUS_RUN_PENDURADO:
+            cache_threads.remover(dialog_id)
+        raise
+    cache_threads.guardar(dialog_id, res.thread_id)
+    return res.texto
+
+def _erro_de_configuracao():
     if not OPENAI_API_KEY:
         log.error("OPENAI_API_KEY ausente.")
         return "⚠️ Configuração da IA ausente (OPENAI_API_KEY)."
     if not ASSISTANT_ID:
         log.error("ASSISTANT_ID ausente.")
         return "⚠️ Configuração da IA ausente (ASSISTANT_ID)."
+    return None
+
+def _logar_erro_run(e: ErroRun):
+    if e.status == "timeout":
+        log.warning(f"Timeout aguardando run {e.run_id}; usando fallback.")
+    elif e.status == "sem_conteudo":
+        log.error("Não encontrei conteúdo de resposta do assistant.")
+    elif e.status == "requires_action":
+        # Seu assistant tem ferramentas externas definidas (function calling)
+        # e está aguardando "tool outputs". Como não tratamos aqui,
+        # registra e cai no fallback para não travar.
+        log.error(f"Run requer ação externa (tool outputs). run={e.run_id} obj={e.run_obj}")
+    else:
+        # failed / cancelled / expired / incomplete → logar motivo e fallback
+        log.error(f"Run não completou: status={e.status} run={e.run_id} last_error={e.last_error}")
+
+def _run_com_vaga(user_text: str, dialog_id, timeout_s: int, controle: ControleRun = None, ao_texto=None,
+                  concluido: threading.Event = None) -> str:
+    # Primeiro o lock do diálogo, depois a vaga: a 2ª mensagem de um diálogo ocupado espera
+    # sem segurar uma vaga. A vaga é liberada antes do fallback, que disputa a sua própria.
+    with _travar_dialogo(dialog_id):
+        with limitador.vaga(dialog_id, estimar_tokens(user_text, OPENAI_TOKENS_RUN)), disjuntor.medir("runs"):
+            texto = _executar_no_dialogo(user_text, dialog_id, timeout_s, controle, ao_texto)
+            if concluido is not None:
+                concluido.set()   # ainda com a vaga: o fallback do hedge que a espera não chega a chamar a OpenAI
+            return texto
 
+def _resposta_apos_falha(e: Exception, user_text: str, dialog_id) -> str:
+    """Sem vaga: avisa o usuário. Run falho ou erro HTTP: cai no fallback."""
+    if isinstance(e, LimiteExcedido):
+        log.warning(f"Sem vaga para o assistant: {e}")
+        return MSG_IA_OCUPADA
+    if isinstance(e, ErroRun):
+        _logar_erro_run(e)
+    else:
+        log.error(f"Erro ao chamar OpenAI: {e}{descrever_erro_http(e)}")
+    return _fallback_completion(user_text, dialog_id)
+
+def _executor_hedge() -> ThreadPoolExecutor:
+    global _pool_hedge, _pool_hedge_pid
+    if _pool_hedge is None or _pool_hedge_pid != os.getpid():
+        _pool_hedge = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix="hedge")
+        _pool_hedge_pid = os.getpid()
+    return _pool_hedge
+
+def _chamar_com_hedge(user_text: str, dialog_id, timeout_s: int, ao_texto=None) -> str:
+    """
+    Roda o assistant e, se ele passar do limiar adaptativo, dispara o fallback em
+    paralelo. A primeira resposta válida vence; o run perdedor é cancelado na OpenAI.
+    """
+    limiar = limiar_hedge.valor()
+    controle = ControleRun()
+    t0 = time.time()
+    cancelar_fallback = threading.Event()   # o run venceu: o fallback não chama a OpenAI
+    # copy_context: os logs das threads do hedge levam o id do evento
+    run = _executor_hedge().submit(contextvars.copy_context().run, perfil.envolver(_run_com_vaga, "hedge_run"),
+                                   user_text, dialog_id, timeout_s, controle, ao_texto, cancelar_fallback)
     try:
-        # 1) Cria thread
-        r = requests.post("https://api.openai.com/v1/threads", headers=_headers(), json={}, timeout=15)
-        r.raise_for_status()
-        thread_id = r.json()["id"]
-
-        # 2) Mensagem do usuário
-        r = requests.post(
-            f"https://api.openai.com/v1/threads/{thread_id}/messages",
-            headers=_headers(),
-            json={"role": "user", "content": user_text},
-            timeout=15
-        )
-        r.raise_for_status()
-
-        # 3) Run
-        r = requests.post(
-            f"https://api.openai.com/v1/threads/{thread_id}/runs",
-            headers=_headers(),
-            json={"assistant_id": ASSISTANT_ID},
-            timeout=15
-        )
-        r.raise_for_status()
-        run_id = r.json()["id"]
-
-        # 4) Poll
-        t0 = time.time()
-        status = None
-        while True:
-            rr = requests.get(
-                f"https://api.openai.com/v1/threads/{thread_id}/runs/{run_id}",
-                headers=_headers(),
-                timeout=15
-            )
-            rr.raise_for_status()
-            run_obj = rr.json()
-            status = run_obj.get("status")
-            if status in ("completed", "failed", "cancelled", "expired", "requires_action"):
-                break
-            if time.time() - t0 > timeout_s:
-                log.warning(f"Timeout aguardando run {run_id} (status atual: {status})")
-                # Usa fallback para ainda responder o usuário
-                return _fallback_completion(user_text)
-            time.sleep(0.7)
-
-        # 5) Trata terminais
-        if status == "completed":
-            # Busca mensagens
-            mm = requests.get(
-                f"https://api.openai.com/v1/threads/{thread_id}/messages",
-                headers=_headers(),
-                params={"limit": 10},
-                timeout=15
-            )
-            mm.raise_for_status()
-            for m in mm.json().get("data", []):
-                if m.get("role") == "assistant":
-                    parts = []
-                    for c in m.get("content", []):
-                        if c.get("type") == "text":
-                            parts.append(c["text"]["value"])
-                    if parts:
-                        return "\n".join(parts).strip()
-            log.error("Não encontrei conteúdo de resposta do assistant.")
-            return _fallback_completion(user_text)
-
-        elif status == "requires_action":
-            # Seu assistant tem ferramentas externas definidas (function calling)
-            # e está aguardando "tool outputs". Como não tratamos aqui,
-            # registra e cai no fallback para não travar.
-            log.error(f"Run requer ação externa (tool outputs). run={run_id} obj={run_obj}")
-            return _fallback_completion(user_text)
-
-        else:
-            # failed / cancelled / expired → logar motivo e fallback
-            last_err = None
-            try:
-                last_err = run_obj.get("last_error")  # {'code': '...', 'message': '...'}
-            except Exception:
-                pass
-            log.error(f"Run não completou: status={status} run={run_id} last_error={last_err}")
-            return _fallback_completion(user_text)
+        texto = run.result(timeout=limiar)
+        limiar_hedge.registrar(time.time() - t0)
+        return texto
+    except FuturesTimeout:
+        pass
+    except (LimiteExcedido, ErroRun, requests.exceptions.RequestException) as e:
+        return _resposta_apos_falha(e, user_text, dialog_id)
 
-    except requests.exceptions.RequestException as e:
-        detail = ""
-        if getattr(e, "response", None) is not None:
+    limiar_hedge.contar("disparos")
+    log.info(f"⏱️ Hedge: run passou de {limiar:.1f}s ({limiar_hedge.descricao()}); "
+             f"disparando o fallback em paralelo.")
+    fallback = _executor_hedge().submit(contextvars.copy_context().run,
+                                        perfil.envolver(_fallback_completion, "hedge_fallback"),
+                                        user_text, dialog_id, "hedge", cancelar_fallback)
+    pendentes = {run, fallback}
+    while pendentes:
+        prontos, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+        if run in prontos and run.exception() is None:
+            cancelar_fallback.set()
+            limiar_hedge.registrar(time.time() - t0)
+            limiar_hedge.contar("vitorias_run")
+            log.info(f"🏁 Hedge: run venceu em {time.time() - t0:.1f}s; fallback cancelado.")
+            return run.result()
+        if fallback in prontos and fallback.result() not in _FALLBACK_SEM_RESPOSTA:
+            controle.cancelar()
+            limiar_hedge.registrar(time.time() - t0)
+            limiar_hedge.contar("vitorias_fallback")
+            log.info(f"🏁 Hedge: fallback venceu em {time.time() - t0:.1f}s; cancelando o run {controle.run_id}.")
+            return fallback.result()
+
+    limiar_hedge.contar("ambos_falharam")
+    log.error(f"Hedge: run e fallback falharam (run: {run.exception()!r}).")
+    return fallback.result() or MSG_ERRO_IA
+
+def chamar_openai_com(user_text: str, timeout_s: int = 25, dialog_id: str = None, ao_texto=None) -> str:
+    """
+    Resposta do assistant para `user_text` (ou do fallback, se ele falhar). `ao_texto`
+    recebe o texto parcial enquanto o run gera a resposta (ver entrega_progressiva.py).
+    """
+    erro = _erro_de_configuracao()
+    if erro:
+        return erro
+    resposta = _responder(user_text, timeout_s, dialog_id, ao_texto)
+    _lembrar(dialog_id, user_text, resposta)
+    return resposta
+
+def _lembrar(dialog_id, user_text: str, resposta: str):
+    """Toda troca respondida (assistant ou fallback) entra na memória do diálogo."""
+    if resposta not in (MSG_ERRO_IA, MSG_IA_OCUPADA):
+        memoria.registrar(dialog_id, user_text, resposta)
+
+def _responder(user_text: str, timeout_s: int, dialog_id, ao_texto) -> str:
+    if not disjuntor.permitir("runs"):
+        # Assistants API degradada: não paga thread + run + polling até o timeout
+        log.warning("Disjuntor da Assistants API aberto; indo direto ao fallback.")
+        return _fallback_completion(user_text, dialog_id, "disjuntor")
+
+    if HEDGE_ATIVO:
+        return _chamar_com_hedge(user_text, dialog_id, timeout_s, ao_texto)
+
+    try:
+        # Mensagem + run numa chamada só (stream ou polling), na thread do diálogo
+        return _run_com_vaga(user_text, dialog_id, timeout_s, ao_texto=ao_texto)
+    except (LimiteExcedido, ErroRun, requests.exceptions.RequestException) as e:
+        return _resposta_apos_falha(e, user_text, dialog_id)
+
+# =========================
+# Versões async (app_async.py)
+# =========================
+async def _fallback_completion_async(user_text: str, dialog_id: str = None, origem: str = "falha") -> str:
+    t0 = time.perf_counter()
+    resposta = await _fallback_completion_medido_async(user_text, dialog_id)
+    _registrar_fallback(origem, resposta, t0)
+    return resposta
+
+async def _fallback_completion_medido_async(user_text: str, dialog_id: str = None) -> str:
+    import httpx
+    if not disjuntor.permitir("chat"):
+        log.warning("Disjuntor do chat completions aberto; fallback indisponível.")
+        return MSG_ERRO_IA
+    historico = await fora_do_loop(memoria, memoria.mensagens, dialog_id)
+    tokens = estimar_tokens(user_text) + sum(estimar_tokens(m["content"], 0) for m in historico)
+    try:
+        async with limitador.vaga_async(dialog_id, tokens):
+            with disjuntor.medir("chat"):
+                r = await cliente_async("openai").post(
+                    f"{cliente_assistants.OPENAI_BASE_URL}/chat/completions",
+                    headers=cliente_assistants._headers_no_beta(),
+                    json=_corpo_fallback(user_text, historico),
+                    timeout=timeout_async(20)
+                )
+                r.raise_for_status()
+        data = r.json()
+        limitador.devolver_tokens(tokens, (data.get("usage") or {}).get("total_tokens"))
+        return data["choices"][0]["message"]["content"].strip()
+    except LimiteExcedido as e:
+        log.warning(f"Fallback sem vaga: {e}")
+        return MSG_IA_OCUPADA
+    except httpx.HTTPError as e:
+        log.error(f"Fallback (chat completions) falhou: {e}{descrever_erro_http(e)}")
+        return MSG_ERRO_IA
+
+async def _executar_no_dialogo_async(user_text: str, dialog_id, timeout_s: int, ao_texto=None) -> str:
+    import httpx
+    if not _usa_thread_do_dialogo(dialog_id):
+        return (await executar_run_async(user_text, assistant_id=ASSISTANT_ID, timeout_s=timeout_s,
+                                         ao_texto=ao_texto)).texto
+
+    thread_id = await fora_do_loop(cache_threads, cache_threads.obter, dialog_id)
+    try:
+        res = await executar_run_async(user_text, thread_id=thread_id, assistant_id=ASSISTANT_ID,
+                                       timeout_s=timeout_s, ao_texto=ao_texto)
+    except httpx.HTTPStatusError as e:
+        if not _thread_inutilizavel(e, thread_id):
+            raise
+        log.warning(f"Thread {thread_id} do diálogo {dialog_id} inutilizável "
+                    f"({e.response.status_code}); criando outra.")
+        await fora_do_loop(cache_threads, cache_threads.remover, dialog_id)
+        res = await executar_run_async(user_text, assistant_id=ASSISTANT_ID, timeout_s=timeout_s,
+                                       ao_texto=ao_texto)
+    except ErroRun as e:
+        if e.status in STATUS_RUN_PENDURADO:
+            await fora_do_loop(cache_threads, cache_threads.remover, dialog_id)
+        raise
+    await fora_do_loop(cache_threads, cache_threads.guardar, dialog_id, res.thread_id)
+    return res.texto
+
+async def _run_com_vaga_async(user_text: str, dialog_id, timeout_s: int, ao_texto=None) -> str:
+    async with _travar_dialogo_async(dialog_id):
+        async with limitador.vaga_async(dialog_id, estimar_tokens(user_text, OPENAI_TOKENS_RUN)):
+            with disjuntor.medir("runs"):
+                return await _executar_no_dialogo_async(user_text, dialog_id, timeout_s, ao_texto)
+
+async def _resposta_apos_falha_async(e: Exception, user_text: str, dialog_id) -> str:
+    if isinstance(e, LimiteExcedido):
+        log.warning(f"Sem vaga para o assistant: {e}")
+        return MSG_IA_OCUPADA
+    if isinstance(e, ErroRun):
+        _logar_erro_run(e)
+    else:
+        log.error(f"Erro ao chamar OpenAI: {e}{descrever_erro_http(e)}")
+    return await _fallback_completion_async(user_text, dialog_id)
+
+async def _chamar_com_hedge_async(user_text: str, dialog_id, timeout_s: int, ao_texto=None) -> str:
+    """_chamar_com_hedge com tarefas: a perdedora é cancelada (o run, também na OpenAI)."""
+    import httpx
+    limiar = limiar_hedge.valor()
+    t0 = time.time()
+    run = asyncio.create_task(_run_com_vaga_async(user_text, dialog_id, timeout_s, ao_texto))
+    fallback = None
+    try:
+        prontos, _ = await asyncio.wait({run}, timeout=limiar)
+        if prontos:
             try:
-                detail = f" | OpenAI {e.response.status_code}: {e.response.text[:400]}"
-            except Exception:
-                detail = f" | OpenAI {e.response.status_code}"
-        log.error(f"Erro ao chamar OpenAI: {e}{detail}")
-        return _fallback_completion(user_text)
+                texto = run.result()
+            except (LimiteExcedido, ErroRun, httpx.HTTPError) as e:
+                return await _resposta_apos_falha_async(e, user_text, dialog_id)
+            limiar_hedge.registrar(time.time() - t0)
+            return texto
+
+        limiar_hedge.contar("disparos")
+        log.info(f"⏱️ Hedge: run passou de {limiar:.1f}s ({limiar_hedge.descricao()}); "
+                 f"disparando o fallback em paralelo.")
+        fallback = asyncio.create_task(_fallback_completion_async(user_text, dialog_id, "hedge"))
+        pendentes = {run, fallback}
+        while pendentes:
+            prontos, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+            if run in prontos and run.exception() is None:
+                limiar_hedge.registrar(time.time() - t0)
+                limiar_hedge.contar("vitorias_run")
+                log.info(f"🏁 Hedge: run venceu em {time.time() - t0:.1f}s; fallback cancelado.")
+                return run.result()
+            if fallback in prontos and fallback.result() not in _FALLBACK_SEM_RESPOSTA:
+                limiar_hedge.registrar(time.time() - t0)
+                limiar_hedge.contar("vitorias_fallback")
+                log.info(f"🏁 Hedge: fallback venceu em {time.time() - t0:.1f}s; cancelando o run.")
+                return fallback.result()
+
+        limiar_hedge.contar("ambos_falharam")
+        log.error(f"Hedge: run e fallback falharam (run: {run.exception()!r}).")
+        return fallback.result()
+    finally:
+        for tarefa in (run, fallback):
+            if tarefa is not None and not tarefa.done():
+                tarefa.cancel()
+
+async def chamar_openai_com_async(user_text: str, timeout_s: int = 25, dialog_id: str = None,
+                                  ao_texto=None) -> str:
+    """Mesma lógica de chamar_openai_com, sem bloquear o event loop."""
+    erro = _erro_de_configuracao()
+    if erro:
+        return erro
+    resposta = await _responder_async(user_text, timeout_s, dialog_id, ao_texto)
+    await fora_do_loop(memoria, _lembrar, dialog_id, user_text, resposta)
+    return resposta
+
+async def _responder_async(user_text: str, timeout_s: int, dialog_id, ao_texto) -> str:
+    import httpx
+    if not disjuntor.permitir("runs"):
+        log.warning("Disjuntor da Assistants API aberto; indo direto ao fallback.")
+        return await _fallback_completion_async(user_text, dialog_id, "disjuntor")
+
+    if HEDGE_ATIVO:
+        return await _chamar_com_hedge_async(user_text, dialog_id, timeout_s, ao_texto)
+
+    try:
+        return await _run_com_vaga_async(user_text, dialog_id, timeout_s, ao_texto)
+    except (LimiteExcedido, ErroRun, httpx.HTTPError) as e:
+        return await _resposta_apos_falha_async(e, user_text, dialog_id)
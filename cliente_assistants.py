@@ -0,0 +1,531 @@
+# cliente_assistants.py
+"""
+Cliente único da Assistants API (v2), usado por chamar_openai_com e utils_assistant.
+
+Cada pergunta custa o mínimo de round trips:
+  - streaming: 1 chamada (POST /threads/runs com a mensagem inline e `stream: true`)
+  - polling:   POST /threads/runs + N GET do run + 1 GET de mensagens filtrado por run_id
+Com uma thread já existente (reuso por diálogo), a mensagem vai inline em
+POST /threads/{id}/runs via `additional_messages`.
+"""
+import os, time, json, asyncio, threading, requests, logging
+from dataclasses import dataclass
+
+from cliente_http import sessao_openai, timeout, cliente_async, timeout_async
+from metricas_prometheus import metricas
+
+log = logging.getLogger("cliente_assistants")
+
+OPENAI_API_KEY  = os.getenv("OPENAI_API_KEY")
+ASSISTANT_ID    = os.getenv("ASSISTANT_ID")          # ex.: asst_...
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+
+# Streaming do run (SSE): devolve o texto assim que o run termina, sem polling.
+# OPENAI_STREAMING=0 volta ao polling (que também é o fallback se o stream cair).
+OPENAI_STREAMING = os.getenv("OPENAI_STREAMING", "1") != "0"
+# Polling com backoff: começa curto (runs rápidos) e cresce até o teto.
+POLL_INTERVALO_INICIAL = float(os.getenv("POLL_INTERVALO_INICIAL", "0.15"))
+POLL_INTERVALO_MAX     = float(os.getenv("POLL_INTERVALO_MAX", "1.5"))
+POLL_FATOR             = 1.6
+
+STATUS_TERMINAIS = ("completed", "failed", "cancelled", "expired", "requires_action", "incomplete")
+
+
+@dataclass
+class ResultadoRun:
+    texto: str
+    thread_id: str
+    run_id: str
+
+
+class ErroRun(Exception):
+    """O run não produziu resposta utilizável (timeout, failed, requires_action, sem conteúdo...)."""
+
+    def __init__(self, status: str, run_id=None, run_obj=None):
+        self.status = status
+        self.run_id = run_id
+        self.run_obj = run_obj or {}
+        super().__init__(f"run {run_id} terminou com status={status}")
+
+    @property
+    def last_error(self):
+        return self.run_obj.get("last_error")  # {'code': '...', 'message': '...'}
+
+
+class ControleRun:
+    """
+    Deixa outro fluxo cancelar um run em andamento (ex.: o fallback em paralelo
+    respondeu primeiro). `cancelar()` pode vir antes de o run existir: quem chegar
+    por último entre `registrar` e `cancelar` envia o runs/{id}/cancel.
+    """
+
+    def __init__(self):
+        self.thread_id = None
+        self.run_id = None
+        self.cancelado = threading.Event()
+        self._lock = threading.Lock()
+        self._cancel_enviado = False
+
+    def registrar(self, run_obj: dict):
+        if self.run_id or not run_obj.get("id"):
+            return
+        with self._lock:
+            self.thread_id, self.run_id = run_obj.get("thread_id"), run_obj["id"]
+            enviar = self.cancelado.is_set() and not self._cancel_enviado
+            self._cancel_enviado |= enviar
+        if enviar:
+            cancelar_run(self.thread_id, self.run_id)
+
+    def cancelar(self):
+        """Marca o run como descartado e pede o cancelamento na OpenAI (em segundo plano)."""
+        with self._lock:
+            self.cancelado.set()
+            enviar = self.run_id is not None and not self._cancel_enviado
+            self._cancel_enviado |= enviar
+        if enviar:
+            threading.Thread(target=cancelar_run, args=(self.thread_id, self.run_id), daemon=True).start()
+
+def _headers():
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY ausente.")
+    return {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+        "OpenAI-Beta": "assistants=v2",  # OBRIGATÓRIO p/ Threads/Runs
+    }
+
+def _headers_no_beta():
+    # para Chat Completions (não usa o Beta header)
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY ausente.")
+    return {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+def descrever_erro_http(e) -> str:
+    """Sufixo com status/corpo da resposta da OpenAI, para log (requests ou httpx)."""
+    if getattr(e, "response", None) is None:
+        return ""
+    try:
+        return f" | OpenAI {e.response.status_code}: {e.response.text[:400]}"
+    except Exception:
+        return f" | OpenAI {e.response.status_code}"
+
+class _LeitorSSE:
+    """Monta eventos (evento, data) a partir das linhas de um text/event-stream."""
+
+    def __init__(self):
+        self.evento, self.dados = None, []
+
+    def linha(self, linha):
+        """Retorna (evento, data) quando uma linha em branco fecha o evento; senão None."""
+        if linha is None:
+            return None
+        if linha == "":
+            pronto = (self.evento, "\n".join(self.dados)) if (self.evento or self.dados) else None
+            self.evento, self.dados = None, []
+            return pronto
+        if linha.startswith("event:"):
+            self.evento = linha[6:].strip()
+        elif linha.startswith("data:"):
+            self.dados.append(linha[5:].lstrip())
+        return None
+
+    def fim(self):
+        return self.linha("")
+
+def _iter_sse(resp):
+    """Itera (evento, data) de uma resposta text/event-stream."""
+    leitor = _LeitorSSE()
+    for linha in resp.iter_lines(decode_unicode=True):
+        ev = leitor.linha(linha)
+        if ev:
+            yield ev
+    ev = leitor.fim()
+    if ev:
+        yield ev
+
+class _EstadoStream:
+    """
+    Interpreta os eventos do run (comum ao modo sync e async). Com `ao_texto`,
+    cada thread.message.delta chama `ao_texto(texto_acumulado)` (entrega progressiva).
+    """
+
+    def __init__(self, timeout_s: float, controle: ControleRun = None, ao_texto=None):
+        self.t0 = time.time()
+        self.timeout_s = timeout_s
+        self.controle = controle
+        self.ao_texto = ao_texto
+        self.run_obj = {}
+        self.criado_em = None   # primeiro evento do run: thread/run já existem na OpenAI
+        self.textos = []
+        self.pedacos = []   # deltas da mensagem em andamento
+
+    def processar(self, evento, dados):
+        """Retorna (status, run_obj, texto) quando o stream deve parar; senão None."""
+        if evento == "done" or dados == "[DONE]":
+            return None, self.run_obj, ""
+        if evento == "error":
+            raise RuntimeError(f"Erro no stream do run: {dados[:400]}")
+        if self.controle and self.controle.cancelado.is_set():
+            # o fallback do hedge venceu: para de ler (solta vaga e lock do diálogo); o
+            # ControleRun já pediu o runs/{id}/cancel
+            log.info(f"Run {self.run_obj.get('id')} descartado; encerrando o stream.")
+            return "cancelled", {**self.run_obj, "status": "cancelled"}, ""
+        if not (evento or "").startswith("thread."):
+            return None
+        obj = json.loads(dados)
+        # thread.run.step.* também começa com "thread.run." mas traz o step (id e status do step)
+        if evento.startswith("thread.run.") and not evento.startswith("thread.run.step."):
+            self.run_obj = obj
+            self.criado_em = self.criado_em or time.time()
+            if self.controle:
+                self.controle.registrar(obj)
+            if obj.get("status") in STATUS_TERMINAIS:
+                return obj["status"], obj, "\n".join(self.textos).strip()
+        elif evento == "thread.message.delta" and self.ao_texto:
+            for parte in (obj.get("delta") or {}).get("content") or []:
+                if parte.get("type") == "text":
+                    self.pedacos.append((parte.get("text") or {}).get("value") or "")
+            self._avisar()
+        elif evento == "thread.message.completed" and obj.get("role") == "assistant":
+            self.textos.append(texto_da_mensagem(obj))
+            self.pedacos = []
+        if time.time() - self.t0 > self.timeout_s:
+            log.warning(f"Timeout no stream do run {self.run_obj.get('id')}")
+            return "timeout", self.run_obj, ""
+        return None
+
+    def _avisar(self):
+        try:
+            self.ao_texto("\n".join(self.textos + ["".join(self.pedacos)]).strip())
+        except Exception:
+            log.exception("Callback de texto parcial falhou")
+
+def texto_da_mensagem(m: dict) -> str:
+    parts = []
+    for c in m.get("content", []) or []:
+        if c.get("type") == "text":
+            parts.append(c["text"]["value"])
+    return "\n".join(parts).strip()
+
+def _url_e_corpo_run(conteudo, thread_id, assistant_id, instructions, stream: bool):
+    mensagem = {"role": "user", "content": conteudo}
+    corpo = {"assistant_id": assistant_id or ASSISTANT_ID}
+    if thread_id:
+        url = f"{OPENAI_BASE_URL}/threads/{thread_id}/runs"
+        corpo["additional_messages"] = [mensagem]
+    else:
+        url = f"{OPENAI_BASE_URL}/threads/runs"
+        corpo["thread"] = {"messages": [mensagem]}
+    if instructions:
+        corpo["instructions"] = instructions
+    if stream:
+        corpo["stream"] = True
+    return url, corpo
+
+def _fim_do_stream(estado: "_EstadoStream", fim):
+    """
+    Resultado do stream (comum ao sync e async). Sem nenhum thread.run.* a API já pode ter
+    criado o run: levanta ErroRun em vez de deixar o chamador fazer um 2º POST (run duplicado).
+    """
+    status, run_obj, texto = fim or (None, estado.run_obj, "")
+    if not run_obj.get("id"):
+        raise ErroRun(status or "stream_interrompido")
+    return status, run_obj, texto, estado.criado_em
+
+def _run_via_stream(url: str, corpo: dict, timeout_s: float, controle: ControleRun = None, ao_texto=None):
+    """
+    Cria o run (e a thread, se nova) com `stream: true` e consome os eventos até um status terminal.
+    Retorna (status, run_obj, texto, criado_em). Se o stream cair depois de o run existir,
+    devolve status=None com o run_obj para o chamador continuar por polling.
+    Só um erro de conexão antes da resposta (o POST não chegou) sai como ConnectionError:
+    aí o chamador pode criar o run sem stream.
+    """
+    estado = _EstadoStream(timeout_s, controle, ao_texto)
+    r = None
+    fim = None
+    try:
+        with sessao_openai().post(
+            url,
+            headers=_headers(),
+            json=corpo,
+            stream=True,
+            timeout=timeout(timeout_s)
+        ) as r:
+            r.raise_for_status()
+            for evento, dados in _iter_sse(r):
+                fim = estado.processar(evento, dados)
+                if fim:
+                    break
+    except requests.exceptions.HTTPError:
+        raise
+    except (requests.exceptions.RequestException, ValueError, RuntimeError) as e:
+        if r is None and isinstance(e, requests.exceptions.ConnectionError):
+            raise
+        if not estado.run_obj.get("id"):
+            log.warning(f"Stream do run interrompido antes do primeiro evento do run ({e}).")
+            raise ErroRun("stream_interrompido") from e
+        log.warning(f"Stream do run {estado.run_obj['id']} interrompido ({e}); seguindo por polling.")
+    return _fim_do_stream(estado, fim)
+
+def _aguardar_run(thread_id: str, run_id: str, timeout_s: float, controle: ControleRun = None):
+    """Polling com backoff adaptativo até status terminal. Retorna (status, run_obj)."""
+    t0 = time.time()
+    intervalo = POLL_INTERVALO_INICIAL
+    polls = 0
+    while True:
+        if controle and controle.cancelado.is_set():
+            metricas.observar("lis_run_polls", polls)
+            return "cancelled", {"id": run_id, "thread_id": thread_id, "status": "cancelled"}
+        polls += 1
+        rr = sessao_openai().get(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/runs/{run_id}",
+            headers=_headers(),
+            timeout=timeout(15)
+        )
+        rr.raise_for_status()
+        run_obj = rr.json()
+        status = run_obj.get("status")
+        if status in STATUS_TERMINAIS:
+            metricas.observar("lis_run_polls", polls)
+            return status, run_obj
+        restante = timeout_s - (time.time() - t0)
+        if restante <= 0:
+            log.warning(f"Timeout aguardando run {run_id} (status atual: {status})")
+            metricas.observar("lis_run_polls", polls)
+            return "timeout", run_obj
+        if controle:
+            controle.cancelado.wait(min(intervalo, restante))
+        else:
+            time.sleep(min(intervalo, restante))
+        intervalo = min(intervalo * POLL_FATOR, POLL_INTERVALO_MAX)
+
+def _texto_do_run(thread_id: str, run_id: str) -> str:
+    """Uma única listagem, filtrada pelo run, só com as mensagens que ele gerou."""
+    with metricas.medir("mensagens_busca"):
+        mm = sessao_openai().get(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/messages",
+            headers=_headers(),
+            params={"run_id": run_id, "order": "desc", "limit": 5},
+            timeout=timeout(15)
+        )
+        mm.raise_for_status()
+    for m in mm.json().get("data", []):
+        if m.get("role") == "assistant":
+            texto = texto_da_mensagem(m)
+            if texto:
+                return texto
+    return ""
+
+def _registrar_run(thread_nova: bool, t0: float, criado_em: float, status: str, via_stream: bool):
+    """Métricas do run: criação (thread + run ou só run), tempo até o status terminal, polls e status."""
+    metricas.etapa("thread_run_criacao" if thread_nova else "run_criacao", (criado_em or time.time()) - t0)
+    metricas.etapa("run_conclusao", time.time() - t0)
+    if via_stream:
+        metricas.observar("lis_run_polls", 0)
+    metricas.contar("lis_run_status_total", status=status)
+
+def cancelar_run(thread_id: str, run_id: str):
+    """Cancela um run que estourou o orçamento (best effort: só loga se falhar)."""
+    try:
+        r = sessao_openai().post(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/runs/{run_id}/cancel",
+            headers=_headers(),
+            timeout=timeout(5)
+        )
+        r.raise_for_status()
+        log.info(f"Run {run_id} cancelado.")
+    except requests.exceptions.RequestException as e:
+        log.warning(f"Falha ao cancelar run {run_id}: {e}{descrever_erro_http(e)}")
+
+def executar_run(conteudo, thread_id=None, assistant_id=None, instructions=None,
+                 timeout_s: float = 25, stream=None, controle: ControleRun = None, ao_texto=None) -> ResultadoRun:
+    """
+    Executa o assistant sobre `conteudo` (texto ou lista de partes), na thread
+    `thread_id` ou numa thread nova. Levanta ErroRun se o run não completar com
+    texto, ou requests.RequestException em erro HTTP (ex.: 404 se a thread sumiu,
+    400 se ela ainda tem um run ativo).
+    Um run que passa de `timeout_s` é cancelado na OpenAI antes do ErroRun("timeout").
+    Se o stream cair (ou estourar o tempo) antes de trazer o run, ErroRun("stream_interrompido")
+    / ErroRun("timeout"): o POST pode ter criado o run, então não há um segundo POST.
+    Com `controle`, outro fluxo pode cancelar o run (ErroRun("cancelled")).
+    `ao_texto(texto_acumulado)` recebe o texto parcial a cada delta (só com streaming).
+    """
+    stream = OPENAI_STREAMING if stream is None else stream
+    t0 = time.time()
+    status, run_obj, texto, criado_em = None, {}, "", None
+    thread_nova = not thread_id
+
+    if stream:
+        url, corpo = _url_e_corpo_run(conteudo, thread_id, assistant_id, instructions, True)
+        try:
+            status, run_obj, texto, criado_em = _run_via_stream(url, corpo, timeout_s, controle, ao_texto)
+        except requests.exceptions.ConnectionError as e:
+            # só erro de conexão: o POST não chegou à API, criar o run sem stream não duplica nada
+            log.warning(f"Streaming indisponível ({e}); usando polling.")
+    if not run_obj.get("id"):
+        url, corpo = _url_e_corpo_run(conteudo, thread_id, assistant_id, instructions, False)
+        r = sessao_openai().post(url, headers=_headers(), json=corpo, timeout=timeout(15))
+        r.raise_for_status()
+        run_obj = r.json()
+        criado_em = time.time()
+    run_id, thread_id = run_obj["id"], run_obj["thread_id"]
+    if controle:
+        controle.registrar(run_obj)
+
+    via_stream = status is not None
+    if status is None:
+        status, run_obj = _aguardar_run(thread_id, run_id, timeout_s - (time.time() - t0), controle)
+    _registrar_run(thread_nova, t0, criado_em, status, via_stream)
+    if status == "timeout":
+        cancelar_run(thread_id, run_id)
+    if status != "completed":
+        raise ErroRun(status, run_id, run_obj)
+
+    texto = texto or _texto_do_run(thread_id, run_id)
+    if not texto:
+        raise ErroRun("sem_conteudo", run_id, run_obj)
+    return ResultadoRun(texto, thread_id, run_id)
+
+
+# =========================
+# Versões async (app_async.py), sobre httpx.AsyncClient
+# =========================
+async def _run_via_stream_async(url: str, corpo: dict, timeout_s: float, controle: ControleRun = None,
+                                ao_texto=None):
+    import httpx
+    estado = _EstadoStream(timeout_s, controle, ao_texto)
+    leitor = _LeitorSSE()
+    respondeu = False
+    fim = None
+    try:
+        async with cliente_async("openai").stream(
+            "POST", url, headers=_headers(), json=corpo, timeout=timeout_async(timeout_s)
+        ) as r:
+            respondeu = True
+            if r.is_error:
+                await r.aread()
+                r.raise_for_status()
+            async for linha in r.aiter_lines():
+                ev = leitor.linha(linha)
+                fim = estado.processar(*ev) if ev else None
+                if fim:
+                    break
+    except httpx.HTTPStatusError:
+        raise
+    except (httpx.HTTPError, ValueError, RuntimeError) as e:
+        if not respondeu and isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+            raise
+        if not estado.run_obj.get("id"):
+            log.warning(f"Stream do run interrompido antes do primeiro evento do run ({e}).")
+            raise ErroRun("stream_interrompido") from e
+        log.warning(f"Stream do run {estado.run_obj['id']} interrompido ({e}); seguindo por polling.")
+    return _fim_do_stream(estado, fim)
+
+async def _aguardar_run_async(thread_id: str, run_id: str, timeout_s: float):
+    t0 = time.time()
+    intervalo = POLL_INTERVALO_INICIAL
+    polls = 0
+    while True:
+        polls += 1
+        rr = await cliente_async("openai").get(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/runs/{run_id}",
+            headers=_headers(),
+            timeout=timeout_async(15)
+        )
+        rr.raise_for_status()
+        run_obj = rr.json()
+        status = run_obj.get("status")
+        if status in STATUS_TERMINAIS:
+            metricas.observar("lis_run_polls", polls)
+            return status, run_obj
+        restante = timeout_s - (time.time() - t0)
+        if restante <= 0:
+            log.warning(f"Timeout aguardando run {run_id} (status atual: {status})")
+            metricas.observar("lis_run_polls", polls)
+            return "timeout", run_obj
+        await asyncio.sleep(min(intervalo, restante))
+        intervalo = min(intervalo * POLL_FATOR, POLL_INTERVALO_MAX)
+
+async def _texto_do_run_async(thread_id: str, run_id: str) -> str:
+    with metricas.medir("mensagens_busca"):
+        mm = await cliente_async("openai").get(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/messages",
+            headers=_headers(),
+            params={"run_id": run_id, "order": "desc", "limit": 5},
+            timeout=timeout_async(15)
+        )
+        mm.raise_for_status()
+    for m in mm.json().get("data", []):
+        if m.get("role") == "assistant":
+            texto = texto_da_mensagem(m)
+            if texto:
+                return texto
+    return ""
+
+async def cancelar_run_async(thread_id: str, run_id: str):
+    import httpx
+    try:
+        r = await cliente_async("openai").post(
+            f"{OPENAI_BASE_URL}/threads/{thread_id}/runs/{run_id}/cancel",
+            headers=_headers(),
+            timeout=timeout_async(5)
+        )
+        r.raise_for_status()
+        log.info(f"Run {run_id} cancelado.")
+    except httpx.HTTPError as e:
+        log.warning(f"Falha ao cancelar run {run_id}: {e}{descrever_erro_http(e)}")
+
+async def executar_run_async(conteudo, thread_id=None, assistant_id=None, instructions=None,
+                             timeout_s: float = 25, stream=None, ao_texto=None) -> ResultadoRun:
+    """
+    Igual a executar_run, sem bloquear o event loop. Erros HTTP vêm como httpx.HTTPError.
+    Se a tarefa for cancelada (ex.: o fallback em paralelo venceu), o run é cancelado na OpenAI.
+    """
+    controle = ControleRun()   # só guarda os ids para o cancelamento
+    try:
+        return await _executar_run_async(conteudo, thread_id, assistant_id, instructions, timeout_s, stream,
+                                         controle, ao_texto)
+    except asyncio.CancelledError:
+        if controle.run_id:
+            await asyncio.shield(cancelar_run_async(controle.thread_id, controle.run_id))
+        raise
+
+async def _executar_run_async(conteudo, thread_id, assistant_id, instructions, timeout_s, stream,
+                              controle: ControleRun, ao_texto=None) -> ResultadoRun:
+    import httpx
+    stream = OPENAI_STREAMING if stream is None else stream
+    t0 = time.time()
+    status, run_obj, texto, criado_em = None, {}, "", None
+    thread_nova = not thread_id
+
+    if stream:
+        url, corpo = _url_e_corpo_run(conteudo, thread_id, assistant_id, instructions, True)
+        try:
+            status, run_obj, texto, criado_em = await _run_via_stream_async(url, corpo, timeout_s, controle, ao_texto)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            log.warning(f"Streaming indisponível ({e}); usando polling.")
+    if not run_obj.get("id"):
+        url, corpo = _url_e_corpo_run(conteudo, thread_id, assistant_id, instructions, False)
+        r = await cliente_async("openai").post(url, headers=_headers(), json=corpo, timeout=timeout_async(15))
+        r.raise_for_status()
+        run_obj = r.json()
+        criado_em = time.time()
+    run_id, thread_id = run_obj["id"], run_obj["thread_id"]
+    controle.registrar(run_obj)
+
+    via_stream = status is not None
+    if status is None:
+        status, run_obj = await _aguardar_run_async(thread_id, run_id, timeout_s - (time.time() - t0))
+    _registrar_run(thread_nova, t0, criado_em, status, via_stream)
+    if status == "timeout":
+        await cancelar_run_async(thread_id, run_id)
+    if status != "completed":
+        raise ErroRun(status, run_id, run_obj)
+
+    texto = texto or await _texto_do_run_async(thread_id, run_id)
+    if not texto:
+        raise ErroRun("sem_conteudo", run_id, run_obj)
+    return ResultadoRun(texto, thread_id, run_id)
@@ -0,0 +1,158 @@
+# cliente_http.py
+"""
+Sessões HTTP compartilhadas (keep-alive) por destino: uma para a OpenAI, uma para
+o portal Bitrix (REST + downloads de arquivos). Cada sessão mantém seu próprio pool
+de conexões, então cada pergunta reaproveita TCP+TLS em vez de abrir um handshake
+por chamada.
+
+No modo ASGI (app_async.py) os mesmos destinos usam `httpx.AsyncClient`
+(`cliente_async`), com limite de conexões bem maior: uma única thread atende
+centenas de conversas.
+"""
+import os, time, threading, logging
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger("cliente_http")
+
+FILA_WORKERS = int(os.getenv("FILA_WORKERS", "4"))
+# Conexões mantidas por host: uma por worker da fila + folga para o /install, warm-up etc.
+HTTP_POOL_MAX = int(os.getenv("HTTP_POOL_MAX", str(FILA_WORKERS + 4)))
+HTTP_TIMEOUT_CONEXAO = float(os.getenv("HTTP_TIMEOUT_CONEXAO", "5"))
+HTTP_TIMEOUT_LEITURA = float(os.getenv("HTTP_TIMEOUT_LEITURA", "30"))
+HTTP_POOL_MAX_ASYNC = int(os.getenv("HTTP_POOL_MAX_ASYNC", "200"))
+# Logo após o boot, resolve o DNS e abre uma conexão em cada pool (cold start do Render)
+HTTP_AQUECER = os.getenv("HTTP_AQUECER", "1") != "0"
+
+_lock = threading.Lock()
+_sessoes = {}
+_pid = None
+_clientes_async = {}   # (loop, nome) -> httpx.AsyncClient
+_ganchos = {}          # nome -> [fn(status_code, headers)] chamados a cada resposta do pool
+
+
+def timeout(leitura: float = None):
+    """(connect, read) padrão; `leitura` sobrescreve só o tempo de leitura."""
+    return (HTTP_TIMEOUT_CONEXAO, leitura if leitura is not None else HTTP_TIMEOUT_LEITURA)
+
+
+def registrar_gancho_resposta(nome: str, fn):
+    """`fn(status_code, headers)` roda a cada resposta do pool `nome` (sync e async)."""
+    _ganchos.setdefault(nome, []).append(fn)
+
+
+def _chamar_ganchos(nome: str, status_code: int, headers):
+    for fn in _ganchos.get(nome, ()):
+        try:
+            fn(status_code, headers)
+        except Exception:
+            log.exception("Gancho de resposta falhou")
+
+
+def _nova_sessao(nome: str) -> requests.Session:
+    s = requests.Session()
+    s.hooks["response"].append(lambda r, *args, **kwargs: _chamar_ganchos(nome, r.status_code, r.headers))
+    # max_retries=0: quem decide repetir é o chamador (fallback, fila de envio...)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_MAX, max_retries=0)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def sessao(nome: str) -> requests.Session:
+    """Sessão do pool `nome`. Recriada após fork (sockets não se compartilham entre processos)."""
+    global _pid
+    pid = os.getpid()
+    s = _sessoes.get(nome) if _pid == pid else None
+    if s is not None:
+        return s
+    with _lock:
+        if _pid != pid:
+            _sessoes.clear()
+            _pid = pid
+        if nome not in _sessoes:
+            _sessoes[nome] = _nova_sessao(nome)
+        return _sessoes[nome]
+
+
+def sessao_openai() -> requests.Session:
+    return sessao("openai")
+
+
+def sessao_bitrix() -> requests.Session:
+    return sessao("bitrix")
+
+
+def aquecer(destinos: dict):
+    """
+    Em segundo plano, faz um HEAD em cada destino {nome_do_pool: url}: DNS, TCP e TLS
+    ficam prontos no pool antes do primeiro webhook. O status da resposta não importa.
+    Chamar já no processo que vai atender (depois do fork), nunca no master do gunicorn.
+    """
+    if not HTTP_AQUECER:
+        return
+
+    def rodar():
+        for nome, url in destinos.items():
+            t0 = time.perf_counter()
+            try:
+                sessao(nome).head(url, timeout=timeout(HTTP_TIMEOUT_CONEXAO), allow_redirects=False)
+                log.info(f"Pool {nome} aquecido em {time.perf_counter() - t0:.3f}s.")
+            except requests.exceptions.RequestException as e:
+                log.warning(f"Falha ao aquecer o pool {nome}: {e}")
+
+    threading.Thread(target=rodar, name="aquecer-http", daemon=True).start()
+
+
+async def aquecer_async(destinos: dict):
+    """Mesmo que `aquecer`, nos clientes httpx do loop atual (startup do ASGI)."""
+    import asyncio, httpx
+    if not HTTP_AQUECER:
+        return
+
+    async def um(nome, url):
+        t0 = time.perf_counter()
+        try:
+            await cliente_async(nome).head(url, timeout=timeout_async(HTTP_TIMEOUT_CONEXAO), follow_redirects=False)
+            log.info(f"Pool {nome} aquecido em {time.perf_counter() - t0:.3f}s.")
+        except httpx.HTTPError as e:
+            log.warning(f"Falha ao aquecer o pool {nome}: {e}")
+
+    await asyncio.gather(*(um(nome, url) for nome, url in destinos.items()))
+
+
+def timeout_async(leitura: float = None):
+    import httpx
+    return httpx.Timeout(leitura if leitura is not None else HTTP_TIMEOUT_LEITURA,
+                         connect=HTTP_TIMEOUT_CONEXAO)
+
+
+def cliente_async(nome: str):
+    """
+    httpx.AsyncClient do pool `nome`, um por event loop (o cliente fica preso ao
+    loop em que abriu as conexões). httpx só é importado no modo async.
+    """
+    import asyncio, httpx
+    chave = (id(asyncio.get_running_loop()), nome)
+    cliente = _clientes_async.get(chave)
+    if cliente is None or cliente.is_closed:
+        async def gancho(r):
+            _chamar_ganchos(nome, r.status_code, r.headers)
+
+        cliente = httpx.AsyncClient(
+            timeout=timeout_async(),
+            event_hooks={"response": [gancho]},
+            limits=httpx.Limits(max_connections=HTTP_POOL_MAX_ASYNC,
+                                max_keepalive_connections=HTTP_POOL_MAX_ASYNC),
+            follow_redirects=True,
+        )
+        _clientes_async[chave] = cliente
+    return cliente
+
+
+async def fechar_clientes_async():
+    """Fecha os clientes do loop atual (shutdown do ASGI)."""
+    import asyncio
+    loop_id = id(asyncio.get_running_loop())
+    for chave in [c for c in _clientes_async if c[0] == loop_id]:
+        await _clientes_async.pop(chave).aclose()
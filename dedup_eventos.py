@@ -0,0 +1,134 @@
+# dedup_eventos.py
+"""
+Idempotência do /handler: o Bitrix reentrega ONIMBOTMESSAGEADD quando a resposta
+demora, e cada reentrega viraria outro run na OpenAI e outra resposta no chat.
+
+Chave do evento: MESSAGE_ID do Bitrix quando vem no payload; senão
+dialog_id + hash da mensagem, válida só por uma janela curta (o mesmo texto
+reenviado de propósito minutos depois é outra pergunta).
+"""
+import os, time, sqlite3, hashlib, threading, logging
+from collections import OrderedDict
+
+from armazenamento_sqlite import BancoCompartilhado
+
+log = logging.getLogger("dedup_eventos")
+
+DEDUP_ATIVO    = os.getenv("DEDUP_ATIVO", "1") != "0"
+DEDUP_MAX      = int(os.getenv("DEDUP_MAX", "10000"))
+DEDUP_TTL_S    = float(os.getenv("DEDUP_TTL_S", "600"))    # chave por MESSAGE_ID
+DEDUP_JANELA_S = float(os.getenv("DEDUP_JANELA_S", "30"))  # chave por hash do texto
+DEDUP_DB       = os.getenv("DEDUP_DB", "")                 # ex.: /var/data/eventos.sqlite3
+_INTERVALO_LIMPEZA_S = 60
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS eventos (
+    chave     TEXT PRIMARY KEY,
+    expira_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS eventos_expira_em ON eventos(expira_em);
+"""
+
+
+def chave_do_evento(payload: dict, dialog_id: str, texto: str, arquivo_url=None):
+    """(chave, ttl_s) do evento de mensagem, ou (None, 0) se não há como identificá-lo."""
+    message_id = None
+    for k in ("data[PARAMS][MESSAGE_ID]", "data[MESSAGE_ID]", "MESSAGE_ID"):
+        if payload.get(k):
+            message_id = payload[k]
+            break
+    if message_id:
+        return f"msg:{dialog_id}:{message_id}", DEDUP_TTL_S
+    if not (texto or arquivo_url):
+        return None, 0
+    digest = hashlib.sha256(f"{texto}\n{arquivo_url or ''}".encode()).hexdigest()[:32]
+    return f"hash:{dialog_id}:{digest}", DEDUP_JANELA_S
+
+
+class DeduplicadorEventos:
+    """
+    Conjunto limitado (LRU) de chaves já vistas, cada uma com seu vencimento.
+    Com `caminho_db`, o registro é feito numa transação SQLite, então dois workers
+    do gunicorn recebendo a mesma reentrega não processam os dois.
+    """
+
+    def __init__(self, max_itens: int = DEDUP_MAX, caminho_db: str = DEDUP_DB):
+        self.max_itens = max(1, max_itens)
+        self._itens = OrderedDict()   # chave -> expira_em
+        self._lock = threading.Lock()
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        self._ultima_limpeza = 0.0
+        self.novos = 0
+        self.duplicados = 0
+        self.liberados = 0
+
+    def registrar(self, chave: str, ttl_s: float) -> bool:
+        """True se o evento é novo (e fica registrado); False se é reentrega."""
+        agora = time.time()
+        with self._lock:
+            expira = self._itens.get(chave)
+            if expira is not None and expira > agora:
+                self.duplicados += 1
+                return False
+            if self._db and not self._registrar_db_seguro(chave, agora, agora + ttl_s):
+                self._inserir(chave, agora + ttl_s)
+                self.duplicados += 1
+                return False
+            self._inserir(chave, agora + ttl_s)
+            self.novos += 1
+            return True
+
+    def liberar(self, chave: str):
+        """Esquece a chave (ex.: a fila recusou o evento), para a reentrega ser aceita."""
+        with self._lock:
+            self._itens.pop(chave, None)
+            self.liberados += 1
+            if self._db:
+                try:
+                    with self._db.lock:
+                        self._db.conn().execute("DELETE FROM eventos WHERE chave = ?", (chave,))
+                except sqlite3.Error as e:
+                    log.warning(f"Dedup SQLite falhou ao liberar {chave}: {e}")
+
+    def _inserir(self, chave: str, expira_em: float):
+        self._itens[chave] = expira_em
+        self._itens.move_to_end(chave)
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+
+    def _registrar_db_seguro(self, chave: str, agora: float, expira_em: float) -> bool:
+        try:
+            return self._registrar_db(chave, agora, expira_em)
+        except sqlite3.Error as e:
+            # banco indisponível: segue só com a memória local em vez de derrubar o webhook
+            log.warning(f"Dedup SQLite falhou ({e}); usando só o registro em memória.")
+            return True
+
+    def _registrar_db(self, chave: str, agora: float, expira_em: float) -> bool:
+        with self._db.lock:
+            conn = self._db.conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM eventos WHERE chave = ? AND expira_em <= ?", (chave, agora))
+                novo = conn.execute("INSERT OR IGNORE INTO eventos(chave, expira_em) VALUES (?, ?)",
+                                    (chave, expira_em)).rowcount == 1
+                if agora - self._ultima_limpeza > _INTERVALO_LIMPEZA_S:
+                    self._ultima_limpeza = agora
+                    conn.execute("DELETE FROM eventos WHERE expira_em <= ?", (agora,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return novo
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "ativo": DEDUP_ATIVO,
+                "persistente": bool(self._db),
+                "itens": len(self._itens),
+                "max_itens": self.max_itens,
+                "novos": self.novos,
+                "duplicados": self.duplicados,
+                "liberados": self.liberados,
+            }
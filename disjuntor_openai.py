@@ -0,0 +1,235 @@
+# disjuntor_openai.py
+"""
+Disjuntor (circuit breaker) por endpoint da OpenAI: "runs" (threads/runs da
+Assistants API), "chat" (chat/completions) e "files" (upload de anexos).
+
+  - fechado: as chamadas passam; DISJUNTOR_FALHAS falhas seguidas (HTTP 5xx,
+    timeout, erro de conexão, run failed/expired) abrem o disjuntor;
+  - aberto: durante DISJUNTOR_ABERTO_S ninguém chama o endpoint. Para "runs",
+    o texto vai direto ao fallback em vez de pagar thread + run + polling até o timeout;
+  - meio-aberto: vencido o prazo, UMA chamada de sonda passa. Sucesso fecha;
+    falha reabre, com o prazo dobrado a cada reabertura (até DISJUNTOR_ABERTO_MAX_S).
+
+Com DISJUNTOR_DB o estado fica num SQLite e vale para todos os workers do gunicorn:
+o worker que vê a API cair abre o disjuntor para os outros, e só um deles faz a sonda.
+"""
+import os, sys, time, sqlite3, threading, logging
+from contextlib import contextmanager
+
+import requests
+
+from armazenamento_sqlite import BancoCompartilhado
+from cliente_assistants import ErroRun
+
+log = logging.getLogger("disjuntor_openai")
+
+DISJUNTOR_ATIVO       = os.getenv("DISJUNTOR_ATIVO", "1") != "0"
+DISJUNTOR_FALHAS      = int(os.getenv("DISJUNTOR_FALHAS", "5"))        # falhas seguidas para abrir
+DISJUNTOR_ABERTO_S    = float(os.getenv("DISJUNTOR_ABERTO_S", "30"))
+DISJUNTOR_ABERTO_MAX_S = float(os.getenv("DISJUNTOR_ABERTO_MAX_S", "300"))
+DISJUNTOR_SONDA_S     = float(os.getenv("DISJUNTOR_SONDA_S", "60"))    # sonda sem resposta: outra pode tentar
+DISJUNTOR_DB          = os.getenv("DISJUNTOR_DB", "")                  # ex.: /var/data/disjuntor.sqlite3
+
+ENDPOINTS = ("runs", "chat", "files")
+FECHADO, ABERTO, MEIO_ABERTO = "fechado", "aberto", "meio_aberto"
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS disjuntores (
+    endpoint        TEXT PRIMARY KEY,
+    estado          TEXT NOT NULL,
+    falhas_seguidas INTEGER NOT NULL,
+    aberto_ate      REAL NOT NULL,
+    sonda_ate       REAL NOT NULL,
+    aberturas       INTEGER NOT NULL,
+    mudou_em        REAL NOT NULL
+);
+"""
+_CAMPOS = ("estado", "falhas_seguidas", "aberto_ate", "sonda_ate", "aberturas", "mudou_em")
+
+
+def _erros_de_transporte() -> tuple:
+    """Timeout/conexão de requests, httpx e do SDK da OpenAI (os dois últimos só se já importados)."""
+    tipos = [requests.exceptions.ConnectionError, requests.exceptions.Timeout]
+    if "httpx" in sys.modules:
+        tipos.append(sys.modules["httpx"].TransportError)
+    if "openai" in sys.modules:
+        tipos.append(sys.modules["openai"].APIConnectionError)
+    return tuple(tipos)
+
+
+def classificar(e: Exception):
+    """
+    "timeout" / "erro" se a exceção indica API degradada; "ok" se a API respondeu
+    (4xx, run que pede tool outputs...); None se não diz nada (run cancelado pelo hedge).
+    """
+    if isinstance(e, ErroRun):
+        if e.status == "cancelled":
+            return None
+        return {"timeout": "timeout", "failed": "erro", "expired": "timeout"}.get(e.status, "ok")
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return "erro" if status >= 500 or status == 408 else "ok"
+    if isinstance(e, _erros_de_transporte()):
+        return "timeout" if "timeout" in type(e).__name__.lower() else "erro"
+    return None
+
+
+def _novo_estado(agora: float) -> dict:
+    return {"estado": FECHADO, "falhas_seguidas": 0, "aberto_ate": 0.0, "sonda_ate": 0.0,
+            "aberturas": 0, "mudou_em": agora}
+
+
+class DisjuntorOpenAI:
+    def __init__(self, falhas: int = DISJUNTOR_FALHAS, aberto_s: float = DISJUNTOR_ABERTO_S,
+                 aberto_max_s: float = DISJUNTOR_ABERTO_MAX_S, sonda_s: float = DISJUNTOR_SONDA_S,
+                 caminho_db: str = DISJUNTOR_DB):
+        self.falhas = max(1, falhas)
+        self.aberto_s = aberto_s
+        self.aberto_max_s = max(aberto_s, aberto_max_s)
+        self.sonda_s = sonda_s
+        self._lock = threading.Lock()
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        agora = time.time()
+        self._estados = {e: _novo_estado(agora) for e in ENDPOINTS}
+        self.stats = {e: {"sucessos": 0, "falhas": 0, "timeouts": 0, "bloqueadas": 0, "sondas": 0}
+                      for e in ENDPOINTS}
+        self.erros_db = 0
+
+    # ---------- estado (local ou SQLite) ----------
+    def _transacao(self, endpoint: str, fn):
+        """Roda `fn(estado, agora)` sobre o estado do endpoint; grava se `fn` devolver (resultado, True)."""
+        with self._lock:
+            if self._db:
+                try:
+                    return self._transacao_db(endpoint, fn)
+                except sqlite3.Error as e:
+                    self.erros_db += 1
+                    log.warning(f"Disjuntor SQLite falhou ({e}); usando o estado local.")
+            resultado, _ = fn(self._estados[endpoint], time.time())
+            return resultado
+
+    def _transacao_db(self, endpoint: str, fn):
+        with self._db.lock:
+            conn = self._db.conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                agora = time.time()
+                linha = conn.execute(f"SELECT {', '.join(_CAMPOS)} FROM disjuntores WHERE endpoint = ?",
+                                     (endpoint,)).fetchone()
+                estado = dict(zip(_CAMPOS, linha)) if linha else _novo_estado(agora)
+                resultado, mudou = fn(estado, agora)
+                if mudou:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO disjuntores(endpoint, {', '.join(_CAMPOS)}) "
+                        f"VALUES (?, {', '.join('?' * len(_CAMPOS))})",
+                        (endpoint, *(estado[c] for c in _CAMPOS)),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._estados[endpoint] = estado   # última leitura, para as métricas
+        return resultado
+
+    # ---------- API ----------
+    def permitir(self, endpoint: str) -> bool:
+        """False se o endpoint está aberto (ou com sonda em andamento): o chamador pula a chamada."""
+        if not DISJUNTOR_ATIVO:
+            return True
+
+        def decidir(estado, agora):
+            if estado["estado"] == FECHADO:
+                return True, False
+            if estado["estado"] == ABERTO and agora < estado["aberto_ate"]:
+                return False, False
+            if estado["estado"] == MEIO_ABERTO and agora < estado["sonda_ate"]:
+                return False, False
+            # prazo vencido (ou sonda anterior sem resposta): esta chamada é a sonda
+            estado.update(estado=MEIO_ABERTO, sonda_ate=agora + self.sonda_s, mudou_em=agora)
+            return "sonda", True
+
+        resultado = self._transacao(endpoint, decidir)
+        if resultado == "sonda":
+            self.stats[endpoint]["sondas"] += 1
+            log.info(f"🔌 Disjuntor {endpoint}: meio-aberto, chamada de sonda liberada.")
+        elif not resultado:
+            self.stats[endpoint]["bloqueadas"] += 1
+        return bool(resultado)
+
+    def sucesso(self, endpoint: str):
+        """Chamada respondida. Zera as falhas seguidas; no meio-aberto, fecha o disjuntor."""
+        def aplicar(estado, agora):
+            if estado["estado"] == ABERTO:
+                return False, False   # chamada que começou antes de abrir: só a sonda fecha
+            if estado["estado"] == FECHADO:
+                if not estado["falhas_seguidas"]:
+                    return False, False
+                estado["falhas_seguidas"] = 0
+                return False, True
+            estado.update(estado=FECHADO, falhas_seguidas=0, aberturas=0, sonda_ate=0.0, mudou_em=agora)
+            return True, True
+
+        self.stats[endpoint]["sucessos"] += 1
+        if DISJUNTOR_ATIVO and self._transacao(endpoint, aplicar):
+            log.info(f"🔌 Disjuntor {endpoint}: fechado, API respondendo de novo.")
+
+    def falha(self, endpoint: str, tipo: str = "erro", motivo: str = ""):
+        """Falha de serviço ("erro" ou "timeout"). Abre ao atingir o limite, ou de novo se for a sonda."""
+        def aplicar(estado, agora):
+            if estado["estado"] == ABERTO:
+                return None, False   # chamada que começou antes de abrir
+            estado["falhas_seguidas"] += 1
+            if estado["estado"] == FECHADO and estado["falhas_seguidas"] < self.falhas:
+                return None, True
+            aberto_s = min(self.aberto_max_s, self.aberto_s * 2 ** estado["aberturas"])
+            estado.update(estado=ABERTO, aberto_ate=agora + aberto_s, sonda_ate=0.0,
+                          aberturas=estado["aberturas"] + 1, mudou_em=agora)
+            return aberto_s, True
+
+        self.stats[endpoint]["timeouts" if tipo == "timeout" else "falhas"] += 1
+        if not DISJUNTOR_ATIVO:
+            return
+        aberto_s = self._transacao(endpoint, aplicar)
+        if aberto_s:
+            log.warning(f"🔌 Disjuntor {endpoint}: aberto por {aberto_s:.0f}s ({tipo}: {motivo}).")
+
+    @contextmanager
+    def medir(self, endpoint: str):
+        """Registra o desfecho da chamada no bloco (sucesso, falha ou nada) e repassa a exceção."""
+        try:
+            yield
+        except Exception as e:
+            tipo = classificar(e)
+            if tipo == "ok":
+                self.sucesso(endpoint)
+            elif tipo:
+                self.falha(endpoint, tipo, str(e)[:200])
+            raise
+        self.sucesso(endpoint)
+
+    def metricas(self) -> dict:
+        agora = time.time()
+        if self._db:
+            for endpoint in ENDPOINTS:   # estado compartilhado, igual em todos os workers
+                self._transacao(endpoint, lambda estado, agora: (None, False))
+        with self._lock:
+            return {
+                "ativo": DISJUNTOR_ATIVO,
+                "compartilhado": bool(self._db),
+                "falhas_para_abrir": self.falhas,
+                "erros_db": self.erros_db,
+                "endpoints": {
+                    e: {
+                        "estado": s["estado"],
+                        "falhas_seguidas": s["falhas_seguidas"],
+                        "reabre_em_s": round(max(0.0, s["aberto_ate"] - agora), 1) if s["estado"] == ABERTO else 0,
+                        "aberturas": s["aberturas"],
+                        "desde": round(s["mudou_em"], 3),
+                        **self.stats[e],
+                    }
+                    for e, s in self._estados.items()
+                },
+            }
+
+
+disjuntor = DisjuntorOpenAI()
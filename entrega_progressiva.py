@@ -0,0 +1,239 @@
+# entrega_progressiva.py
+"""
+Entrega progressiva da resposta no Bitrix: "digitando..." assim que a mensagem
+chega (imbot.chat.sendTyping), a primeira parte do texto como mensagem nova
+(imbot.message.add) logo que o stream do run traz ENTREGA_MIN_CARACTERES e, daí
+em diante, a MESMA mensagem atualizada no lugar (imbot.message.update) até o
+texto final.
+
+Atualizações intermediárias são opcionais: no máximo uma a cada ENTREGA_INTERVALO_S
+por mensagem e ENTREGA_ATUALIZACOES_POR_S no processo todo (teto do REST do Bitrix).
+Sem vaga, a atualização é pulada e a próxima leva o texto acumulado. O texto
+final sempre é enviado.
+"""
+import os, time, asyncio, threading, logging
+
+from envio_bitrix import BITRIX_ESPERA_S
+
+log = logging.getLogger("entrega_progressiva")
+
+ENTREGA_PROGRESSIVA         = os.getenv("ENTREGA_PROGRESSIVA", "0") == "1"
+ENTREGA_INTERVALO_S         = float(os.getenv("ENTREGA_INTERVALO_S", "1.5"))
+ENTREGA_MIN_CARACTERES      = int(os.getenv("ENTREGA_MIN_CARACTERES", "20"))
+ENTREGA_ATUALIZACOES_POR_S  = float(os.getenv("ENTREGA_ATUALIZACOES_POR_S", "1"))
+ENTREGA_RAJADA              = int(os.getenv("ENTREGA_RAJADA", "5"))
+CURSOR = " ▍"   # marca a mensagem ainda em geração
+
+
+class _Teto:
+    """Token bucket sem espera: `tentar()` diz se a atualização intermediária pode sair agora."""
+
+    def __init__(self, por_s: float = ENTREGA_ATUALIZACOES_POR_S, rajada: int = ENTREGA_RAJADA):
+        self.por_s = por_s
+        self.rajada = max(1.0, float(rajada))
+        self._fichas = self.rajada
+        self._atualizado = time.time()
+        self._lock = threading.Lock()
+        self.stats = {"digitando": 0, "parciais": 0, "puladas_teto": 0, "finais": 0, "erros": 0}
+
+    def tentar(self) -> bool:
+        with self._lock:
+            agora = time.time()
+            self._fichas = min(self.rajada, self._fichas + (agora - self._atualizado) * self.por_s)
+            self._atualizado = agora
+            if self._fichas < 1:
+                self.stats["puladas_teto"] += 1
+                return False
+            self._fichas -= 1
+            return True
+
+    def contar(self, evento: str):
+        with self._lock:
+            self.stats[evento] += 1
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {"ativo": ENTREGA_PROGRESSIVA, "intervalo_s": ENTREGA_INTERVALO_S,
+                    "atualizacoes_por_s": self.por_s, **self.stats}
+
+
+teto = _Teto()
+
+
+class _Progresso:
+    """Decisões comuns ao modo síncrono e ao async: quando atualizar e com quais parâmetros."""
+
+    def __init__(self, dialog_id: str, bot_id: str, formatar=None):
+        self.dialog_id = dialog_id
+        self.bot_id = bot_id
+        self.formatar = formatar or (lambda texto: texto)
+        self.message_id = None
+        self.exibido = ""
+        self.ultimo_envio = 0.0
+        self.encerrada = False   # texto final enviado (ou parciais desativadas por erro)
+        self.t0 = time.time()
+
+    def _parcial_a_enviar(self, texto: str):
+        """Texto (com cursor) a exibir agora, ou None se esta atualização deve ser pulada."""
+        if self.encerrada:
+            return None
+        texto = (self.formatar(texto) or "").strip()
+        if len(texto) - len(self.exibido) < ENTREGA_MIN_CARACTERES:
+            return None
+        if time.time() - self.ultimo_envio < ENTREGA_INTERVALO_S or not teto.tentar():
+            return None
+        return texto
+
+    def _chamada(self, texto: str, parcial: bool):
+        """(método REST, corpo) para exibir `texto`: mensagem nova ou atualização da existente."""
+        mensagem = texto + CURSOR if parcial else texto
+        if self.message_id is None:
+            return "imbot.message.add", {"BOT_ID": self.bot_id, "DIALOG_ID": self.dialog_id,
+                                         "CLIENT_ID": "1", "MESSAGE": mensagem}
+        return "imbot.message.update", {"BOT_ID": self.bot_id, "MESSAGE_ID": self.message_id,
+                                        "MESSAGE": mensagem}
+
+    def _registrar(self, metodo: str, texto: str, resultado: dict, parcial: bool):
+        if metodo == "imbot.message.add":
+            self.message_id = (resultado or {}).get("result")
+            if parcial:
+                log.info(f"✍️ Primeira parte da resposta no diálogo {self.dialog_id} "
+                         f"em {time.time() - self.t0:.2f}s (mensagem {self.message_id}).")
+        self.exibido = texto
+        self.ultimo_envio = time.time()
+        teto.contar("parciais" if parcial else "finais")
+
+    def _falhou(self, e: Exception, parcial: bool):
+        teto.contar("erros")
+        if parcial:
+            log.warning(f"Atualização parcial no diálogo {self.dialog_id} falhou ({e}); "
+                        f"seguindo só com a mensagem final.")
+            self.encerrada = True
+
+
+class EntregaProgressiva(_Progresso):
+    """
+    Modo síncrono. `chamar_bitrix(metodo, corpo, dialog_id, esperar=True) -> dict` faz a chamada REST;
+    com `esperar=False` só enfileira e devolve o Future do resultado.
+    `parcial` é o callback do stream do run (roda na thread que lê o stream): só enfileira, nunca
+    espera o Bitrix. Uma parcial em andamento por mensagem; o add precisa do MESSAGE_ID antes dos
+    updates, e a fila do Bitrix mantém a ordem do diálogo. Só `finalizar` aguarda.
+    """
+
+    def __init__(self, dialog_id: str, bot_id: str, chamar_bitrix, formatar=None):
+        super().__init__(dialog_id, bot_id, formatar)
+        self.chamar_bitrix = chamar_bitrix
+        self._lock = threading.RLock()   # o callback do Future pode rodar na hora, dentro de `parcial`
+        self._envio = None               # (Future, método) da parcial em andamento
+
+    def digitando(self):
+        try:
+            self.chamar_bitrix("imbot.chat.sendTyping", {"BOT_ID": self.bot_id, "DIALOG_ID": self.dialog_id},
+                              self.dialog_id, esperar=False)
+            teto.contar("digitando")
+        except Exception as e:
+            log.warning(f"sendTyping no diálogo {self.dialog_id} falhou: {e}")
+
+    def parcial(self, texto: str):
+        with self._lock:
+            if self._envio is not None and not self._envio[0].done():
+                return   # a próxima delta leva o texto acumulado
+            texto = self._parcial_a_enviar(texto)
+            if texto is None:
+                return
+            metodo, corpo = self._chamada(texto, parcial=True)
+            try:
+                futuro = self.chamar_bitrix(metodo, corpo, self.dialog_id, esperar=False)
+            except Exception as e:
+                self._falhou(e, parcial=True)
+                return
+            self._envio = (futuro, metodo)
+            self.ultimo_envio = time.time()   # o intervalo conta do envio, não da confirmação
+            futuro.add_done_callback(lambda f: self._parcial_concluida(f, metodo, texto))
+
+    def _parcial_concluida(self, futuro, metodo: str, texto: str):
+        """Callback do Future (thread da fila do Bitrix). Depois de `finalizar`, quem lê o resultado é ele."""
+        with self._lock:
+            if self.encerrada:
+                return
+            try:
+                self._registrar(metodo, texto, {"result": futuro.result()}, parcial=True)
+            except Exception as e:
+                self._falhou(e, parcial=True)
+
+    def finalizar(self, texto: str):
+        """Envia o texto final (atualizando a mensagem parcial, se houver). Parciais atrasadas são ignoradas."""
+        with self._lock:
+            self.encerrada = True
+            envio = self._envio
+        # fora do lock: o callback da parcial roda na thread da fila do Bitrix, que também entrega o final
+        if envio is not None and envio[1] == "imbot.message.add" and self.message_id is None:
+            try:
+                self.message_id = envio[0].result(timeout=BITRIX_ESPERA_S)
+            except Exception as e:
+                self._falhou(e, parcial=True)   # sem a mensagem parcial: o final sai como mensagem nova
+        metodo, corpo = self._chamada(texto, parcial=False)
+        try:
+            self._registrar(metodo, texto, self.chamar_bitrix(metodo, corpo, self.dialog_id), parcial=False)
+            return
+        except Exception as e:
+            self._falhou(e, parcial=False)
+            if metodo == "imbot.message.add":
+                raise
+        # a atualização falhou: a resposta vai como mensagem nova
+        log.warning(f"imbot.message.update falhou no diálogo {self.dialog_id}; enviando como mensagem nova.")
+        self.message_id = None
+        metodo, corpo = self._chamada(texto, parcial=False)
+        self._registrar(metodo, texto, self.chamar_bitrix(metodo, corpo, self.dialog_id), parcial=False)
+
+
+class EntregaProgressivaAsync(_Progresso):
+    """
+    Modo async (app_async). `chamar_bitrix` é uma corrotina. O callback do stream é
+    síncrono, então cada atualização vira uma tarefa; só uma fica em andamento por
+    mensagem (o message_id da primeira precisa chegar antes das seguintes).
+    """
+
+    def __init__(self, dialog_id: str, bot_id: str, chamar_bitrix, formatar=None):
+        super().__init__(dialog_id, bot_id, formatar)
+        self.chamar_bitrix = chamar_bitrix
+        self._tarefa = None
+
+    async def digitando(self):
+        try:
+            await self.chamar_bitrix("imbot.chat.sendTyping", {"BOT_ID": self.bot_id, "DIALOG_ID": self.dialog_id},
+                              self.dialog_id, esperar=False)
+            teto.contar("digitando")
+        except Exception as e:
+            log.warning(f"sendTyping no diálogo {self.dialog_id} falhou: {e}")
+
+    def parcial(self, texto: str):
+        if self._tarefa is not None and not self._tarefa.done():
+            return   # a próxima delta leva o texto acumulado
+        texto = self._parcial_a_enviar(texto)
+        if texto is not None:
+            self._tarefa = asyncio.get_running_loop().create_task(self._enviar_parcial(texto))
+
+    async def _enviar_parcial(self, texto: str):
+        metodo, corpo = self._chamada(texto, parcial=True)
+        try:
+            self._registrar(metodo, texto, await self.chamar_bitrix(metodo, corpo, self.dialog_id), parcial=True)
+        except Exception as e:
+            self._falhou(e, parcial=True)
+
+    async def finalizar(self, texto: str):
+        self.encerrada = True
+        if self._tarefa is not None:
+            await self._tarefa
+        metodo, corpo = self._chamada(texto, parcial=False)
+        try:
+            self._registrar(metodo, texto, await self.chamar_bitrix(metodo, corpo, self.dialog_id), parcial=False)
+            return
+        except Exception as e:
+            self._falhou(e, parcial=False)
+            if metodo == "imbot.message.add":
+                raise
+        log.warning(f"imbot.message.update falhou no diálogo {self.dialog_id}; enviando como mensagem nova.")
+        self.message_id = None
+        metodo, corpo = self._chamada(texto, parcial=False)
+        self._registrar(metodo, texto, await self.chamar_bitrix(metodo, corpo, self.dialog_id), parcial=False)
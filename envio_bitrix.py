@@ -0,0 +1,286 @@
+# envio_bitrix.py
+"""
+Fila de saída do REST do Bitrix. Respostas, boas-vindas, avisos de horário,
+"digitando..." e atualizações da entrega progressiva não saem mais cada um no seu
+POST: uma thread despachante junta os comandos pendentes numa chamada `batch`
+(até BITRIX_BATCH_MAX comandos), que o Bitrix conta como uma só no limite do portal.
+
+  - ordem por diálogo: um lote leva no máximo um comando de cada diálogo, e um
+    comando que volta para a fila volta na frente dos seguintes do mesmo diálogo;
+  - QUERY_LIMIT_EXCEEDED / HTTP 429/503 / falha de conexão: o comando é repetido com
+    backoff exponencial (pausa a fila toda: o limite é do portal);
+  - timeout de leitura / outro 5xx: o Bitrix pode ter executado o lote. Só os
+    comandos idempotentes são repetidos; um `*.message.add` falha (repetir
+    duplicaria a mensagem no chat);
+  - depois de BITRIX_TENTATIVAS, ou em erro definitivo (ex.: diálogo inexistente),
+    a falha é logada com o diálogo e o texto e fica em `metricas()["falhas_recentes"]`.
+"""
+import os, time, threading, logging
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import urlencode
+
+import requests
+
+from cliente_http import sessao_bitrix, timeout
+from metricas_prometheus import metricas
+
+log = logging.getLogger("envio_bitrix")
+
+BITRIX_BATCH_MAX     = min(50, int(os.getenv("BITRIX_BATCH_MAX", "50")))   # teto do próprio Bitrix
+BITRIX_TENTATIVAS    = int(os.getenv("BITRIX_TENTATIVAS", "5"))
+BITRIX_BACKOFF_S     = float(os.getenv("BITRIX_BACKOFF_S", "1"))
+BITRIX_BACKOFF_MAX_S = float(os.getenv("BITRIX_BACKOFF_MAX_S", "30"))
+BITRIX_ESPERA_S      = float(os.getenv("BITRIX_ESPERA_S", "60"))   # quem aguarda o resultado desiste depois disso
+BITRIX_TIMEOUT_S     = float(os.getenv("BITRIX_TIMEOUT_S", "15"))
+
+ERROS_DE_LIMITE = ("QUERY_LIMIT_EXCEEDED", "OPERATION_TIME_LIMIT")
+# Repetir depois de um lote de desfecho incerto criaria outra mensagem
+METODOS_NAO_IDEMPOTENTES = ("imbot.message.add", "im.message.add")
+
+
+class ErroBitrix(Exception):
+    """Comando recusado pelo Bitrix (ou sem resposta depois de todas as tentativas)."""
+
+    def __init__(self, codigo: str, descricao: str = "", status_code: int = None):
+        self.codigo = codigo
+        self.descricao = descricao
+        self.status_code = status_code
+        super().__init__(f"{codigo}: {descricao}" if descricao else codigo)
+
+
+class _Comando:
+    __slots__ = ("metodo", "params", "dialog_id", "futuro", "tentativas", "criado")
+
+    def __init__(self, metodo: str, params: dict, dialog_id):
+        self.metodo = metodo
+        self.params = params
+        self.dialog_id = dialog_id
+        self.futuro = Future()
+        self.tentativas = 0
+        self.criado = time.time()
+
+    def chave_ordem(self):
+        return self.dialog_id if self.dialog_id is not None else id(self)
+
+    def linha_batch(self) -> str:
+        return f"{self.metodo}?{urlencode(self.params, doseq=True)}"
+
+
+class FilaEnvioBitrix:
+    """
+    `enviar` devolve um Future com o `result` do comando (ex.: o MESSAGE_ID do
+    imbot.message.add). A thread sobe no primeiro envio e é recriada após fork.
+    """
+
+    def __init__(self, webhook: str, batch_max: int = BITRIX_BATCH_MAX, tentativas: int = BITRIX_TENTATIVAS,
+                 backoff_s: float = BITRIX_BACKOFF_S, backoff_max_s: float = BITRIX_BACKOFF_MAX_S):
+        self.webhook = webhook.rstrip("/")
+        self.batch_max = max(1, batch_max)
+        self.tentativas = max(1, tentativas)
+        self.backoff_s = backoff_s
+        self.backoff_max_s = max(backoff_s, backoff_max_s)
+        self._pendentes = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._em_andamento = 0
+        self._pausa_ate = 0.0
+        self._nivel_backoff = 0
+        self._falhas_recentes = deque(maxlen=20)
+        self.stats = {"comandos": 0, "lotes": 0, "entregues": 0, "repetidos": 0, "falhas": 0, "pausas": 0,
+                      "incertos": 0, "maior_lote": 0}
+
+    # ---------- API ----------
+    def enviar(self, metodo: str, params: dict, dialog_id=None) -> Future:
+        """Enfileira o comando sem esperar."""
+        self._garantir_thread()
+        comando = _Comando(metodo, params, dialog_id)
+        with self._cond:
+            self._pendentes.append(comando)
+            self.stats["comandos"] += 1
+            self._cond.notify()
+        return comando.futuro
+
+    def chamar(self, metodo: str, params: dict, dialog_id=None, espera_s: float = BITRIX_ESPERA_S):
+        """Enfileira e aguarda o resultado. Levanta ErroBitrix (ou TimeoutError)."""
+        return self.enviar(metodo, params, dialog_id).result(timeout=espera_s)
+
+    async def chamar_async(self, metodo: str, params: dict, dialog_id=None, espera_s: float = BITRIX_ESPERA_S):
+        import asyncio
+        return await asyncio.wait_for(asyncio.wrap_future(self.enviar(metodo, params, dialog_id)), espera_s)
+
+    def drenar(self, espera_s: float = 10.0) -> bool:
+        """Espera a fila esvaziar (shutdown). True se tudo saiu a tempo."""
+        limite = time.time() + espera_s
+        with self._cond:
+            while self._pendentes or self._em_andamento:
+                restante = limite - time.time()
+                if restante <= 0 or self._pid != os.getpid():
+                    log.warning(f"{len(self._pendentes) + self._em_andamento} comandos do Bitrix não saíram.")
+                    return False
+                self._cond.wait(min(restante, 0.1))
+        return True
+
+    # ---------- despachante ----------
+    def _garantir_thread(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+        with self._cond:
+            if self._pid == pid and self._thread is not None:
+                return
+            if self._pid is not None and self._pid != pid:
+                self._pendentes.clear()   # comandos herdados do pai pertencem ao processo dele
+                self._em_andamento = 0
+            self._pid = pid
+            self._thread = threading.Thread(target=self._loop, name="envio-bitrix", daemon=True)
+            self._thread.start()
+
+    def _montar_lote(self) -> list:
+        """Sob self._cond. Primeiro comando pendente de cada diálogo, na ordem de chegada."""
+        lote, vistos, resto = [], set(), deque()
+        while self._pendentes:
+            comando = self._pendentes.popleft()
+            chave = comando.chave_ordem()
+            if chave in vistos or len(lote) >= self.batch_max:
+                resto.append(comando)
+                continue
+            vistos.add(chave)
+            lote.append(comando)
+        self._pendentes = resto
+        return lote
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    pausa = self._pausa_ate - time.time()
+                    if pausa > 0:
+                        self._cond.wait(pausa)
+                        continue
+                    if self._pendentes:
+                        break
+                    self._cond.wait()
+                lote = self._montar_lote()
+                self._em_andamento = len(lote)
+                self.stats["lotes"] += 1
+                self.stats["maior_lote"] = max(self.stats["maior_lote"], len(lote))
+            try:
+                self._enviar_lote(lote)
+            except Exception as e:
+                log.exception(f"Erro inesperado enviando lote ao Bitrix: {e}")
+                for comando in lote:
+                    if not comando.futuro.done():
+                        self._falhar(comando, ErroBitrix("ERRO_INTERNO", str(e)))
+            finally:
+                with self._cond:
+                    self._em_andamento = 0
+                    self._cond.notify_all()
+
+    def _enviar_lote(self, lote: list):
+        cmd = {f"c{i}": c.linha_batch() for i, c in enumerate(lote)}
+        for comando in lote:
+            comando.tentativas += 1
+        try:
+            with metricas.medir("bitrix_lote"):
+                r = sessao_bitrix().post(f"{self.webhook}/batch.json", json={"halt": 0, "cmd": cmd},
+                                         timeout=timeout(BITRIX_TIMEOUT_S))
+                data = r.json()
+        except requests.exceptions.ConnectionError as e:   # inclui ConnectTimeout: o lote não chegou
+            return self._repetir(lote, ErroBitrix("REDE", str(e)))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # timeout de leitura / resposta cortada: o Bitrix pode ter executado o lote
+            return self._incerto(lote, ErroBitrix("REDE_INCERTA", str(e)))
+
+        erro = data.get("error") if isinstance(data, dict) else None
+        descricao = data.get("error_description", "") if erro else ""
+        if r.status_code in (429, 503) or erro in ERROS_DE_LIMITE:
+            return self._repetir(lote, ErroBitrix(erro or f"HTTP_{r.status_code}", descricao, r.status_code))
+        if r.status_code >= 500:
+            return self._incerto(lote, ErroBitrix(erro or f"HTTP_{r.status_code}", descricao, r.status_code))
+        if erro or r.status_code >= 400:
+            for comando in lote:
+                self._falhar(comando, ErroBitrix(erro or f"HTTP_{r.status_code}", descricao, r.status_code))
+            return
+
+        corpo = data.get("result") or {}
+        resultados = corpo.get("result") or {}
+        erros = corpo.get("result_error") or {}   # o Bitrix devolve [] quando vazio
+        repetir = []
+        for i, comando in enumerate(lote):
+            chave = f"c{i}"
+            if chave in erros:
+                e = erros[chave] or {}
+                falha = ErroBitrix(e.get("error", "ERRO"), e.get("error_description", ""))
+                if falha.codigo in ERROS_DE_LIMITE:
+                    repetir.append(comando)
+                else:
+                    self._falhar(comando, falha)
+            else:
+                self._registrar(comando, "ok")
+                comando.futuro.set_result(resultados.get(chave) if isinstance(resultados, dict) else None)
+                self.stats["entregues"] += 1
+        if repetir:
+            return self._repetir(repetir, ErroBitrix("QUERY_LIMIT_EXCEEDED"))
+        with self._cond:
+            self._nivel_backoff = 0
+
+    def _incerto(self, comandos: list, erro: ErroBitrix):
+        """Lote que o Bitrix pode ter executado: repete só o que é idempotente."""
+        nao_repetir = [c for c in comandos if c.metodo in METODOS_NAO_IDEMPOTENTES]
+        with self._cond:
+            self.stats["incertos"] += len(nao_repetir)
+        for comando in nao_repetir:
+            self._falhar(comando, erro)
+        repetir = [c for c in comandos if c.metodo not in METODOS_NAO_IDEMPOTENTES]
+        if repetir:
+            self._repetir(repetir, erro)
+
+    def _repetir(self, comandos: list, erro: ErroBitrix):
+        """Devolve os comandos à frente da fila e pausa o despachante com backoff exponencial."""
+        de_novo = []
+        for comando in comandos:
+            if comando.tentativas >= self.tentativas:
+                self._falhar(comando, erro)
+            else:
+                de_novo.append(comando)
+        with self._cond:
+            pausa = min(self.backoff_max_s, self.backoff_s * 2 ** self._nivel_backoff)
+            self._nivel_backoff += 1
+            self._pausa_ate = max(self._pausa_ate, time.time() + pausa)
+            self._pendentes.extendleft(reversed(de_novo))
+            self.stats["repetidos"] += len(de_novo)
+            self.stats["pausas"] += 1
+        log.warning(f"Bitrix recusou/adiou {len(comandos)} comandos ({erro}); nova tentativa em {pausa:.1f}s.")
+
+    def _falhar(self, comando: _Comando, erro: ErroBitrix):
+        texto = str(comando.params.get("MESSAGE", ""))[:200]
+        log.error(f"❌ Bitrix {comando.metodo} para o diálogo {comando.dialog_id} falhou após "
+                  f"{comando.tentativas} tentativa(s): {erro}. Mensagem: {texto!r}")
+        with self._cond:
+            self.stats["falhas"] += 1
+            self._falhas_recentes.append({
+                "metodo": comando.metodo, "dialog_id": comando.dialog_id, "erro": str(erro),
+                "mensagem": texto, "em": round(time.time(), 3),
+            })
+        self._registrar(comando, "falha")
+        comando.futuro.set_exception(erro)
+
+    @staticmethod
+    def _registrar(comando: _Comando, resultado: str):
+        """Do enfileiramento ao desfecho (inclui espera na fila e backoff)."""
+        metricas.etapa("bitrix_envio", time.time() - comando.criado)
+        metricas.contar("lis_bitrix_comandos_total", metodo=comando.metodo, resultado=resultado)
+
+    def metricas(self) -> dict:
+        with self._cond:
+            lotes = self.stats["lotes"]
+            return {
+                "pendentes": len(self._pendentes),
+                "em_andamento": self._em_andamento,
+                "pausado_por_s": round(max(0.0, self._pausa_ate - time.time()), 2),
+                **self.stats,
+                "comandos_por_lote": round((self.stats["entregues"] + self.stats["falhas"]) / lotes, 2) if lotes else 0,
+                "falhas_recentes": list(self._falhas_recentes),
+            }
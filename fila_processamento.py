@@ -0,0 +1,103 @@
+# fila_processamento.py
+import os, queue, threading, time, logging, contextvars
+
+log = logging.getLogger("fila_processamento")
+
+FILA_WORKERS = int(os.getenv("FILA_WORKERS", "4"))
+FILA_MAX     = int(os.getenv("FILA_MAX", "100"))   # backpressure: acima disso o /handler recusa
+
+
+class FilaProcessamento:
+    """
+    Pool de threads com fila limitada para tirar o trabalho pesado (IA + envio
+    ao Bitrix) de dentro da requisição do webhook.
+
+    As threads só sobem no primeiro `enviar`, para funcionar com `gunicorn --preload`
+    (threads não sobrevivem ao fork do worker). Cada tarefa roda com os contextvars
+    de quem a enfileirou (ex.: id do evento nos logs).
+    """
+
+    def __init__(self, workers: int = FILA_WORKERS, maxsize: int = FILA_MAX):
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        self._fila = queue.Queue(maxsize=self.maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._em_execucao = 0
+        self._enfileirados = 0
+        self._processados = 0
+        self._rejeitados = 0
+        self._falhas = 0
+        self._espera_total_s = 0.0
+        self._espera_max_s = 0.0
+
+    def _garantir_workers(self):
+        pid = os.getpid()
+        if self._pid == pid and self._threads:
+            return
+        with self._lock:
+            if self._pid == pid and self._threads:
+                return
+            # processo novo (fork): descarta o estado herdado do pai
+            if self._pid is not None and self._pid != pid:
+                self._fila = queue.Queue(maxsize=self.maxsize)
+            self._pid = pid
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._loop, name=f"fila-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def enviar(self, fn, *args, **kwargs) -> bool:
+        """Enfileira `fn(*args, **kwargs)`. Retorna False se a fila estiver cheia (backpressure)."""
+        self._garantir_workers()
+        try:
+            self._fila.put_nowait((time.monotonic(), contextvars.copy_context(), fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._rejeitados += 1
+            log.warning(f"Fila cheia ({self.maxsize}); evento recusado.")
+            return False
+        with self._lock:
+            self._enfileirados += 1
+        return True
+
+    def _loop(self):
+        while True:
+            t_enfileirado, contexto, fn, args, kwargs = self._fila.get()
+            espera = time.monotonic() - t_enfileirado
+            with self._lock:
+                self._em_execucao += 1
+                self._espera_total_s += espera
+                self._espera_max_s = max(self._espera_max_s, espera)
+            try:
+                contexto.run(fn, *args, **kwargs)
+                ok = True
+            except Exception as e:
+                ok = False
+                log.exception(f"Erro processando tarefa da fila: {e}")
+            finally:
+                with self._lock:
+                    self._em_execucao -= 1
+                    if ok:
+                        self._processados += 1
+                    else:
+                        self._falhas += 1
+                self._fila.task_done()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            iniciados = self._processados + self._falhas + self._em_execucao
+            return {
+                "workers": self.workers,
+                "capacidade": self.maxsize,
+                "profundidade": self._fila.qsize(),
+                "em_execucao": self._em_execucao,
+                "enfileirados": self._enfileirados,
+                "processados": self._processados,
+                "falhas": self._falhas,
+                "rejeitados": self._rejeitados,
+                "espera_media_s": round(self._espera_total_s / iniciados, 4) if iniciados else 0.0,
+                "espera_max_s": round(self._espera_max_s, 4),
+            }
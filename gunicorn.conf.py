@@ -0,0 +1,23 @@
+# gunicorn.conf.py
+"""
+Partida rápida no modo síncrono (o plano free do Render dorme e acorda no primeiro
+webhook).
+
+- preload_app: o master importa o main uma vez e os workers herdam os módulos já
+  carregados (fork), em vez de cada um repetir os imports. Filas, pools e conexões
+  só nascem no primeiro uso e são recriados por pid, então nada é dividido entre
+  processos.
+- post_worker_init: cada worker abre suas conexões com a OpenAI e o Bitrix em
+  segundo plano (HTTP_AQUECER=0 desliga).
+
+GUNICORN_PRELOAD=0 volta a importar o app em cada worker.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+
+
+def post_worker_init(worker):
+    from main import aquecer_worker
+    aquecer_worker()
@@ -0,0 +1,63 @@
+# hedge_fallback.py
+"""
+Limiar do "hedge": quanto esperar pelo run do Assistant antes de disparar o
+fallback (Chat Completions) em paralelo. Acompanha as latências recentes dos runs
+e usa o percentil HEDGE_PERCENTIL, limitado a [HEDGE_LIMIAR_MIN_S, HEDGE_LIMIAR_MAX_S].
+"""
+import os, threading, logging
+from collections import deque
+
+log = logging.getLogger("hedge_fallback")
+
+HEDGE_ATIVO            = os.getenv("HEDGE_ATIVO", "0") == "1"
+HEDGE_PERCENTIL        = float(os.getenv("HEDGE_PERCENTIL", "0.95"))
+HEDGE_LIMIAR_INICIAL_S = float(os.getenv("HEDGE_LIMIAR_INICIAL_S", "10"))
+HEDGE_LIMIAR_MIN_S     = float(os.getenv("HEDGE_LIMIAR_MIN_S", "3"))
+HEDGE_LIMIAR_MAX_S     = float(os.getenv("HEDGE_LIMIAR_MAX_S", "20"))
+HEDGE_JANELA           = int(os.getenv("HEDGE_JANELA", "200"))        # latências guardadas
+HEDGE_AMOSTRAS_MIN     = int(os.getenv("HEDGE_AMOSTRAS_MIN", "20"))   # antes disso, limiar inicial
+
+
+class LimiarAdaptativo:
+    def __init__(self, percentil: float = HEDGE_PERCENTIL, inicial_s: float = HEDGE_LIMIAR_INICIAL_S,
+                 minimo_s: float = HEDGE_LIMIAR_MIN_S, maximo_s: float = HEDGE_LIMIAR_MAX_S,
+                 janela: int = HEDGE_JANELA, amostras_min: int = HEDGE_AMOSTRAS_MIN):
+        self.percentil = percentil
+        self.inicial_s = inicial_s
+        self.minimo_s = minimo_s
+        self.maximo_s = max(minimo_s, maximo_s)
+        self.amostras_min = amostras_min
+        self._latencias = deque(maxlen=max(1, janela))
+        self._lock = threading.Lock()
+        self.stats = {"disparos": 0, "vitorias_run": 0, "vitorias_fallback": 0, "ambos_falharam": 0}
+
+    def registrar(self, segundos: float):
+        """Latência de um run. Runs cancelados pelo hedge entram com o tempo até o cancelamento
+        (limite inferior), para o limiar não ficar otimista."""
+        with self._lock:
+            self._latencias.append(segundos)
+
+    def valor(self) -> float:
+        with self._lock:
+            if len(self._latencias) < self.amostras_min:
+                return self.inicial_s
+            ordenadas = sorted(self._latencias)
+        p = ordenadas[min(len(ordenadas) - 1, int(self.percentil * len(ordenadas)))]
+        return min(self.maximo_s, max(self.minimo_s, p))
+
+    def contar(self, evento: str):
+        with self._lock:
+            self.stats[evento] += 1
+
+    def descricao(self) -> str:
+        with self._lock:
+            n = len(self._latencias)
+        if n < self.amostras_min:
+            return f"inicial, {n} amostras"
+        return f"p{self.percentil * 100:.0f} de {n} amostras"
+
+    def metricas(self) -> dict:
+        with self._lock:
+            n = len(self._latencias)
+            stats = dict(self.stats)
+        return {"ativo": HEDGE_ATIVO, "limiar_s": round(self.valor(), 3), "amostras": n, **stats}
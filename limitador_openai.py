@@ -0,0 +1,365 @@
+# limitador_openai.py
+"""
+Orçamento de chamadas à OpenAI, comum ao texto, ao fallback e às imagens:
+
+  - baldes de requisições/min e tokens/min (token bucket); com OPENAI_LIMITE_DB
+    os baldes ficam num SQLite e todos os workers do gunicorn gastam do mesmo orçamento;
+  - no máximo OPENAI_MAX_CONCORRENCIA chamadas em andamento; com OPENAI_LIMITE_DB
+    o teto vale para a soma dos workers (cada vaga é uma linha em `vagas`, com prazo);
+  - fila justa por diálogo: quem espera é atendido em rodízio entre diálogos, então
+    um diálogo com várias mensagens não segura os demais;
+  - 429 / Retry-After / x-ratelimit-* vistos em qualquer resposta pausam ou
+    reajustam os baldes (gancho nas sessões do cliente_http).
+"""
+import os, re, time, uuid, asyncio, sqlite3, threading, logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+
+from armazenamento_sqlite import BancoCompartilhado
+from cliente_http import registrar_gancho_resposta
+
+log = logging.getLogger("limitador_openai")
+
+OPENAI_LIMITE_ATIVO     = os.getenv("OPENAI_LIMITE_ATIVO", "1") != "0"
+OPENAI_RPM              = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM              = float(os.getenv("OPENAI_TPM", "200000"))
+OPENAI_MAX_CONCORRENCIA = int(os.getenv("OPENAI_MAX_CONCORRENCIA", "8"))
+OPENAI_ESPERA_MAX_S     = float(os.getenv("OPENAI_ESPERA_MAX_S", "20"))
+# Tokens reservados por run do Assistant (instruções + trechos do file_search + resposta)
+OPENAI_TOKENS_RUN       = int(os.getenv("OPENAI_TOKENS_RUN", "3000"))
+OPENAI_LIMITE_DB        = os.getenv("OPENAI_LIMITE_DB", "")   # ex.: /var/data/limites.sqlite3
+_PAUSA_PADRAO_S = 2.0          # 429 sem Retry-After nem x-ratelimit-reset-*
+_ESPERA_ASYNC_MAX_S = 0.05     # no modo async, re-checa a fila com esta frequência
+_ESPERA_VAGA_DB_S = 0.05       # vagas todas com outros workers: re-checa o SQLite com esta frequência
+# Vaga de um worker que morreu no meio da chamada volta a contar como livre depois disso
+OPENAI_VAGA_TTL_S       = float(os.getenv("OPENAI_VAGA_TTL_S", "300"))
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS limites (
+    nome          TEXT PRIMARY KEY,
+    valor         REAL NOT NULL,
+    atualizado_em REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vagas (
+    id        TEXT PRIMARY KEY,
+    pid       INTEGER NOT NULL,
+    expira_em REAL NOT NULL
+);
+"""
+
+_RE_DURACAO = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_SEGUNDOS_UNIDADE = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class LimiteExcedido(Exception):
+    """Não houve vaga/orçamento dentro do prazo de espera."""
+
+
+def estimar_tokens(texto, resposta_max: int = 500) -> int:
+    """Estimativa grosseira (≈4 caracteres por token) + teto da resposta."""
+    return len(str(texto or "")) // 4 + resposta_max
+
+
+def _duracao_s(valor: str):
+    """'1s', '6m0s', '120ms' (x-ratelimit-reset-*) ou '3' (Retry-After) -> segundos."""
+    if not valor:
+        return None
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    partes = _RE_DURACAO.findall(valor)
+    if not partes:
+        return None
+    return sum(float(n) * _SEGUNDOS_UNIDADE[u] for n, u in partes)
+
+
+class LimitadorOpenAI:
+    def __init__(self, rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM,
+                 max_concorrencia: int = OPENAI_MAX_CONCORRENCIA, caminho_db: str = OPENAI_LIMITE_DB):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concorrencia = max(1, max_concorrencia)
+        self._cond = threading.Condition()
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        agora = time.time()
+        self._baldes = {"req": [rpm, agora], "tok": [tpm, agora], "pausa": [0.0, agora]}
+        self._fila = OrderedDict()   # dialog_id -> deque de tickets, na ordem de rodízio
+        self._em_uso = 0
+        self.stats = {"concedidas": 0, "esperaram": 0, "espera_total_s": 0.0, "recusadas": 0,
+                      "pausas": 0, "erros_db": 0}
+
+    # ---------- baldes ----------
+    def _capacidade(self, nome: str) -> float:
+        return self.rpm if nome == "req" else self.tpm
+
+    def _consumir(self, tokens: int, vaga_id: str) -> float:
+        """Tenta gastar 1 requisição + `tokens`. Retorna 0 se gastou, ou quantos segundos esperar."""
+        if self._db:
+            try:
+                return self._consumir_db(tokens, vaga_id)
+            except sqlite3.Error as e:
+                self.stats["erros_db"] += 1
+                log.warning(f"Limitador SQLite falhou ({e}); usando os baldes locais.")
+        return self._consumir_em(self._baldes, tokens, time.time())
+
+    def _consumir_em(self, baldes: dict, tokens: int, agora: float) -> float:
+        pausa = baldes["pausa"][0] - agora
+        if pausa > 0:
+            return pausa
+        pedidos = {"req": 1.0, "tok": float(min(tokens, self.tpm))}
+        espera = 0.0
+        for nome, pedido in pedidos.items():
+            cap = self._capacidade(nome)
+            valor, atualizado = baldes[nome]
+            valor = min(cap, valor + (agora - atualizado) * cap / 60.0)
+            baldes[nome] = [valor, agora]
+            if valor < pedido:
+                espera = max(espera, (pedido - valor) * 60.0 / cap)
+        if espera:
+            return espera
+        for nome, pedido in pedidos.items():
+            baldes[nome][0] -= pedido
+        return 0.0
+
+    def _transacao_db(self, fn):
+        with self._db.lock:
+            conn = self._db.conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                agora = time.time()
+                baldes = {n: [v, t] for n, v, t in conn.execute("SELECT nome, valor, atualizado_em FROM limites")}
+                for nome, padrao in (("req", self.rpm), ("tok", self.tpm), ("pausa", 0.0)):
+                    baldes.setdefault(nome, [padrao, agora])
+                resultado = fn(baldes, agora)
+                conn.executemany(
+                    "INSERT INTO limites(nome, valor, atualizado_em) VALUES (?, ?, ?) "
+                    "ON CONFLICT(nome) DO UPDATE SET valor=excluded.valor, atualizado_em=excluded.atualizado_em",
+                    [(n, v, t) for n, (v, t) in baldes.items()],
+                )
+                conn.execute("COMMIT")
+                return resultado
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _consumir_db(self, tokens: int, vaga_id: str) -> float:
+        def aplicar(baldes, agora):
+            conn = self._db.conn()   # a mesma conexão da transação (sob self._db.lock)
+            conn.execute("DELETE FROM vagas WHERE expira_em < ?", (agora,))
+            if conn.execute("SELECT COUNT(*) FROM vagas").fetchone()[0] >= self.max_concorrencia:
+                return _ESPERA_VAGA_DB_S   # todas as vagas estão com outros workers
+            espera = self._consumir_em(baldes, tokens, agora)
+            if not espera:
+                conn.execute("INSERT INTO vagas(id, pid, expira_em) VALUES (?, ?, ?)",
+                             (vaga_id, os.getpid(), agora + OPENAI_VAGA_TTL_S))
+            return espera
+        return self._transacao_db(aplicar)
+
+    def _soltar_vaga_db(self, vaga_id: str):
+        try:
+            with self._db.lock:
+                self._db.conn().execute("DELETE FROM vagas WHERE id = ?", (vaga_id,))
+        except sqlite3.Error as e:
+            self.stats["erros_db"] += 1   # a vaga vence sozinha em OPENAI_VAGA_TTL_S
+            log.warning(f"Limitador SQLite falhou ao liberar a vaga ({e}).")
+
+    def _vagas_em_uso_db(self):
+        try:
+            with self._db.lock:
+                return self._db.conn().execute("SELECT COUNT(*) FROM vagas WHERE expira_em >= ?",
+                                               (time.time(),)).fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def _ajustar(self, pausa_ate: float = None, restante_req=None, restante_tok=None):
+        def aplicar(baldes, agora):
+            if pausa_ate:
+                baldes["pausa"] = [max(baldes["pausa"][0], pausa_ate), agora]
+            if restante_req is not None:
+                baldes["req"][0] = min(baldes["req"][0], restante_req)
+            if restante_tok is not None:
+                baldes["tok"][0] = min(baldes["tok"][0], restante_tok)
+        with self._cond:
+            aplicar(self._baldes, time.time())
+            if self._db:
+                try:
+                    self._transacao_db(aplicar)
+                except sqlite3.Error as e:
+                    self.stats["erros_db"] += 1
+                    log.warning(f"Limitador SQLite falhou ao ajustar ({e}).")
+
+    def devolver_tokens(self, estimados: int, reais: int):
+        """Acerta o balde de tokens com o uso real informado pela API."""
+        if not OPENAI_LIMITE_ATIVO or reais is None:
+            return
+        def aplicar(baldes, agora):
+            baldes["tok"][0] = min(self.tpm, baldes["tok"][0] + estimados - reais)
+        with self._cond:
+            aplicar(self._baldes, time.time())
+            if self._db:
+                try:
+                    self._transacao_db(aplicar)
+                except sqlite3.Error:
+                    self.stats["erros_db"] += 1
+
+    # ---------- cabeçalhos da API ----------
+    def observar(self, status_code: int, headers):
+        """Gancho de resposta: 429/Retry-After pausam todos; x-ratelimit-* reajustam os baldes."""
+        agora = time.time()
+        restante_req = headers.get("x-ratelimit-remaining-requests")
+        restante_tok = headers.get("x-ratelimit-remaining-tokens")
+        pausa_s = None
+        if status_code == 429 or (status_code == 503 and headers.get("Retry-After")):
+            pausa_s = (_duracao_s(headers.get("Retry-After"))
+                       or _duracao_s(headers.get("x-ratelimit-reset-requests"))
+                       or _duracao_s(headers.get("x-ratelimit-reset-tokens"))
+                       or _PAUSA_PADRAO_S)
+        elif restante_req == "0":
+            pausa_s = _duracao_s(headers.get("x-ratelimit-reset-requests"))
+        elif restante_tok == "0":
+            pausa_s = _duracao_s(headers.get("x-ratelimit-reset-tokens"))
+        if pausa_s is None and restante_req is None and restante_tok is None:
+            return
+        if pausa_s:
+            self.stats["pausas"] += 1
+            log.warning(f"OpenAI pediu para esperar {pausa_s:.1f}s (HTTP {status_code}); pausando as chamadas.")
+        try:
+            self._ajustar(agora + pausa_s if pausa_s else None,
+                          float(restante_req) if restante_req else None,
+                          float(restante_tok) if restante_tok else None)
+        except ValueError:
+            pass
+
+    # ---------- fila justa ----------
+    def _enfileirar(self, dialog_id, ticket):
+        self._fila.setdefault(dialog_id, deque()).append(ticket)
+
+    def _sair_da_fila(self, dialog_id, ticket):
+        tickets = self._fila.get(dialog_id)
+        if tickets is None:
+            return
+        try:
+            tickets.remove(ticket)
+        except ValueError:
+            pass
+        if not tickets:
+            del self._fila[dialog_id]
+
+    def _e_a_vez(self, dialog_id, ticket) -> bool:
+        primeiro = next(iter(self._fila), None)
+        return primeiro == dialog_id and self._fila[dialog_id][0] is ticket
+
+    def _tentar(self, dialog_id, ticket, tokens: int, vaga_id: str):
+        """Sob self._cond. Retorna 0 se a vaga foi concedida, senão quanto esperar (None = até ser avisado)."""
+        if not self._e_a_vez(dialog_id, ticket) or self._em_uso >= self.max_concorrencia:
+            return None
+        espera = self._consumir(tokens, vaga_id)
+        if espera:
+            return espera
+        self._fila[dialog_id].popleft()
+        restantes = self._fila.pop(dialog_id)
+        if restantes:
+            self._fila[dialog_id] = restantes   # volta para o fim do rodízio
+        self._em_uso += 1
+        self.stats["concedidas"] += 1
+        self._cond.notify_all()
+        return 0
+
+    def _registrar_espera(self, t0: float):
+        espera = time.time() - t0
+        if espera > 0.01:
+            self.stats["esperaram"] += 1
+            self.stats["espera_total_s"] += espera
+
+    def _liberar(self, vaga_id: str):
+        if self._db:
+            self._soltar_vaga_db(vaga_id)
+        with self._cond:
+            self._em_uso -= 1
+            self._cond.notify_all()
+
+    def _desistir(self, dialog_id, ticket, espera_max_s: float):
+        self._sair_da_fila(dialog_id, ticket)
+        self.stats["recusadas"] += 1
+        self._cond.notify_all()
+        raise LimiteExcedido(f"Sem vaga na OpenAI em {espera_max_s:.1f}s (diálogo {dialog_id}).")
+
+    @contextmanager
+    def vaga(self, dialog_id=None, tokens: int = 0, espera_max_s: float = OPENAI_ESPERA_MAX_S):
+        """Segura uma vaga (concorrência + orçamento) durante a chamada. LimiteExcedido se não conseguir."""
+        if not OPENAI_LIMITE_ATIVO:
+            yield
+            return
+        t0 = time.time()
+        ticket = object()
+        vaga_id = uuid.uuid4().hex
+        with self._cond:
+            self._enfileirar(dialog_id, ticket)
+            while True:
+                espera = self._tentar(dialog_id, ticket, tokens, vaga_id)
+                if espera == 0:
+                    break
+                restante = espera_max_s - (time.time() - t0)
+                if restante <= 0:
+                    self._desistir(dialog_id, ticket, espera_max_s)
+                self._cond.wait(min(espera, restante) if espera else restante)
+            self._registrar_espera(t0)
+        try:
+            yield
+        finally:
+            self._liberar(vaga_id)
+
+    @asynccontextmanager
+    async def vaga_async(self, dialog_id=None, tokens: int = 0, espera_max_s: float = OPENAI_ESPERA_MAX_S):
+        """Igual a `vaga`, sem bloquear o event loop (re-checa a fila em intervalos curtos)."""
+        if not OPENAI_LIMITE_ATIVO:
+            yield
+            return
+        t0 = time.time()
+        ticket = object()
+        vaga_id = uuid.uuid4().hex
+        with self._cond:
+            self._enfileirar(dialog_id, ticket)
+        try:
+            while True:
+                with self._cond:
+                    espera = self._tentar(dialog_id, ticket, tokens, vaga_id)
+                    if espera == 0:
+                        self._registrar_espera(t0)
+                        break
+                    restante = espera_max_s - (time.time() - t0)
+                    if restante <= 0:
+                        self._desistir(dialog_id, ticket, espera_max_s)
+                await asyncio.sleep(min(espera or _ESPERA_ASYNC_MAX_S, restante, _ESPERA_ASYNC_MAX_S))
+        except asyncio.CancelledError:
+            with self._cond:
+                self._sair_da_fila(dialog_id, ticket)
+                self._cond.notify_all()
+            raise
+        try:
+            yield
+        finally:
+            self._liberar(vaga_id)
+
+    def metricas(self) -> dict:
+        em_uso_global = self._vagas_em_uso_db() if self._db else None
+        with self._cond:
+            pausa = self._baldes["pausa"][0] - time.time()
+            return {
+                "ativo": OPENAI_LIMITE_ATIVO,
+                "compartilhado": bool(self._db),
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "max_concorrencia": self.max_concorrencia,
+                "em_uso": self._em_uso,
+                "em_uso_global": em_uso_global,   # soma dos workers (só com OPENAI_LIMITE_DB)
+                "aguardando": sum(len(t) for t in self._fila.values()),
+                "dialogos_aguardando": len(self._fila),
+                "pausado_por_s": round(max(0.0, pausa), 2),
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()},
+            }
+
+
+limitador = LimitadorOpenAI()
+registrar_gancho_resposta("openai", limitador.observar)
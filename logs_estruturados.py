@@ -0,0 +1,180 @@
+# logs_estruturados.py
+"""
+Logs fora do caminho do request: o handler do root só enfileira o registro
+(QueueHandler, fila limitada, put_nowait) e uma thread (QueueListener) formata,
+redige e escreve. Fila cheia descarta o registro e conta; logar nunca bloqueia o
+/handler nem a fila de processamento.
+
+- JSON por linha (LOG_JSON=0 volta ao texto simples), com `evento`: id de
+  correlação do webhook, propagado para a fila de processamento e as tarefas async.
+- Mensagens acima de LOG_CAMPO_MAX caracteres são cortadas ainda no request;
+  chaves do webhook do Bitrix, tokens `auth[...]`, `sk-...` e `Bearer ...` são
+  trocados por `***` na thread de escrita.
+- Registros DEBUG (payload completo, corpo enviado ao Bitrix) passam por
+  amostragem: só LOG_AMOSTRA_DEBUG deles chegam à fila (com LOG_NIVEL=DEBUG).
+"""
+import os, re, sys, json, time, uuid, queue, atexit, random, logging, threading, contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_NIVEL         = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_JSON          = os.getenv("LOG_JSON", "1") != "0"
+LOG_FILA_MAX      = int(os.getenv("LOG_FILA_MAX", "10000"))
+LOG_CAMPO_MAX     = int(os.getenv("LOG_CAMPO_MAX", "2000"))       # caracteres por mensagem/traceback
+LOG_AMOSTRA_DEBUG = float(os.getenv("LOG_AMOSTRA_DEBUG", "0.05"))  # fração dos DEBUG mantida
+
+id_evento = contextvars.ContextVar("id_evento", default="-")
+
+_REDACOES = (
+    (re.compile(r"(/rest/\d+/)[A-Za-z0-9]{6,}"), r"\1***"),                       # chave do webhook
+    (re.compile(r"""(['"]auth\[\w+\]['"]\s*:\s*['"])[^'"]*"""), r"\1***"),        # auth[...] do payload
+    (re.compile(r"([?&](?:auth|token|access_token)=)[^&\s'\"]+"), r"\1***"),      # token na URL do anexo
+    (re.compile(r"\bsk-[A-Za-z0-9_\-]{8,}"), "sk-***"),
+    (re.compile(r"(Bearer\s+)\S+", re.I), r"\1***"),
+)
+
+# Atributos de todo LogRecord; o resto veio de `extra=` e vai como campo do JSON
+_CAMPOS_PADRAO = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "evento"}
+
+
+def novo_id_evento() -> str:
+    """Gera e ativa o id de correlação do evento atual (início do /handler)."""
+    valor = uuid.uuid4().hex[:12]
+    id_evento.set(valor)
+    return valor
+
+
+def redigir(texto: str) -> str:
+    for padrao, troca in _REDACOES:
+        texto = padrao.sub(troca, texto)
+    return texto
+
+
+def _cortar(texto: str, limite: int = LOG_CAMPO_MAX) -> str:
+    if len(texto) <= limite:
+        return texto
+    return f"{texto[:limite]}… (+{len(texto) - limite} caracteres)"
+
+
+class FormatadorJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        dados = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "nivel": record.levelname,
+            "logger": record.name,
+            "evento": getattr(record, "evento", "-"),
+            "msg": redigir(record.getMessage()),
+        }
+        for chave, valor in vars(record).items():
+            if chave not in _CAMPOS_PADRAO:
+                dados[chave] = redigir(_cortar(valor)) if isinstance(valor, str) else valor
+        if record.exc_info:
+            dados["exc"] = redigir(self.formatException(record.exc_info)[-LOG_CAMPO_MAX:])   # o fim é o que importa
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class FormatadorTexto(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:[%(evento)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        return redigir(super().format(record))
+
+
+class _FiltroAmostragem(logging.Filter):
+    def __init__(self, handler: "HandlerFila"):
+        super().__init__()
+        self.handler = handler
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or random.random() < LOG_AMOSTRA_DEBUG:
+            return True
+        self.handler._contar("fora_da_amostra")
+        return False
+
+
+class HandlerFila(QueueHandler):
+    """
+    QueueHandler com fila limitada que nunca bloqueia. A thread de escrita sobe no
+    primeiro registro de cada processo (funciona com `gunicorn --preload`).
+    """
+
+    def __init__(self, destino: logging.Handler, maxsize: int = LOG_FILA_MAX):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.destino = destino
+        self.maxsize = maxsize
+        self._lock_stats = threading.Lock()
+        self._pid = None
+        self._listener = None
+        self.stats = {"enfileirados": 0, "descartados": 0, "fora_da_amostra": 0}
+        self.addFilter(_FiltroAmostragem(self))
+
+    def _contar(self, chave: str):
+        with self._lock_stats:
+            self.stats[chave] += 1
+
+    def _garantir_listener(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock_stats:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # processo novo (fork): fila e thread do pai não valem aqui
+                self.queue = queue.Queue(maxsize=self.maxsize)
+            self._listener = QueueListener(self.queue, self.destino, respect_handler_level=True)
+            self._listener.start()
+            self._pid = pid
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # No thread do request: só fixa a mensagem (os args podem mudar depois), corta e marca o evento.
+        # Redação e JSON ficam para a thread de escrita.
+        record.evento = id_evento.get()
+        record.msg, record.args = _cortar(record.getMessage()), None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self._garantir_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._contar("descartados")
+            return
+        self._contar("enfileirados")
+
+    def parar(self):
+        """Esvazia a fila no encerramento do processo."""
+        if self._listener is None or self._pid != os.getpid():
+            return
+        try:
+            self._listener.stop()
+        except queue.Full:
+            pass
+
+    def metricas(self) -> dict:
+        with self._lock_stats:
+            return {**self.stats, "na_fila": self.queue.qsize(), "max": self.maxsize}
+
+
+_handler = None
+
+
+def configurar() -> HandlerFila:
+    """Troca os handlers do root pelo HandlerFila (idempotente; chamado no import do main)."""
+    global _handler
+    if _handler is not None:
+        return _handler
+    saida = logging.StreamHandler(sys.stderr)
+    saida.setFormatter(FormatadorJSON() if LOG_JSON else FormatadorTexto())
+    _handler = HandlerFila(saida)
+    raiz = logging.getLogger()
+    for h in list(raiz.handlers):
+        raiz.removeHandler(h)
+    raiz.addHandler(_handler)
+    raiz.setLevel(LOG_NIVEL)
+    atexit.register(_handler.parar)
+    return _handler
+
+
+def metricas() -> dict:
+    return _handler.metricas() if _handler else {}
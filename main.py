@@ -1,15 +1,30 @@
 import os
 import re
-import logging
-import requests
+import hmac
+import atexit
+import time
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, send_file
 
 # Suas funções existentes
-from processar_arquivo import processar_arquivo_do_bitrix
-from chamar_openai_com import chamar_openai_com  # Função separada
-
-logging.basicConfig(level=logging.INFO)
+from processar_arquivo import processar_arquivos_do_bitrix, cache_arquivos
+from chamar_openai_com import chamar_openai_com, cache_threads, limiar_hedge, memoria  # Função separada
+from fila_processamento import FilaProcessamento
+from cliente_http import sessao_bitrix, timeout, aquecer
+from cliente_assistants import OPENAI_BASE_URL
+from cache_respostas import CacheRespostas, RESP_CACHE_ATIVO
+from dedup_eventos import DeduplicadorEventos, DEDUP_ATIVO, chave_do_evento
+from agrupador_mensagens import AgrupadorMensagens, AGRUPAR_ATIVO
+from limitador_openai import limitador
+from disjuntor_openai import disjuntor
+from envio_bitrix import FilaEnvioBitrix
+from entrega_progressiva import EntregaProgressiva, EntregaProgressivaAsync, ENTREGA_PROGRESSIVA, teto as teto_entrega
+from metricas_prometheus import metricas, TIPO_CONTEUDO as TIPO_METRICAS
+import logs_estruturados
+from logs_estruturados import novo_id_evento
+from perfilador import perfil
+
+logs_estruturados.configurar()   # fila + thread de escrita: logar não bloqueia o request
 app = Flask(__name__)
 
 # =========================
@@ -20,6 +35,12 @@ HABILITAR_RESTRICAO_HORARIO = False
 BOT_NAME = "Ana Lis - Agente IA"
 BOT_COLOR = "ORANGE"
 WELCOME_MESSAGE = "Olá! Sou a Ana Lis - Agente IA, sua assistente virtual. Como posso te ajudar?"
+MENSAGEM_LIMITE = (
+    "Ana Lis - Agente IA está disponível das 06:30 às 18:00. "
+    "Por favor, retorne nesse horário 😊"
+)
+MSG_OCUPADO = "⚠️ Estou com muitas conversas agora. Por favor, envie sua mensagem novamente em instantes."
+EVENTOS_TRATADOS = ("ONIMBOTMESSAGEADD", "ONIMBOTJOINCHAT", "ONIMBOTDELETE", "ONIMBOTWELCOMEMESSAGE")
 
 PUBLIC_URL = os.getenv("PUBLIC_URL", "https://lis-v2-bot.onrender.com")
 
@@ -37,6 +58,27 @@ BITRIX_WEBHOOK_SEND = os.getenv("BITRIX_WEBHOOK_SEND", BITRIX_WEBHOOK).rstrip("/
 # Enviar como BOT
 BOT_ID = os.getenv("BOT_ID", "136")  # defina no Render se precisar
 
+# Processa IA + envio fora da requisição (responde 200 ao Bitrix na hora).
+# PROCESSAMENTO_ASSINCRONO=0 volta ao modo antigo (tudo dentro do request).
+PROCESSAMENTO_ASSINCRONO = os.getenv("PROCESSAMENTO_ASSINCRONO", "1") != "0"
+fila = FilaProcessamento()
+
+# Cache de respostas para perguntas repetidas (ver cache_respostas.py)
+cache_respostas = CacheRespostas()
+
+# Reentregas do mesmo evento pelo Bitrix não geram outro run (ver dedup_eventos.py)
+dedup = DeduplicadorEventos()
+
+# Mensagens picadas do mesmo diálogo viram uma pergunta só (ver agrupador_mensagens.py)
+agrupador = AgrupadorMensagens(despachar=lambda dialog_id, texto: _despachar_grupo(dialog_id, texto))
+
+# Tudo que vai para o Bitrix sai em lotes (`batch`), com repetição e ordem por diálogo (ver envio_bitrix.py)
+fila_bitrix = FilaEnvioBitrix(BITRIX_WEBHOOK_SEND)
+atexit.register(fila_bitrix.drenar)
+
+# Token das rotas /admin/* (header X-Admin-Token). Sem token configurado, elas ficam fechadas.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 # =========================
 # Utilitários
 # =========================
@@ -66,50 +108,79 @@ def _flatten_form_all(form):
                 out[k] = form.get(k)
     return out
 
+def _token_admin_valido(enviado: str) -> bool:
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(enviado or "", ADMIN_TOKEN)
+
+def _admin_autorizado() -> bool:
+    return _token_admin_valido(request.headers.get("X-Admin-Token", ""))
+
+def _perfil_forcado():
+    """Modo pedido no header X-Perfil de um /handler reenviado à mão (só com X-Admin-Token válido)."""
+    modo = request.headers.get("X-Perfil")
+    return modo if modo and _admin_autorizado() else None
+
+def _eh_resposta_de_erro(resposta) -> bool:
+    return not isinstance(resposta, str) or resposta.startswith(("❗", "⚠️", "❌"))
+
+def _resposta_do_cache(text: str):
+    if not RESP_CACHE_ATIVO:
+        return None
+    resposta = cache_respostas.obter(text)
+    if resposta is not None:
+        app.logger.info("⚡ Resposta servida do cache.")
+    return resposta
+
+def _guardar_resposta(text: str, resposta):
+    if RESP_CACHE_ATIVO and not _eh_resposta_de_erro(resposta):
+        cache_respostas.guardar(text, resposta)
+
+def _responder_texto(dialog_id: str, text: str, ao_texto=None) -> str:
+    """Cache de respostas na frente do assistant; só respostas válidas entram no cache."""
+    resposta = _resposta_do_cache(text)
+    if resposta is not None:
+        return resposta
+    resposta = limpar_marcadores_de_citacao(chamar_openai_com(text, dialog_id=dialog_id, ao_texto=ao_texto))
+    _guardar_resposta(text, resposta)
+    return resposta
+
 def _pick(keys, d):
     for k in keys:
         if k in d and d[k]:
             return d[k]
     return None
 
-def _send_imbot_message(dialog_id: str, text: str):
-    """
-    Envia mensagem como o BOT via imbot.message.add.
-    IMPORTANTE: NÃO envie CLIENT_ID aqui. O Bitrix usa o token do webhook para validar a app.
-    """
-    if not BOT_ID:
-        raise RuntimeError("BOT_ID não configurado. Defina a env BOT_ID.")
-    url = f"{BITRIX_WEBHOOK_SEND}/imbot.message.add.json"
-    body = {
-        "BOT_ID": BOT_ID,
-        "DIALOG_ID": dialog_id,
-        "CLIENT_ID": "1",
-        "MESSAGE": text
-    }
-    app.logger.info(f"[imbot.message.add] POST {url} body={body}")
-    r = requests.post(url, json=body, headers={"Content-Type": "application/json"}, timeout=15)
-    app.logger.info(f"[imbot.message.add] status={r.status_code} resp={r.text[:400]}")
-    return r
-
-# =========================
-# Rotas
-# =========================
-@app.route("/", methods=["GET"])
-def home():
-    return "Ana Lis - Agente IA está online!"
-
-@app.route("/install", methods=["POST"])
-def install():
-    """
-    Registra o bot informando os endpoints (sem CLIENT_ID no registro).
-    """
-    data = request.args.to_dict()
-    app.logger.info(f"📦 Dados recebidos na instalação: {data}")
-
+def _interpretar_evento(payload: dict):
+    """Extrai (evento, dialog_id, texto, arquivos) do payload do Bitrix; arquivos = [(url, nome), ...]."""
+    evt = (payload.get("event") or payload.get("EVENT") or "").upper()
+    dialog_id = _pick([
+        "data[PARAMS][DIALOG_ID]", "data[DIALOG_ID]", "DIALOG_ID",
+        "data[PARAMS][CHAT_ID]", "CHAT_ID"
+    ], payload)
+    text = _pick(["data[PARAMS][MESSAGE]", "data[MESSAGE]", "MESSAGE"], payload) or ""
+
+    # Detecta todos os anexos (FILES[id]), na ordem do payload
+    arquivos = []
+    for k, v in payload.items():
+        if isinstance(k, str) and k.endswith("][urlDownload]") and "data[PARAMS][FILES][" in k and v:
+            i = k.find("[FILES][") + 8
+            j = k.find("]", i)
+            file_id = k[i:j]
+            arquivos.append((v, payload.get(f"data[PARAMS][FILES][{file_id}][name]", "arquivo_desconhecido")))
+    return evt, dialog_id, text, arquivos
+
+def _fora_do_horario() -> bool:
+    if not HABILITAR_RESTRICAO_HORARIO:
+        return False
+    hora = datetime.now().hour
+    minuto = datetime.now().minute
+    return hora < 6 or (hora == 6 and minuto < 30) or hora >= 23
+
+def _registro_do_bot(data: dict):
+    """(URL do imbot.register, payload) para o /install; (None, None) sem DOMAIN."""
     domain = data.get("DOMAIN")
     protocol = "https" if data.get("PROTOCOL") == "1" else "http"
     if not domain:
-        return jsonify({"erro": "Domain não especificado", "status": "Erro interno"}), 500
+        return None, None
 
     # tenta extrair a chave do webhook da env BITRIX_WEBHOOK (se existir)
     webhook_key_from_env = None
@@ -135,9 +206,236 @@ def install():
             "COLOR": BOT_COLOR
         }
     }
+    return webhook_url, payload
+
+def _registrar_evento(payload: dict, dialog_id: str, text: str, arquivos):
+    """
+    Registra o evento de mensagem no deduplicador. Retorna (novo, chave); `chave`
+    deve ser liberada se o evento acabar recusado (fila cheia).
+    """
+    if not DEDUP_ATIVO:
+        return True, None
+    urls = "\n".join(url for url, _ in arquivos) or None
+    chave, ttl_s = chave_do_evento(payload, dialog_id, text, urls)
+    if chave is None:
+        return True, None
+    if not dedup.registrar(chave, ttl_s):
+        app.logger.info(f"🔁 Evento repetido ignorado ({chave}).")
+        return False, chave
+    return True, chave
+
+def _corpo_imbot(dialog_id: str, text: str):
+    if not BOT_ID:
+        raise RuntimeError("BOT_ID não configurado. Defina a env BOT_ID.")
+    return {
+        "BOT_ID": BOT_ID,
+        "DIALOG_ID": dialog_id,
+        "CLIENT_ID": "1",
+        "MESSAGE": text
+    }
+
+def _send_imbot_message(dialog_id: str, text: str):
+    """
+    Envia mensagem como o BOT via imbot.message.add, pela fila de saída (batch).
+    Não espera: devolve o Future com o MESSAGE_ID. Falhas definitivas são logadas pela fila.
+    """
+    body = _corpo_imbot(dialog_id, text)
+    app.logger.debug("[imbot.message.add] enfileirado body=%s", body)
+    return fila_bitrix.enviar("imbot.message.add", body, dialog_id)
+
+async def _send_imbot_message_async(dialog_id: str, text: str):
+    """_send_imbot_message para o app_async (enfileirar não bloqueia o event loop)."""
+    return _send_imbot_message(dialog_id, text)
+
+def _chamar_bitrix(metodo: str, body: dict, dialog_id: str = None, esperar: bool = True):
+    """
+    Chamada REST pela fila de saída. Com `esperar`, aguarda o resultado (levanta ErroBitrix);
+    sem, devolve o Future do `result`.
+    """
+    dialog_id = dialog_id or body.get("DIALOG_ID")
+    if not esperar:
+        return fila_bitrix.enviar(metodo, body, dialog_id)
+    return {"result": fila_bitrix.chamar(metodo, body, dialog_id)}
+
+async def _chamar_bitrix_async(metodo: str, body: dict, dialog_id: str = None, esperar: bool = True):
+    dialog_id = dialog_id or body.get("DIALOG_ID")
+    if not esperar:
+        fila_bitrix.enviar(metodo, body, dialog_id)
+        return None
+    return {"result": await fila_bitrix.chamar_async(metodo, body, dialog_id)}
+
+def _nova_entrega(dialog_id: str):
+    """Entrega progressiva (digitando + mensagem atualizada no lugar), se ativada."""
+    if not ENTREGA_PROGRESSIVA:
+        return None
+    return EntregaProgressiva(dialog_id, BOT_ID, _chamar_bitrix, formatar=limpar_marcadores_de_citacao)
+
+def _enviar_seguro(dialog_id: str, text: str, contexto: str):
+    try:
+        _send_imbot_message(dialog_id, text)
+    except Exception as e:
+        app.logger.error(f"Falha ao enviar {contexto}: {e}")
+
+def _processar_mensagem(dialog_id: str, text: str, arquivos=None):
+    """
+    Parte pesada do /handler: gera a resposta (IA ou fallback) e envia ao Bitrix.
+    Roda na fila de processamento (ou inline, se PROCESSAMENTO_ASSINCRONO=0).
+    """
+    with metricas.medir("processamento_total"):
+        _gerar_e_enviar(dialog_id, text, arquivos)
+
+def _gerar_e_enviar(dialog_id: str, text: str, arquivos=None):
+    entrega = _nova_entrega(dialog_id)
+    if entrega:
+        entrega.digitando()
+
+    # 7) Gera resposta (IA ou fallback)
+    if arquivos:
+        app.logger.info(f"📂 {len(arquivos)} arquivo(s) detectado(s)! Enviando ao processador de arquivo...")
+        try:
+            with metricas.medir("resposta_arquivo"):
+                resposta_ia = processar_arquivos_do_bitrix(arquivos, dialog_id)
+        except Exception as e:
+            app.logger.error(f"processar_arquivos_do_bitrix erro: {e}")
+            resposta_ia = "❌ O tipo de arquivo não é reconhecido como imagem compatível para análise."
+    elif text:
+        app.logger.info("💬 Mensagem de texto detectada! Enviando ao GPT...")
+        try:
+            with metricas.medir("resposta_texto"):
+                resposta_ia = _responder_texto(dialog_id, text, ao_texto=entrega.parcial if entrega else None)
+        except Exception as e:
+            app.logger.error(f"chamar_openai_com erro: {e}")
+            resposta_ia = "❗Erro ao processar com a IA. Tente novamente."
+    else:
+        resposta_ia = "❗Mensagem vazia ou sem arquivo. Por favor, envie um texto ou anexo válido."
+
+    # 8) Envia ao Bitrix (como BOT, com BOT_ID e CLIENT_ID se exigido pelo tenant)
+    if entrega is None:
+        _enviar_seguro(dialog_id, resposta_ia, "ao Bitrix")
+        return
+    try:
+        entrega.finalizar(resposta_ia)
+    except Exception as e:
+        app.logger.error(f"Falha ao enviar ao Bitrix: {e}")
+
+def _despachar(fn, *args):
+    """Enfileira `fn` (ou executa inline). Retorna False se a fila recusou por estar cheia."""
+    fn = perfil.envolver(fn, "processamento")   # request em captura: a tarefa entra no mesmo perfil
+    if not PROCESSAMENTO_ASSINCRONO:
+        fn(*args)
+        return True
+    if fila.enviar(fn, *args):
+        return True
+    perfil.cancelar(fn)
+    return False
+
+def _despachar_grupo(dialog_id: str, texto: str):
+    """Chamado pela thread do agrupador quando um grupo fecha (o Bitrix já recebeu 200)."""
+    novo_id_evento()   # grupo fechado na thread do agrupador: evento próprio nos logs
+    if not _despachar(_processar_mensagem, dialog_id, texto):
+        app.logger.error(f"Fila cheia: grupo de mensagens do diálogo {dialog_id} descartado.")
+        _enviar_seguro(dialog_id, MSG_OCUPADO, "aviso de fila cheia")
+
+def _resposta_fila_cheia():
+    resp = jsonify({"status": "ocupado"})
+    resp.headers["Retry-After"] = "5"
+    return resp, 503
+
+# =========================
+# Rotas
+# =========================
+@app.before_request
+def _marcar_inicio():
+    g.t0 = time.perf_counter()
+    novo_id_evento()
+
+@app.after_request
+def _medir_handler(resp):
+    """Tempo de resposta do /handler ao Bitrix e desfecho (status do JSON devolvido)."""
+    if request.path == "/handler" and "t0" in g:
+        metricas.etapa("handler", time.perf_counter() - g.t0)
+        corpo = resp.get_json(silent=True) if resp.is_json else None
+        metricas.contar("lis_handler_total", desfecho=(corpo or {}).get("status", str(resp.status_code)))
+    return resp
+
+@app.route("/", methods=["GET"])
+def home():
+    return "Ana Lis - Agente IA está online!"
+
+@app.route("/status/fila", methods=["GET"])
+def status_fila():
+    return jsonify({"assincrono": PROCESSAMENTO_ASSINCRONO, **fila.metricas(), "dedup": dedup.metricas(),
+                    "agrupamento": agrupador.metricas(), "openai": limitador.metricas(),
+                    "hedge": limiar_hedge.metricas(),
+                    "entrega": teto_entrega.metricas(),
+                    "envio_bitrix": fila_bitrix.metricas(), "logs": logs_estruturados.metricas()})
+
+@app.route("/status/disjuntor", methods=["GET"])
+def status_disjuntor():
+    return jsonify(disjuntor.metricas())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Histogramas por etapa e contadores no formato do Prometheus (somados entre workers com METRICAS_DB)."""
+    return metricas.texto(), 200, {"Content-Type": TIPO_METRICAS}
+
+@app.route("/status/cache", methods=["GET"])
+def status_cache():
+    return jsonify({
+        "respostas": cache_respostas.metricas(),
+        "threads": cache_threads.metricas(),
+        "memoria": memoria.metricas(),
+        "arquivos": cache_arquivos.metricas(),
+    })
+
+@app.route("/admin/cache/invalidar", methods=["POST"])
+def admin_invalidar_cache():
+    """Esvazia o cache de respostas (ex.: depois de atualizar os arquivos/instruções do assistant)."""
+    if not _admin_autorizado():
+        return jsonify({"erro": "não autorizado"}), 401
+    cache_respostas.invalidar()
+    return jsonify({"status": "cache_invalidado"})
+
+@app.route("/admin/perfil", methods=["GET", "POST"])
+def admin_perfil():
+    """
+    POST ?n=5&modo=cprofile|amostragem: perfila os próximos n /handler deste worker (n=0 desarma).
+    GET: estado e capturas gravadas (ver perfilador.py).
+    """
+    if not _admin_autorizado():
+        return jsonify({"erro": "não autorizado"}), 401
+    if request.method == "POST":
+        try:
+            return jsonify({"status": "armado", **perfil.armar(request.values.get("n", "1"),
+                                                                request.values.get("modo"))})
+        except ValueError as e:
+            return jsonify({"erro": str(e)}), 400
+    return jsonify({**perfil.metricas(), "capturas": perfil.listar()})
+
+@app.route("/admin/perfil/<arquivo>", methods=["GET"])
+def admin_perfil_arquivo(arquivo):
+    """Download de uma captura (.prof, .folded ou o .json de resumo)."""
+    if not _admin_autorizado():
+        return jsonify({"erro": "não autorizado"}), 401
+    caminho = perfil.caminho(arquivo)
+    if caminho is None:
+        return jsonify({"erro": "captura não encontrada"}), 404
+    return send_file(caminho, as_attachment=True, download_name=arquivo)
+
+@app.route("/install", methods=["POST"])
+def install():
+    """
+    Registra o bot informando os endpoints (sem CLIENT_ID no registro).
+    """
+    data = request.args.to_dict()
+    app.logger.info(f"📦 Dados recebidos na instalação: {data}")
+
+    webhook_url, payload = _registro_do_bot(data)
+    if not webhook_url:
+        return jsonify({"erro": "Domain não especificado", "status": "Erro interno"}), 500
 
     try:
-        response = requests.post(webhook_url, json=payload, timeout=20)
+        response = sessao_bitrix().post(webhook_url, json=payload, timeout=timeout(20))
         try:
             bitrix_result = response.json()
         except Exception:
@@ -150,107 +448,94 @@ def install():
 
 @app.route('/handler', methods=['POST'])
 def bitrix_handler():
+    captura = perfil.pedir(_perfil_forcado())
+    if captura is None:
+        return _tratar_handler()
+    with perfil.trecho(captura, "handler"):
+        return _tratar_handler()
+
+def _tratar_handler():
     """
     ÚNICO handler:
     - Aceita JSON e x-www-form-urlencoded
     - Checa horário primeiro; se fora, responde e sai
     - Se for evento de boas-vindas, envia WELCOME_MESSAGE e sai
     - Caso contrário, processa texto/arquivo, chama a IA e responde como BOT (BOT_ID + CLIENT_ID quando necessário)
+    - Envios e chamadas à IA vão para a fila de processamento; o Bitrix recebe 200 na hora
+      (503 + Retry-After se a fila estiver cheia)
     """
     try:
         # 1) Normaliza payload
-        payload = request.get_json(silent=True)
-        if not payload:
-            payload = _flatten_form_all(request.form)
+        with metricas.medir("payload_parse"):
+            payload = request.get_json(silent=True)
+            if not payload:
+                payload = _flatten_form_all(request.form)
 
-        app.logger.info(f"[HANDLER] ct={request.headers.get('Content-Type','')}")
-        app.logger.info(f"[HANDLER] payload={payload}")
+        app.logger.debug("[HANDLER] ct=%s payload=%s", request.headers.get("Content-Type", ""), payload)
 
         # 2) Evento + IDs
-        evt = (payload.get("event") or payload.get("EVENT") or "").upper()
-        dialog_id = _pick([
-            "data[PARAMS][DIALOG_ID]", "data[DIALOG_ID]", "DIALOG_ID",
-            "data[PARAMS][CHAT_ID]", "CHAT_ID"
-        ], payload)
-        text = _pick(["data[PARAMS][MESSAGE]", "data[MESSAGE]", "MESSAGE"], payload) or ""
+        evt, dialog_id, text, arquivos = _interpretar_evento(payload)
+        app.logger.info(f"[HANDLER] evt={evt} dialog={dialog_id} texto={len(text)} chars anexos={len(arquivos)}")
 
         if not dialog_id:
             return jsonify({"status": "no_dialog"}), 200
 
         # 3) Horário primeiro (vale para welcome e mensagens)
-        if HABILITAR_RESTRICAO_HORARIO:
-            hora = datetime.now().hour
-            minuto = datetime.now().minute
-            if hora < 6 or (hora == 6 and minuto < 30) or hora >= 23:
-                mensagem_limite = (
-                    "Ana Lis - Agente IA está disponível das 06:30 às 18:00. "
-                    "Por favor, retorne nesse horário 😊"
-                )
-                try:
-                    _send_imbot_message(dialog_id, mensagem_limite)
-                except Exception as e:
-                    app.logger.error(f"Falha ao enviar msg de limite: {e}")
-                return jsonify({"status": "fora_do_horario"}), 200
+        if _fora_do_horario():
+            if not _despachar(_enviar_seguro, dialog_id, MENSAGEM_LIMITE, "msg de limite"):
+                return _resposta_fila_cheia()
+            return jsonify({"status": "fora_do_horario"}), 200
 
         # 4) Welcome DEPOIS de checar horário e ANTES de chamar a IA
         if evt in ("ONIMBOTJOINCHAT", "ONIMBOTWELCOMEMESSAGE"):
-            try:
-                _send_imbot_message(dialog_id, WELCOME_MESSAGE)
-            except Exception as e:
-                app.logger.error(f"Falha ao enviar welcome: {e}")
+            if not _despachar(_enviar_seguro, dialog_id, WELCOME_MESSAGE, "welcome"):
+                return _resposta_fila_cheia()
             return jsonify({"status": "welcome_sent"}), 200
 
         # 5) Ignore eventos que não nos interessam
-        if evt not in ("ONIMBOTMESSAGEADD", "ONIMBOTJOINCHAT", "ONIMBOTDELETE", "ONIMBOTWELCOMEMESSAGE"):
+        if evt not in EVENTOS_TRATADOS:
             return jsonify({"status": "ignored", "event": evt}), 200
 
-        # 6) Detecta arquivo (mantém sua lógica)
-        arquivo_url = None
-        arquivo_nome = None
-        if isinstance(payload, dict):
-            for k, v in payload.items():
-                if isinstance(k, str) and k.endswith("][urlDownload]") and "data[PARAMS][FILES][" in k:
-                    arquivo_url = v
-                    i = k.find("FILES[") + 6
-                    j = k.find("]", i)
-                    file_id = k[i:j]
-                    arquivo_nome = payload.get(f"data[PARAMS][FILES][{file_id}][name]", "arquivo_desconhecido")
-                    break
-
-        # 7) Gera resposta (IA ou fallback)
-        if arquivo_url and arquivo_nome:
-            app.logger.info("📂 Arquivo detectado! Enviando ao processador de arquivo...")
-            try:
-                resposta_ia = processar_arquivo_do_bitrix(arquivo_url, arquivo_nome)
-            except Exception as e:
-                app.logger.error(f"processar_arquivo_do_bitrix erro: {e}")
-                resposta_ia = "❌ O tipo de arquivo não é reconhecido como imagem compatível para análise."
-        elif text:
-            app.logger.info("💬 Mensagem de texto detectada! Enviando ao GPT...")
-            try:
-                resposta_ia = chamar_openai_com(text)
-            except Exception as e:
-                app.logger.error(f"chamar_openai_com erro: {e}")
-                resposta_ia = "❗Erro ao processar com a IA. Tente novamente."
-            resposta_ia = limpar_marcadores_de_citacao(resposta_ia)
-        else:
-            resposta_ia = "❗Mensagem vazia ou sem arquivo. Por favor, envie um texto ou anexo válido."
-
-        # 8) Envia ao Bitrix (como BOT, com BOT_ID e CLIENT_ID se exigido pelo tenant)
-        try:
-            _send_imbot_message(dialog_id, resposta_ia)
-        except Exception as e:
-            app.logger.error(f"Falha ao enviar ao Bitrix: {e}")
+        # 6) Reentrega do Bitrix (mesma mensagem): 200 sem chamar a IA de novo
+        novo, chave = _registrar_evento(payload, dialog_id, text, arquivos)
+        if not novo:
+            return jsonify({"status": "duplicado"}), 200
 
-        return jsonify({"status": "ok"}), 200
+        # 6b) Texto puro: espera o usuário terminar de digitar (AGRUPAR_ATIVO=1)
+        if AGRUPAR_ATIVO and text and not arquivos:
+            agrupador.enviar(dialog_id, text)
+            return jsonify({"status": "agrupando"}), 200
+        if AGRUPAR_ATIVO:
+            pendente = agrupador.retirar(dialog_id)   # texto antes do anexo sai primeiro
+            if pendente:
+                _despachar_grupo(dialog_id, pendente)
+
+        # 7+8) IA e envio ao Bitrix fora da requisição
+        if not _despachar(_processar_mensagem, dialog_id, text, arquivos):
+            if chave:
+                dedup.liberar(chave)
+            return _resposta_fila_cheia()
+
+        return jsonify({"status": "enfileirado" if PROCESSAMENTO_ASSINCRONO else "ok"}), 200
 
     except Exception as e:
         app.logger.error(f"Erro no /handler: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# =========================
+# Partida
+# =========================
+def _destinos_aquecimento() -> dict:
+    return {"openai": OPENAI_BASE_URL, "bitrix": BITRIX_WEBHOOK_SEND}
+
+def aquecer_worker():
+    """Warm-up do worker recém-criado (gunicorn.conf.py: post_worker_init)."""
+    aquecer(_destinos_aquecimento())
+
 # =========================
 # Run
 # =========================
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    aquecer_worker()
     app.run(host="0.0.0.0", port=port)
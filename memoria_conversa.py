@@ -0,0 +1,252 @@
+# memoria_conversa.py
+"""
+Memória curta por diálogo para o fallback (Chat Completions), que não tem a
+thread do assistant: sem ela o usuário perde todo o contexto quando a
+Assistants API falha ou o hedge dispara.
+
+Cada diálogo guarda as últimas mensagens (usuário/assistente) dentro de
+MEMORIA_TOKENS. Ao estourar o orçamento, as trocas mais antigas saem da
+janela e viram uma linha do resumo ("U: ... → A: ..."), cortada localmente,
+sem chamada extra ao modelo; o resumo também tem teto (MEMORIA_RESUMO_TOKENS)
+e perde primeiro as linhas mais velhas. O prompt do fallback fica limitado a
+~MEMORIA_TOKENS + MEMORIA_RESUMO_TOKENS, por mais longa que seja a conversa.
+
+LRU entre diálogos (MEMORIA_MAX_DIALOGOS) e TTL de ociosidade. Com MEMORIA_DB
+o histórico fica num SQLite compartilhado: sobrevive a restart e todos os
+workers veem as mesmas conversas. Se o SQLite falhar (ex.: "database is
+locked"), a troca segue sem histórico em vez de derrubar a resposta.
+"""
+import os, re, time, json, sqlite3, threading, logging
+from array import array
+from collections import OrderedDict
+
+from armazenamento_sqlite import BancoCompartilhado
+from limitador_openai import estimar_tokens
+
+log = logging.getLogger("memoria_conversa")
+
+MEMORIA_ATIVA         = os.getenv("MEMORIA_ATIVA", "1") != "0"
+MEMORIA_MAX_DIALOGOS  = int(os.getenv("MEMORIA_MAX_DIALOGOS", "2000"))
+MEMORIA_TOKENS        = int(os.getenv("MEMORIA_TOKENS", "1200"))          # janela de mensagens literais
+MEMORIA_RESUMO_TOKENS = int(os.getenv("MEMORIA_RESUMO_TOKENS", "300"))    # resumo das trocas antigas
+MEMORIA_TTL_S         = float(os.getenv("MEMORIA_TTL_S", str(12 * 3600)))  # ociosidade
+MEMORIA_DB            = os.getenv("MEMORIA_DB", "")                        # ex.: /var/data/memoria.sqlite3
+_RESUMO_CARACTERES = 120   # por lado de cada troca resumida
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS memoria (
+    dialog_id TEXT PRIMARY KEY,
+    dados     TEXT NOT NULL,
+    usado_em  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memoria_usado_em ON memoria(usado_em);
+"""
+
+_RE_ESPACOS = re.compile(r"\s+")
+
+
+def _tokens(texto: str) -> int:
+    return estimar_tokens(texto, 0) + 4   # + papel/separadores da mensagem
+
+
+def _encurtar(texto: str) -> str:
+    texto = _RE_ESPACOS.sub(" ", texto).strip()
+    return texto if len(texto) <= _RESUMO_CARACTERES else texto[:_RESUMO_CARACTERES - 1] + "…"
+
+
+class _Historico:
+    """
+    Mensagens de um diálogo em listas paralelas (texto, papel em `array('b')`,
+    tokens em `array('H')`) e o total mantido incrementalmente: somar a janela
+    não percorre as mensagens.
+    """
+    __slots__ = ("textos", "papeis", "tokens", "total", "resumo", "tokens_resumo", "usado_em")
+
+    USUARIO, ASSISTENTE = 0, 1
+
+    def __init__(self):
+        self.textos = []
+        self.papeis = array("b")
+        self.tokens = array("H")
+        self.total = 0
+        self.resumo = []          # linhas "U: ... → A: ...", da mais antiga para a mais nova
+        self.tokens_resumo = 0
+        self.usado_em = time.time()
+
+    def adicionar(self, papel: int, texto: str):
+        n = min(_tokens(texto), 0xFFFF)
+        self.textos.append(texto)
+        self.papeis.append(papel)
+        self.tokens.append(n)
+        self.total += n
+
+    def compactar(self, orcamento: int, orcamento_resumo: int) -> int:
+        """Tira as mensagens mais antigas da janela até caber no orçamento. Retorna quantas saíram."""
+        saiu = 0
+        while self.total > orcamento and len(self.textos) > 1:
+            # a troca mais antiga (usuário + resposta) vira uma linha do resumo
+            fim = 2 if len(self.papeis) > 1 and self.papeis[0] == self.USUARIO \
+                and self.papeis[1] == self.ASSISTENTE else 1
+            partes = [("U: " if p == self.USUARIO else "A: ") + _encurtar(t)
+                      for p, t in zip(self.papeis[:fim], self.textos[:fim])]
+            self._resumir(" → ".join(partes), orcamento_resumo)
+            self.total -= sum(self.tokens[:fim])
+            del self.textos[:fim], self.papeis[:fim], self.tokens[:fim]
+            saiu += fim
+        if self.total > orcamento and self.textos:
+            # uma mensagem sozinha maior que a janela: fica só o começo
+            self.textos[0] = self.textos[0][:max(0, orcamento - 4) * 4] + "…"
+            self.total = self.tokens[0] = _tokens(self.textos[0])
+        return saiu
+
+    def _resumir(self, linha: str, orcamento_resumo: int):
+        self.resumo.append(linha)
+        self.tokens_resumo += _tokens(linha)
+        while self.tokens_resumo > orcamento_resumo and self.resumo:
+            self.tokens_resumo -= _tokens(self.resumo.pop(0))
+
+    def mensagens(self) -> list:
+        """Mensagens no formato do Chat Completions: resumo (se houver) + janela recente."""
+        msgs = []
+        if self.resumo:
+            msgs.append({"role": "system", "content": "Resumo do início desta conversa:\n" + "\n".join(self.resumo)})
+        msgs += [{"role": "user" if p == self.USUARIO else "assistant", "content": t}
+                 for p, t in zip(self.papeis, self.textos)]
+        return msgs
+
+    def para_json(self) -> str:
+        return json.dumps({"t": self.textos, "p": list(self.papeis), "r": self.resumo}, ensure_ascii=False)
+
+    @classmethod
+    def de_json(cls, dados: str, usado_em: float) -> "_Historico":
+        d = json.loads(dados)
+        h = cls()
+        for papel, texto in zip(d["p"], d["t"]):
+            h.adicionar(papel, texto)
+        h.resumo = d["r"]
+        h.tokens_resumo = sum(_tokens(linha) for linha in h.resumo)
+        h.usado_em = usado_em
+        return h
+
+
+class MemoriaConversa:
+    def __init__(self, max_dialogos: int = MEMORIA_MAX_DIALOGOS, orcamento: int = MEMORIA_TOKENS,
+                 orcamento_resumo: int = MEMORIA_RESUMO_TOKENS, ttl_s: float = MEMORIA_TTL_S,
+                 caminho_db: str = MEMORIA_DB, ativa: bool = MEMORIA_ATIVA):
+        self.max_dialogos = max(1, max_dialogos)
+        self.orcamento = orcamento
+        self.orcamento_resumo = orcamento_resumo
+        self.ttl_s = ttl_s
+        self.ativa = ativa
+        self._itens = OrderedDict()   # dialog_id -> _Historico (só sem MEMORIA_DB)
+        self._lock = threading.Lock()
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        self.trocas = 0
+        self.compactadas = 0
+        self.consultas = 0
+        self.despejados = 0
+        self.erros_db = 0
+
+    def registrar(self, dialog_id: str, pergunta: str, resposta: str):
+        """Guarda uma troca (pergunta do usuário + resposta enviada) e compacta se passar do orçamento."""
+        if not (self.ativa and dialog_id):
+            return
+        agora = time.time()
+        try:
+            with self._db.lock if self._db else self._lock:
+                h = self._carregar(dialog_id, agora) or _Historico()
+                h.adicionar(_Historico.USUARIO, pergunta)
+                h.adicionar(_Historico.ASSISTENTE, resposta)
+                saiu = h.compactar(self.orcamento, self.orcamento_resumo)
+                h.usado_em = agora
+                self._salvar(dialog_id, h)
+        except sqlite3.Error as e:
+            return self._erro_db("registrar", e)   # a resposta já foi dada; só esta troca fica de fora
+        with self._lock:
+            self.trocas += 1
+            self.compactadas += saiu
+
+    def mensagens(self, dialog_id: str) -> list:
+        """Contexto do diálogo para o fallback ([] se não houver)."""
+        if not (self.ativa and dialog_id):
+            return []
+        try:
+            with self._db.lock if self._db else self._lock:
+                h = self._carregar(dialog_id, time.time())
+                # copia ainda sob o lock: sem SQLite, `h` é o mesmo objeto que `registrar` compacta no lugar
+                msgs = h.mensagens() if h else []
+        except sqlite3.Error as e:
+            self._erro_db("mensagens", e)
+            return []   # o fallback responde sem contexto
+        with self._lock:
+            self.consultas += 1
+        return msgs
+
+    def esquecer(self, dialog_id: str):
+        with self._lock:
+            self._itens.pop(dialog_id, None)
+        if self._db:
+            try:
+                with self._db.lock:
+                    self._db.conn().execute("DELETE FROM memoria WHERE dialog_id = ?", (dialog_id,))
+            except sqlite3.Error as e:
+                self._erro_db("esquecer", e)
+
+    def _erro_db(self, operacao: str, e: Exception):
+        with self._lock:
+            self.erros_db += 1
+        log.warning(f"SQLite da memória falhou ({operacao}): {e}; seguindo sem histórico.")
+
+    # ---------- armazenamento (chamados sob o lock) ----------
+    def _carregar(self, dialog_id: str, agora: float):
+        if self._db:
+            row = self._db.conn().execute(
+                "SELECT dados, usado_em FROM memoria WHERE dialog_id = ?", (dialog_id,)
+            ).fetchone()
+            if row and agora - row[1] <= self.ttl_s:
+                return _Historico.de_json(row[0], row[1])
+            return None
+        h = self._itens.get(dialog_id)
+        if h and agora - h.usado_em > self.ttl_s:
+            del self._itens[dialog_id]
+            h = None
+        if h:
+            self._itens.move_to_end(dialog_id)
+        return h
+
+    def _salvar(self, dialog_id: str, h: _Historico):
+        if self._db:
+            conn = self._db.conn()
+            conn.execute(
+                "INSERT INTO memoria(dialog_id, dados, usado_em) VALUES (?, ?, ?) "
+                "ON CONFLICT(dialog_id) DO UPDATE SET dados=excluded.dados, usado_em=excluded.usado_em",
+                (dialog_id, h.para_json(), h.usado_em),
+            )
+            conn.execute("DELETE FROM memoria WHERE usado_em < ?", (h.usado_em - self.ttl_s,))
+            conn.execute(
+                "DELETE FROM memoria WHERE dialog_id NOT IN "
+                "(SELECT dialog_id FROM memoria ORDER BY usado_em DESC LIMIT ?)",
+                (self.max_dialogos,),
+            )
+            return
+        self._itens[dialog_id] = h
+        self._itens.move_to_end(dialog_id)
+        while len(self._itens) > self.max_dialogos:
+            self._itens.popitem(last=False)
+            self.despejados += 1
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "ativa": self.ativa,
+                "dialogos": len(self._itens),
+                "max_dialogos": self.max_dialogos,
+                "orcamento_tokens": self.orcamento,
+                "orcamento_resumo_tokens": self.orcamento_resumo,
+                "persistente": bool(self._db),
+                "trocas": self.trocas,
+                "compactadas": self.compactadas,
+                "consultas": self.consultas,
+                "despejados": self.despejados,
+                "erros_db": self.erros_db,
+            }
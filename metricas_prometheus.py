@@ -0,0 +1,212 @@
+# metricas_prometheus.py
+"""
+Instrumentação de latência por etapa e contadores de desfecho, expostos em
+`GET /metrics` no formato texto do Prometheus.
+
+Cada processo acumula em memória (observar/contar são só um lock e uma soma).
+Com METRICAS_DB, cada worker grava seu acumulado num SQLite a cada
+METRICAS_FLUSH_S (e na hora do scrape), e o /metrics soma os workers vivos.
+`atualizado_em` é o batimento: linhas de um pid que não grava há mais de
+METRICAS_EXPIRA_S (worker reciclado/morto) são apagadas no scrape, e um worker
+novo apaga as linhas do seu pid (pid reaproveitado não herda contadores).
+A parcela que sai da soma aparece para o Prometheus como reset do contador.
+"""
+import os, time, json, atexit, sqlite3, threading, logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from armazenamento_sqlite import BancoCompartilhado
+
+log = logging.getLogger("metricas_prometheus")
+
+METRICAS_DB      = os.getenv("METRICAS_DB", "")                    # ex.: /var/data/metricas.sqlite3
+METRICAS_FLUSH_S = float(os.getenv("METRICAS_FLUSH_S", "5"))
+METRICAS_EXPIRA_S = float(os.getenv("METRICAS_EXPIRA_S", str(max(60.0, 6 * METRICAS_FLUSH_S))))
+TIPO_CONTEUDO    = "text/plain; version=0.0.4; charset=utf-8"
+
+_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+_BUCKETS_POLLS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# nome -> (tipo, ajuda, buckets)
+FAMILIAS = {
+    "lis_etapa_segundos": ("histogram", "Duração de cada etapa do atendimento, em segundos.", _BUCKETS_S),
+    "lis_run_polls": ("histogram", "GETs de status até o run terminar (0 quando o stream trouxe o desfecho).",
+                      _BUCKETS_POLLS),
+    "lis_run_status_total": ("counter", "Runs do assistant por status terminal.", None),
+    "lis_cache_total": ("counter", "Consultas aos caches por resultado (hit/miss).", None),
+    "lis_fallback_total": ("counter", "Chamadas de fallback (chat completions) por origem e resultado.", None),
+    "lis_bitrix_comandos_total": ("counter", "Comandos REST enviados ao Bitrix por método e resultado.", None),
+    "lis_handler_total": ("counter", "Eventos recebidos no /handler por desfecho.", None),
+}
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS amostras (
+    pid           INTEGER NOT NULL,
+    chave         TEXT NOT NULL,
+    valor         TEXT NOT NULL,
+    atualizado_em REAL NOT NULL,
+    PRIMARY KEY (pid, chave)
+);
+CREATE INDEX IF NOT EXISTS amostras_atualizado_em ON amostras(atualizado_em);
+"""
+
+
+class RegistroMetricas:
+    def __init__(self, caminho_db: str = METRICAS_DB):
+        self._lock = threading.Lock()
+        self._contadores = {}    # (nome, labels) -> valor
+        self._histogramas = {}   # (nome, labels) -> [contagem por bucket..., +Inf, soma]
+        self._db = BancoCompartilhado(caminho_db, _DDL) if caminho_db else None
+        self._pid = None
+        self._thread = None
+
+    # ---------- coleta ----------
+    def contar(self, nome: str, valor: float = 1, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+        self._garantir_flush()
+
+    def observar(self, nome: str, valor: float, **labels):
+        buckets = FAMILIAS[nome][2]
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histogramas.get(chave)
+            if h is None:
+                h = self._histogramas[chave] = [0] * (len(buckets) + 2)
+            h[bisect_left(buckets, valor)] += 1
+            h[-1] += valor
+        self._garantir_flush()
+
+    def etapa(self, etapa: str, segundos: float):
+        self.observar("lis_etapa_segundos", segundos, etapa=etapa)
+
+    @contextmanager
+    def medir(self, etapa: str):
+        """Cronometra o bloco como `lis_etapa_segundos{etapa=...}` (também quando ele levanta)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.etapa(etapa, time.perf_counter() - t0)
+
+    # ---------- agregação entre workers ----------
+    def _garantir_flush(self):
+        if not self._db:
+            return
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # herdado do pai (fork): o acumulado dele já está no banco com o pid dele
+                self._contadores.clear()
+                self._histogramas.clear()
+            self._pid = pid
+            self._limpar_pid(pid)
+            self._thread = threading.Thread(target=self._loop_flush, name="metricas-flush", daemon=True)
+            self._thread.start()
+
+    def _limpar_pid(self, pid: int):
+        """Apaga as linhas de um processo anterior com o mesmo pid."""
+        try:
+            with self._db.lock:
+                self._db.conn().execute("DELETE FROM amostras WHERE pid = ?", (pid,))
+        except sqlite3.Error as e:
+            log.warning(f"Métricas: falha ao limpar o pid {pid} no SQLite ({e}).")
+
+    def _loop_flush(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(METRICAS_FLUSH_S)
+            self.flush()
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            dados = {json.dumps(["c", n, l]): v for (n, l), v in self._contadores.items()}
+            dados.update({json.dumps(["h", n, l]): list(h) for (n, l), h in self._histogramas.items()})
+        return dados
+
+    def flush(self):
+        """Grava o acumulado deste processo no SQLite compartilhado."""
+        if not self._db or self._pid != os.getpid():
+            return
+        agora = time.time()
+        linhas = [(self._pid, chave, json.dumps(valor), agora) for chave, valor in self._snapshot().items()]
+        if not linhas:
+            return
+        try:
+            with self._db.lock:
+                self._db.conn().executemany(
+                    "INSERT OR REPLACE INTO amostras(pid, chave, valor, atualizado_em) VALUES (?, ?, ?, ?)", linhas)
+        except sqlite3.Error as e:
+            log.warning(f"Métricas: falha ao gravar no SQLite ({e}).")
+
+    def _agregado(self) -> dict:
+        """{chave: valor} somado entre os workers vivos (ou só deste processo, sem METRICAS_DB)."""
+        if not self._db:
+            return self._snapshot()
+        self.flush()
+        try:
+            with self._db.lock:
+                conn = self._db.conn()
+                conn.execute("DELETE FROM amostras WHERE atualizado_em < ?", (time.time() - METRICAS_EXPIRA_S,))
+                linhas = conn.execute("SELECT chave, valor FROM amostras").fetchall()
+        except sqlite3.Error as e:
+            log.warning(f"Métricas: falha ao ler o SQLite ({e}); mostrando só este worker.")
+            return self._snapshot()
+        total = {}
+        for chave, valor in linhas:
+            valor = json.loads(valor)
+            atual = total.get(chave)
+            if atual is None:
+                total[chave] = valor
+            elif isinstance(valor, list):
+                total[chave] = [a + b for a, b in zip(atual, valor)]
+            else:
+                total[chave] = atual + valor
+        return total
+
+    # ---------- exposição ----------
+    def texto(self) -> str:
+        """Formato texto do Prometheus (0.0.4)."""
+        por_familia = {}
+        for chave, valor in self._agregado().items():
+            tipo, nome, labels = json.loads(chave)
+            por_familia.setdefault(nome, []).append((tuple(map(tuple, labels)), valor))
+
+        linhas = []
+        for nome, (tipo, ajuda, buckets) in FAMILIAS.items():
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            for labels, valor in sorted(por_familia.get(nome, [])):
+                if tipo == "counter":
+                    linhas.append(f"{nome}{_labels(labels)} {_num(valor)}")
+                    continue
+                acumulado = 0
+                for le, n in zip(list(buckets) + ["+Inf"], valor[:-1]):
+                    acumulado += n
+                    linhas.append(f"{nome}_bucket{_labels(labels + (('le', _num(le)),))} {acumulado}")
+                linhas.append(f"{nome}_sum{_labels(labels)} {_num(valor[-1])}")
+                linhas.append(f"{nome}_count{_labels(labels)} {acumulado}")
+        return "\n".join(linhas) + "\n"
+
+
+def _num(v) -> str:
+    if isinstance(v, str):
+        return v
+    return str(int(v)) if float(v).is_integer() else repr(round(float(v), 6))
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    partes = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                      for k, v in labels)
+    return "{" + partes + "}"
+
+
+metricas = RegistroMetricas()
+atexit.register(metricas.flush)
@@ -0,0 +1,365 @@
+# perfilador.py
+"""
+Perfil sob demanda dos próximos N /handler, para investigar picos de p99 no
+serviço em produção sem redeploy: quanto foi para o parse do payload, a varredura
+dos anexos, o Pillow (`is_image`), as chamadas à OpenAI e o envio ao Bitrix.
+
+- POST /admin/perfil?n=5&modo=cprofile (X-Admin-Token) arma o worker que recebeu
+  o POST; ou o header `X-Perfil: cprofile|amostragem` (com X-Admin-Token) num
+  /handler reenviado à mão perfila só aquele request.
+- Uma captura segue o evento inteiro: o request, a tarefa da fila de
+  processamento e as threads que ela abre (anexos em paralelo, hedge), pelo
+  ContextVar `captura_atual`, que já é copiado para todas elas.
+- cprofile: um cProfile.Profile por thread (até o 3.11) ou um por processo
+  (3.12+, em que o cProfile usa sys.monitoring: um perfilador ativo por vez, que
+  vê todas as threads), somados num `.prof` (pstats, snakeviz, flameprof). Se o
+  perfilador do processo já está com outra captura, o trecho fica de fora e é
+  contado em `puladas`. amostragem: uma thread lê as pilhas das threads em
+  captura a cada PERFIL_INTERVALO_MS e grava `.folded` (uma pilha por linha +
+  contagem; flamegraph.pl, speedscope).
+- Arquivos em PERFIL_DIR (+ um `.json` com duração por trecho e id do evento dos
+  logs), os PERFIL_MAX_CAPTURAS mais novos; GET /admin/perfil lista e
+  GET /admin/perfil/<arquivo> baixa.
+
+Desarmado, o custo no caminho do request é ler um inteiro (`pedir`) e um set
+(`envolver`).
+"""
+import os, re, sys, json, time, uuid, pstats, cProfile, tempfile, threading, logging, contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+from logs_estruturados import id_evento
+
+log = logging.getLogger("perfilador")
+
+PERFIL_DIR          = os.getenv("PERFIL_DIR", os.path.join(tempfile.gettempdir(), "lis-perfis"))
+PERFIL_MODO         = os.getenv("PERFIL_MODO", "cprofile")                # modo padrão do POST e do header
+PERFIL_MAX_REQUESTS = int(os.getenv("PERFIL_MAX_REQUESTS", "50"))         # teto do N por POST
+PERFIL_MAX_CAPTURAS = int(os.getenv("PERFIL_MAX_CAPTURAS", "100"))        # capturas mantidas no disco
+PERFIL_INTERVALO_MS = float(os.getenv("PERFIL_INTERVALO_MS", "5"))        # período da amostragem
+MODOS = ("cprofile", "amostragem")
+_EXTENSAO = {"cprofile": ".prof", "amostragem": ".folded"}
+_PERFIL_POR_THREAD = sys.version_info < (3, 12)
+_RE_ARQUIVO = re.compile(r"\d{8}-\d{6}-\d+-[0-9a-f]+\.(?:prof|folded|json)")
+
+captura_atual = contextvars.ContextVar("captura_atual", default=None)
+
+
+class _Captura:
+    __slots__ = ("id", "modo", "inicio", "evento", "pendentes", "perfis", "ligados", "threads", "pilhas", "trechos")
+
+    def __init__(self, modo: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.modo = modo
+        self.inicio = time.time()
+        self.evento = "-"
+        self.pendentes = 0          # trechos em andamento ou agendados (fila, pool, tarefa)
+        self.perfis = {}            # thread id (0 no 3.12+) -> cProfile.Profile
+        self.ligados = Counter()    # mesma chave -> trechos com o Profile ligado
+        self.threads = set()        # threads que entraram na captura
+        self.pilhas = Counter()     # pilha "trecho;f1;f2;..." -> amostras
+        self.trechos = Counter()    # nome do trecho -> segundos somados
+
+
+def _empilhar(raiz: str, quadro) -> str:
+    nomes = []
+    while quadro is not None:
+        codigo = quadro.f_code
+        nomes.append(f"{codigo.co_qualname} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+        quadro = quadro.f_back
+    nomes.append(raiz)
+    return ";".join(reversed(nomes))
+
+
+class Perfilador:
+    def __init__(self, pasta: str = PERFIL_DIR, modo: str = PERFIL_MODO,
+                 max_capturas: int = PERFIL_MAX_CAPTURAS, intervalo_ms: float = PERFIL_INTERVALO_MS):
+        self.pasta = pasta
+        self.modo = modo if modo in MODOS else "cprofile"
+        self.max_capturas = max(1, max_capturas)
+        self.intervalo_s = max(0.001, intervalo_ms / 1000)
+        self._restantes = 0
+        self._em_andamento = set()
+        self._threads = {}          # thread id -> [captura, profundidade, trecho de fora]
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._amostrador = None
+        self._pid = None
+        self.stats = {"iniciadas": 0, "gravadas": 0, "sobrepostas": 0, "puladas": 0, "falhas": 0}
+
+    # ---------- armar / escolher o request ----------
+    def armar(self, n: int, modo: str = None) -> dict:
+        """Perfila os próximos `n` /handler deste processo (0 desarma)."""
+        modo = modo or self.modo
+        if modo not in MODOS:
+            raise ValueError(f"modo inválido: {modo} (use {', '.join(MODOS)})")
+        with self._lock:
+            self._restantes = max(0, min(int(n), PERFIL_MAX_REQUESTS))
+            self.modo = modo
+        log.info(f"🔬 Perfil armado: próximos {self._restantes} /handler ({modo}).")
+        return {"restantes": self._restantes, "modo": modo, "pid": os.getpid()}
+
+    def pedir(self, forcar: str = None, exclusivo: bool = False):
+        """
+        Captura para este request, ou None. `forcar` (header X-Perfil já autorizado)
+        perfila mesmo desarmado. `exclusivo`: no app_async todos os requests dividem a
+        thread do event loop, então só uma captura por vez.
+        """
+        if not self._restantes and forcar is None:
+            return None
+        with self._lock:
+            if exclusivo and self._em_andamento:
+                return None
+            if forcar is not None:
+                modo = forcar if forcar in MODOS else self.modo
+            elif self._restantes:
+                self._restantes -= 1
+                modo = self.modo
+            else:
+                return None
+            captura = _Captura(modo)
+            self._em_andamento.add(captura)
+            self.stats["iniciadas"] += 1
+        return captura
+
+    # ---------- trechos ----------
+    @contextmanager
+    def trecho(self, captura: _Captura, nome: str, retido: bool = False):
+        """Perfila a thread atual durante o bloco e deixa `captura` no contexto (herdado por fila/pools/tarefas)."""
+        if not retido:
+            self._reter(captura)
+        token = captura_atual.set(captura)
+        ativo = False
+        t0 = time.perf_counter()
+        try:
+            ativo = self._entrar(captura, nome)
+            yield captura
+        finally:
+            if ativo:
+                self._sair(captura)
+            with self._lock:
+                captura.trechos[nome] += time.perf_counter() - t0
+                if captura.evento == "-":
+                    captura.evento = id_evento.get()
+            captura_atual.reset(token)
+            self._soltar(captura)
+
+    def envolver(self, fn, nome: str):
+        """
+        `fn` agendada a partir de um trecho (fila, pool de threads) vira outro trecho
+        da mesma captura. Sem captura no contexto, devolve `fn` como está.
+        """
+        if not self._em_andamento:
+            return fn
+        captura = captura_atual.get()
+        if captura is None:
+            return fn
+        self._reter(captura)
+
+        def _no_perfil(*args, **kwargs):
+            with self.trecho(captura, nome, retido=True):
+                return fn(*args, **kwargs)
+        _no_perfil.captura = captura
+        return _no_perfil
+
+    def cancelar(self, fn):
+        """`fn` devolvida por `envolver` que não vai mais rodar (fila cheia)."""
+        captura = getattr(fn, "captura", None)
+        if captura is not None:
+            self._soltar(captura)
+
+    def envolver_async(self, coro, nome: str):
+        """`envolver` para a corrotina de uma tarefa do app_async."""
+        if not self._em_andamento:
+            return coro
+        captura = captura_atual.get()
+        if captura is None:
+            return coro
+        self._reter(captura)
+        return self._no_perfil_async(captura, coro, nome)
+
+    async def _no_perfil_async(self, captura: _Captura, coro, nome: str):
+        with self.trecho(captura, nome, retido=True):
+            return await coro
+
+    def _reter(self, captura: _Captura):
+        with self._lock:
+            captura.pendentes += 1
+
+    def _soltar(self, captura: _Captura):
+        with self._lock:
+            captura.pendentes -= 1
+            if captura.pendentes > 0:
+                return
+            self._em_andamento.discard(captura)
+        # grava fora da thread do request/worker/event loop
+        threading.Thread(target=self._gravar, args=(captura,), name="perfil-gravar", daemon=True).start()
+
+    def _entrar(self, captura: _Captura, nome: str) -> bool:
+        tid = threading.get_ident()
+        with self._lock:
+            dono = self._threads.get(tid)
+            if dono is not None:
+                if dono[0] is not captura:
+                    # a thread já está numa captura (perfil é por thread): este trecho fica de fora
+                    self.stats["sobrepostas"] += 1
+                    return False
+                dono[1] += 1
+                return True
+            if captura.modo == "cprofile" and not self._ligar(captura, tid):
+                self.stats["puladas"] += 1
+                return False
+            self._threads[tid] = [captura, 1, nome]
+            captura.threads.add(tid)
+            if captura.modo == "cprofile":
+                return True
+            self._acordar.set()
+        self._garantir_amostrador()
+        return True
+
+    def _ligar(self, captura: _Captura, tid: int) -> bool:
+        """Liga o Profile da thread (ou do processo, no 3.12+). Chamado sob o lock."""
+        chave = tid if _PERFIL_POR_THREAD else 0
+        if captura.ligados[chave] == 0:
+            perfil = captura.perfis.setdefault(chave, cProfile.Profile())
+            try:
+                perfil.enable()
+            except ValueError:
+                # 3.12+: o perfilador do processo está com outra captura (ou outra ferramenta)
+                return False
+        captura.ligados[chave] += 1
+        return True
+
+    def _sair(self, captura: _Captura):
+        tid = threading.get_ident()
+        with self._lock:
+            dono = self._threads[tid]
+            dono[1] -= 1
+            if dono[1]:
+                return
+            del self._threads[tid]
+            if captura.modo == "cprofile":
+                chave = tid if _PERFIL_POR_THREAD else 0
+                captura.ligados[chave] -= 1
+                if captura.ligados[chave] == 0:
+                    captura.perfis[chave].disable()
+
+    # ---------- amostragem ----------
+    def _garantir_amostrador(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._amostrador = threading.Thread(target=self._amostrar, name="perfil-amostrador", daemon=True)
+            self._amostrador.start()
+            self._pid = pid
+
+    def _amostrar(self):
+        while True:
+            self._acordar.wait()
+            time.sleep(self.intervalo_s)
+            with self._lock:
+                alvos = [(tid, captura, nome) for tid, (captura, _, nome) in self._threads.items()
+                         if captura.modo == "amostragem"]
+                if not alvos:
+                    self._acordar.clear()
+                    continue
+            quadros = sys._current_frames()
+            pilhas = [(captura, _empilhar(nome, quadros[tid])) for tid, captura, nome in alvos if tid in quadros]
+            del quadros
+            with self._lock:
+                for captura, pilha in pilhas:
+                    captura.pilhas[pilha] += 1
+
+    # ---------- arquivos ----------
+    def _gravar(self, captura: _Captura):
+        base = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(captura.inicio))}-{os.getpid()}-{captura.id}"
+        arquivo = base + _EXTENSAO[captura.modo]
+        try:
+            os.makedirs(self.pasta, exist_ok=True)
+            caminho = os.path.join(self.pasta, arquivo)
+            if captura.modo == "cprofile":
+                total = pstats.Stats()
+                for perfil in captura.perfis.values():
+                    try:
+                        total.add(perfil)
+                    except TypeError:
+                        pass   # thread sem nenhuma chamada registrada
+                total.dump_stats(caminho)
+                amostras = None
+            else:
+                with self._lock:
+                    pilhas = captura.pilhas.most_common()
+                with open(caminho, "w", encoding="utf-8") as f:
+                    f.writelines(f"{pilha} {n}\n" for pilha, n in pilhas)
+                amostras = sum(n for _, n in pilhas)
+            meta = {
+                "arquivo": arquivo,
+                "modo": captura.modo,
+                "evento": captura.evento,
+                "pid": os.getpid(),
+                "inicio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(captura.inicio)),
+                "duracao_s": round(time.time() - captura.inicio, 4),
+                "trechos_s": {nome: round(s, 4) for nome, s in captura.trechos.items()},
+                "threads": len(captura.threads),
+                "amostras": amostras,
+                "bytes": os.path.getsize(caminho),
+            }
+            with open(os.path.join(self.pasta, base + ".json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            self._podar()
+        except Exception as e:
+            with self._lock:
+                self.stats["falhas"] += 1
+            log.exception(f"Falha gravando o perfil {arquivo}: {e}")
+            return
+        with self._lock:
+            self.stats["gravadas"] += 1
+        log.info(f"🔬 Perfil gravado: {arquivo} ({meta['duracao_s']:.2f}s, evento {captura.evento}).")
+
+    def _podar(self):
+        metas = sorted(n for n in os.listdir(self.pasta) if _RE_ARQUIVO.fullmatch(n) and n.endswith(".json"))
+        for nome in metas[:-self.max_capturas]:
+            base = nome[:-len(".json")]
+            for ext in (".json", *_EXTENSAO.values()):
+                try:
+                    os.remove(os.path.join(self.pasta, base + ext))
+                except FileNotFoundError:
+                    pass
+
+    def listar(self) -> list:
+        """Capturas no disco (de todos os workers que usam a mesma PERFIL_DIR), mais novas primeiro."""
+        if not os.path.isdir(self.pasta):
+            return []
+        capturas = []
+        for nome in sorted(os.listdir(self.pasta), reverse=True):
+            if not (_RE_ARQUIVO.fullmatch(nome) and nome.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.pasta, nome), encoding="utf-8") as f:
+                    capturas.append(json.load(f))
+            except (OSError, ValueError):
+                continue   # podada ou ainda sendo escrita
+        return capturas
+
+    def caminho(self, arquivo: str):
+        """Caminho de um arquivo de captura para download, ou None (nome fora do padrão ou inexistente)."""
+        if not _RE_ARQUIVO.fullmatch(arquivo or ""):
+            return None
+        caminho = os.path.join(self.pasta, arquivo)
+        return caminho if os.path.isfile(caminho) else None
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "restantes": self._restantes,
+                "modo": self.modo,
+                "em_andamento": len(self._em_andamento),
+                **self.stats,
+                "pasta": self.pasta,
+            }
+
+
+perfil = Perfilador()
@@ -0,0 +1,88 @@
+# preprocessar_imagem.py
+"""
+Reduz fotos antes do upload para a OpenAI: aplica a orientação EXIF, limita o
+maior lado, descarta metadados e recodifica em JPEG/WebP. A decodificação roda
+num pool de processos para não segurar as threads que atendem o bot.
+"""
+import os, time, logging, multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger("preprocessar_imagem")
+
+IMG_PREPROCESSAR = os.getenv("IMG_PREPROCESSAR", "1") != "0"
+IMG_LADO_MAX     = int(os.getenv("IMG_LADO_MAX", "1568"))
+IMG_FORMATO      = os.getenv("IMG_FORMATO", "JPEG").upper()      # JPEG ou WEBP
+IMG_QUALIDADE    = int(os.getenv("IMG_QUALIDADE", "82"))
+IMG_PROCESSOS    = int(os.getenv("IMG_PROCESSOS", "2"))
+IMG_TIMEOUT_S    = float(os.getenv("IMG_TIMEOUT_S", "20"))
+# Abaixo disso a imagem já é leve: sobe como veio
+IMG_MIN_BYTES    = int(os.getenv("IMG_MIN_BYTES", str(300 * 1024)))
+
+MIME_POR_FORMATO = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+EXTENSAO_POR_MIME = {"image/jpeg": "jpg", "image/webp": "webp"}
+
+_pool = None
+_pool_pid = None
+
+
+def _reprocessar(dados: bytes, lado_max: int, formato: str, qualidade: int):
+    """Executa no processo filho. Retorna (bytes, tamanho_antes, tamanho_depois)."""
+    from PIL import Image, ImageOps
+
+    img = Image.open(BytesIO(dados))
+    antes = img.size
+    img.draft("RGB", (lado_max, lado_max))   # JPEG: decodifica já reduzido (bem mais rápido)
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((lado_max, lado_max), Image.LANCZOS)
+
+    if formato == "JPEG" and img.mode != "RGB":
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            fundo = Image.new("RGB", img.size, (255, 255, 255))
+            fundo.paste(img, mask=img.getchannel("A"))
+            img = fundo
+        else:
+            img = img.convert("RGB")
+    elif formato == "WEBP" and img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+
+    saida = BytesIO()
+    # sem exif=/icc_profile=: metadados (GPS, câmera...) ficam de fora
+    img.save(saida, format=formato, quality=qualidade, optimize=True)
+    return saida.getvalue(), antes, img.size
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        # spawn: não herda locks/threads do worker do gunicorn
+        _pool = ProcessPoolExecutor(max_workers=IMG_PROCESSOS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def preprocessar(buf: BytesIO, mime: str, timeout_s: float = None):
+    """
+    Retorna (buf, mime) prontos para upload. Em qualquer falha, timeout ou se o
+    resultado não ficar menor, devolve o original.
+    """
+    tamanho = buf.getbuffer().nbytes
+    if not IMG_PREPROCESSAR or tamanho < IMG_MIN_BYTES:
+        return buf, mime
+    formato = IMG_FORMATO if IMG_FORMATO in MIME_POR_FORMATO else "JPEG"
+    t0 = time.perf_counter()
+    try:
+        futuro = _executor().submit(_reprocessar, buf.getvalue(), IMG_LADO_MAX, formato, IMG_QUALIDADE)
+        limite = IMG_TIMEOUT_S if timeout_s is None else max(0.5, min(IMG_TIMEOUT_S, timeout_s))
+        dados, antes, depois = futuro.result(timeout=limite)
+    except Exception as e:
+        log.warning(f"Pré-processamento falhou ({e!r}); enviando a imagem original.")
+        return buf, mime
+    ms = (time.perf_counter() - t0) * 1000
+    log.info(f"🖼️ {mime} {antes[0]}x{antes[1]} {tamanho // 1024} KB -> "
+             f"{formato} {depois[0]}x{depois[1]} {len(dados) // 1024} KB em {ms:.0f} ms")
+    if len(dados) >= tamanho:
+        return buf, mime
+    return BytesIO(dados), MIME_POR_FORMATO[formato]
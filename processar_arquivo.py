@@ -1,82 +1,585 @@
-import requests
 from io import BytesIO
-from PIL import Image
-import mimetypes
-from openai import OpenAI
 import os
 import time
+import base64
+import asyncio
+import logging
+import threading
+import contextvars
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+import cliente_assistants
+from cliente_assistants import ErroRun, descrever_erro_http, executar_run, executar_run_async
+from chamar_openai_com import FALLBACK_MODEL, MSG_IA_OCUPADA
+from limitador_openai import limitador, LimiteExcedido, OPENAI_TOKENS_RUN, OPENAI_ESPERA_MAX_S
+from disjuntor_openai import disjuntor
+from cliente_http import sessao_bitrix, sessao_openai, timeout, cliente_async, timeout_async
+from preprocessar_imagem import preprocessar, EXTENSAO_POR_MIME
+from cache_arquivos import CacheArquivos, hash_conteudo
+from armazenamento_sqlite import fora_do_loop
+from metricas_prometheus import metricas
+from perfilador import perfil
+
+log = logging.getLogger("processar_arquivo")
 
-openai_client = OpenAI(api_key=os.getenv("API_KEY"))
 ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 
-def is_image(file_bytes, content_type):
-    if "image" not in content_type:
-        print("❌ Conteúdo não é uma imagem (content-type).")
-        return False
+INSTRUCOES_IMAGEM = "Analise a imagem enviada e forneça uma resposta útil à equipe do laboratório."
+PROMPT_IMAGEM = "Por favor, analise esta imagem."
+PROMPT_IMAGENS = "Por favor, analise estas imagens em conjunto, na ordem em que foram enviadas."
+CHAVE_PROMPT = f"{INSTRUCOES_IMAGEM}\n{PROMPT_IMAGEM}"   # análises em cache valem para este prompt
+
+# SDK da OpenAI (upload/exclusão de arquivos) e Pillow só são importados no primeiro anexo:
+# tráfego só de texto não paga ~0,6 s de import na partida a frio
+_openai_client = None
+_openai_lock = threading.Lock()
+
+def cliente_openai():
+    """Cliente do SDK da OpenAI, criado no primeiro uso."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI(api_key=os.getenv("API_KEY"))
+    return _openai_client
+
+# Mesmo anexo de novo (formulário padrão, print repassado): sem re-upload nem re-análise
+cache_arquivos = CacheArquivos(excluir_remoto=lambda file_id: cliente_openai().files.delete(file_id))
+
+# Download do anexo: limite rígido de bytes e de tempo total
+ARQUIVO_MAX_BYTES = int(os.getenv("ARQUIVO_MAX_BYTES", str(20 * 1024 * 1024)))
+ARQUIVO_TIMEOUT_S = float(os.getenv("ARQUIVO_TIMEOUT_S", "30"))
+ARQUIVO_CHUNK = 64 * 1024
+
+# Teto de ocupação do worker por imagem (download + upload + run + fallback)
+IMAGEM_PRAZO_S = float(os.getenv("IMAGEM_PRAZO_S", "60"))
+# Parte do prazo guardada para o fallback de visão caso o run estoure
+IMAGEM_RESERVA_FALLBACK_S = float(os.getenv("IMAGEM_RESERVA_FALLBACK_S", "15"))
+
+# Vários anexos na mesma mensagem: downloads/uploads em paralelo e um run só
+ARQUIVOS_MAX = int(os.getenv("ARQUIVOS_MAX", "10"))
+ARQUIVOS_PARALELOS = int(os.getenv("ARQUIVOS_PARALELOS", "4"))
+_pool_arquivos = None   # criado sob demanda (e recriado após fork)
+_pool_arquivos_pid = None
+
+# Números mágicos dos formatos aceitos pela visão da OpenAI
+ASSINATURAS_IMAGEM = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+MSG_NAO_IMAGEM = "❌ O tipo de arquivo não é reconhecido como imagem compatível para análise."
+MSG_ERRO_IA = "❗Erro ao processar imagem com a IA."
+MSG_ERRO_DOWNLOAD = "❗Ocorreu um erro ao processar o arquivo."
+
+
+class ArquivoRecusado(Exception):
+    """Anexo rejeitado antes da análise; a mensagem vai direto para o usuário."""
+
+
+class _Imagem:
+    """Um anexo da mensagem e o que já se sabe dele ao longo do fluxo."""
+    __slots__ = ("url", "nome", "buf", "mime", "digest", "envio", "file_id", "recusa")
+
+    def __init__(self, url: str, nome: str):
+        self.url, self.nome = url, nome
+        self.buf = self.mime = self.digest = None
+        self.envio = None     # (buf, mime, nome) pré-processados; reaproveitado pelo fallback
+        self.file_id = None
+        self.recusa = None    # mensagem ao usuário se o anexo foi rejeitado
+
+
+def detectar_tipo_imagem(cabecalho: bytes):
+    """MIME da imagem pelos primeiros bytes, ou None se não for um formato aceito."""
+    for assinatura, mime in ASSINATURAS_IMAGEM:
+        if cabecalho.startswith(assinatura):
+            return mime
+    if len(cabecalho) >= 12 and cabecalho[:4] == b"RIFF" and cabecalho[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def is_image(buf: BytesIO) -> bool:
+    """Confere a estrutura da imagem com o Pillow, sem copiar o buffer."""
+    from PIL import Image
     try:
-        img = Image.open(BytesIO(file_bytes))
+        img = Image.open(buf)
         img.verify()
         return True
     except Exception as e:
-        print("🛑 Erro ao verificar imagem:", e)
+        log.warning(f"🛑 Erro ao verificar imagem: {e}")
         return False
+    finally:
+        buf.seek(0)
 
-def processar_arquivo_do_bitrix(arquivo_url: str, arquivo_nome: str) -> str:
+class _ValidadorDownload:
+    """
+    Regras do download, comuns ao modo síncrono (requests) e ao async (httpx):
+    status HTTP, Content-Length, números mágicos nos primeiros bytes, limite de
+    bytes e prazo total.
+    """
+
+    def __init__(self, timeout_s: float):
+        self.t0 = time.time()
+        self.timeout_s = timeout_s
+        self.buf = BytesIO()
+        self.cabecalho = b""
+        self.mime = None
+
+    def resposta(self, status_code: int, headers):
+        if status_code != 200:
+            raise ArquivoRecusado(f"❌ Não foi possível acessar o link do arquivo. Código HTTP: {status_code}")
+        log.debug(f"📦 Tipo de conteúdo recebido: {headers.get('Content-Type', '')}")
+        tamanho = int(headers.get("Content-Length") or 0)
+        if tamanho > ARQUIVO_MAX_BYTES:
+            raise ArquivoRecusado(f"❌ Arquivo muito grande ({tamanho // 1024} KB). "
+                                  f"Limite: {ARQUIVO_MAX_BYTES // 1024} KB.")
+
+    def chunk(self, chunk: bytes):
+        if self.mime is None:
+            self.cabecalho += chunk[:16]
+            if len(self.cabecalho) >= 12:
+                self.mime = detectar_tipo_imagem(self.cabecalho)
+                if self.mime is None:
+                    raise ArquivoRecusado(MSG_NAO_IMAGEM)
+        self.buf.write(chunk)
+        if self.buf.tell() > ARQUIVO_MAX_BYTES:
+            raise ArquivoRecusado(f"❌ Arquivo muito grande. Limite: {ARQUIVO_MAX_BYTES // 1024} KB.")
+        if time.time() - self.t0 > self.timeout_s:
+            raise ArquivoRecusado("❌ O download do arquivo demorou demais. Tente novamente.")
+
+    def fim(self):
+        mime = self.mime or detectar_tipo_imagem(self.cabecalho)
+        if mime is None:
+            raise ArquivoRecusado(MSG_NAO_IMAGEM)
+        log.info(f"📥 {self.buf.tell()} bytes ({mime}) em {time.time() - self.t0:.2f}s")
+        self.buf.seek(0)
+        return self.buf, mime
+
+def baixar_imagem(arquivo_url: str, timeout_s: float = ARQUIVO_TIMEOUT_S):
+    """
+    Baixa o anexo em streaming. Recusa cedo (ArquivoRecusado) se o HTTP falhar, se o
+    Content-Length passar do limite, se os primeiros bytes não forem de imagem, se o
+    corpo passar de ARQUIVO_MAX_BYTES ou se o download estourar `timeout_s`.
+    Retorna (BytesIO posicionado no início, mime).
+    """
+    validador = _ValidadorDownload(timeout_s)
+    with metricas.medir("arquivo_download"), \
+            sessao_bitrix().get(arquivo_url, allow_redirects=True, stream=True,
+                                timeout=timeout(timeout_s)) as response:
+        validador.resposta(response.status_code, response.headers)
+        for chunk in response.iter_content(ARQUIVO_CHUNK):
+            validador.chunk(chunk)
+    return validador.fim()
+
+def _preparar_envio(buf: BytesIO, mime: str, arquivo_nome: str, timeout_s: float):
+    """Reduz/recodifica antes do upload (orientação EXIF, lado máximo, sem metadados)."""
+    buf, mime_envio = preprocessar(buf, mime, timeout_s=timeout_s)
+    if mime_envio != mime:
+        arquivo_nome = f"{os.path.splitext(arquivo_nome)[0]}.{EXTENSAO_POR_MIME[mime_envio]}"
+    return buf, mime_envio, arquivo_nome
+
+def _prompt(n_imagens: int) -> str:
+    return PROMPT_IMAGEM if n_imagens == 1 else PROMPT_IMAGENS
+
+def _corpo_visao(envios: list) -> dict:
+    partes = [{"type": "text", "text": _prompt(len(envios))}]
+    for buf, mime, _ in envios:
+        data_url = f"data:{mime};base64,{base64.b64encode(buf.getvalue()).decode()}"
+        partes.append({"type": "image_url", "image_url": {"url": data_url}})
+    return {
+        "model": FALLBACK_MODEL,
+        "messages": [
+            {"role": "system", "content": INSTRUCOES_IMAGEM},
+            {"role": "user", "content": partes},
+        ],
+        "max_tokens": 700
+    }
+
+def _fallback_visao(envios: list, timeout_s: float) -> str:
+    """Se o run falhar ou estourar o prazo, analisa as imagens direto no Chat Completions (visão)."""
+    t0 = time.perf_counter()
+    resposta = _fallback_visao_medido(envios, timeout_s)
+    _registrar_fallback_visao(resposta, t0)
+    return resposta
+
+def _registrar_fallback_visao(resposta: str, t0: float):
+    metricas.etapa("fallback_visao", time.perf_counter() - t0)
+    metricas.contar("lis_fallback_total", origem="imagem", resultado="erro" if resposta == MSG_ERRO_IA else "ok")
+
+def _fallback_visao_medido(envios: list, timeout_s: float) -> str:
+    if not disjuntor.permitir("chat"):
+        log.warning("⚠️ Disjuntor do chat completions aberto; sem fallback de visão.")
+        return MSG_ERRO_IA
     try:
-        print(f"🔗 URL: {arquivo_url}")
-        print(f"🔽 Baixando arquivo: {arquivo_nome}")
+        with disjuntor.medir("chat"):
+            r = sessao_openai().post(
+                f"{cliente_assistants.OPENAI_BASE_URL}/chat/completions",
+                headers=cliente_assistants._headers_no_beta(),
+                json=_corpo_visao(envios),
+                timeout=timeout(timeout_s)
+            )
+            r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"].strip()
+    except (requests.exceptions.RequestException, KeyError, IndexError) as e:
+        detalhe = descrever_erro_http(e) if isinstance(e, requests.exceptions.RequestException) else ""
+        log.error(f"❌ Fallback de visão falhou: {e}{detalhe}")
+        return MSG_ERRO_IA
 
-        response = requests.get(arquivo_url, allow_redirects=True)
+def _conteudo_run(file_ids: list) -> list:
+    partes = [{"type": "text", "text": _prompt(len(file_ids))}]
+    partes += [{"type": "image_file", "image_file": {"file_id": file_id}} for file_id in file_ids]
+    return partes
 
-        if response.status_code != 200:
-            return f"❌ Não foi possível acessar o link do arquivo. Código HTTP: {response.status_code}"
+def _espera_vaga(restante_s: float, reserva_s: float = IMAGEM_RESERVA_FALLBACK_S) -> float:
+    """Quanto do prazo da imagem pode ser gasto esperando vaga no limitador."""
+    return max(0.0, min(OPENAI_ESPERA_MAX_S, restante_s - reserva_s))
 
-        content_type = response.headers.get("Content-Type", "")
-        print(f"📦 Tipo de conteúdo recebido: {content_type}")
+def _executor_arquivos() -> ThreadPoolExecutor:
+    global _pool_arquivos, _pool_arquivos_pid
+    if _pool_arquivos is None or _pool_arquivos_pid != os.getpid():
+        _pool_arquivos = ThreadPoolExecutor(max_workers=ARQUIVOS_PARALELOS, thread_name_prefix="arquivos")
+        _pool_arquivos_pid = os.getpid()
+    return _pool_arquivos
 
-        file_bytes = response.content
+def _em_paralelo(fn, imagens: list):
+    """Roda `fn(imagem)` para cada anexo no pool (inline se for um só). Repassa a primeira exceção."""
+    if len(imagens) <= 1:
+        return [fn(img) for img in imagens]
+    pool = _executor_arquivos()
+    return [f.result() for f in [pool.submit(contextvars.copy_context().run, perfil.envolver(fn, "arquivos"), img) for img in imagens]]
 
-        if not is_image(file_bytes, content_type):
-            return "❌ O tipo de arquivo não é reconhecido como imagem compatível para análise."
+def _lista_de_arquivos(arquivos: list) -> list:
+    if len(arquivos) > ARQUIVOS_MAX:
+        log.warning(f"⚠️ {len(arquivos)} anexos na mensagem; analisando só os {ARQUIVOS_MAX} primeiros.")
+    return [_Imagem(url, nome) for url, nome in arquivos[:ARQUIVOS_MAX]]
 
-        # Upload do arquivo para OpenAI
-        upload_response = openai_client.files.create(
-            file=BytesIO(file_bytes),
-            purpose="assistants"
-        )
+def _chave_analise(imagens: list) -> str:
+    """Chave do cache de análises: o hash do anexo, ou dos anexos na ordem em que vieram."""
+    return "+".join(img.digest for img in imagens)
 
-        file_id = upload_response.id
-        print(f"📎 Arquivo enviado à OpenAI. ID: {file_id}")
+def _resposta_final(texto: str, imagens: list) -> str:
+    """Texto da análise + aviso dos anexos recusados (com um anexo só, só a mensagem da recusa)."""
+    recusadas = [img for img in imagens if img.recusa]
+    if len(imagens) == 1 and recusadas:
+        return recusadas[0].recusa
+    if not recusadas:
+        return texto
+    avisos = "\n".join(f"• {img.nome}: {img.recusa}" for img in recusadas)
+    if texto is None:
+        return f"Nenhum anexo pôde ser analisado:\n{avisos}"
+    return f"{texto}\n\n⚠️ Anexos não analisados:\n{avisos}"
 
-        # Criar thread
-        thread = openai_client.beta.threads.create()
-        run = openai_client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=ASSISTANT_ID,
-            instructions="Analise a imagem enviada e forneça uma resposta útil à equipe do laboratório."
-        )
+def _baixar_e_validar(img: "_Imagem", restante) -> "_Imagem":
+    log.info(f"🔽 Baixando arquivo: {img.nome}")
+    try:
+        img.buf, img.mime = baixar_imagem(img.url, timeout_s=min(ARQUIVO_TIMEOUT_S, restante()))
+    except ArquivoRecusado as e:
+        img.recusa = str(e)
+        return img
+    except requests.exceptions.RequestException as e:
+        log.warning(f"❌ Download de {img.nome} falhou: {e}")
+        img.recusa = MSG_ERRO_DOWNLOAD
+        return img
+    if not is_image(img.buf):
+        img.recusa = MSG_NAO_IMAGEM
+        return img
+    img.digest = hash_conteudo(img.buf)
+    return img
 
-        # Adiciona a imagem como mensagem
-        openai_client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=[
-                {"type": "text", "text": "Por favor, analise esta imagem."},
-                {"type": "image_file", "image_file": {"file_id": file_id}}
-            ]
+def _enviar_imagem(img: "_Imagem", restante) -> "_Imagem":
+    """Pré-processa e sobe o anexo (só chamado sem file_id em cache)."""
+    img.envio = _preparar_envio(img.buf, img.mime, img.nome, restante() - IMAGEM_RESERVA_FALLBACK_S)
+    with disjuntor.medir("files"), metricas.medir("arquivo_upload"):
+        upload_response = cliente_openai().files.create(
+            file=(img.envio[2], img.envio[0], img.envio[1]),
+            purpose="assistants",
+            timeout=max(1.0, restante() - IMAGEM_RESERVA_FALLBACK_S)
         )
+    img.envio[0].seek(0)
+    img.file_id = upload_response.id
+    cache_arquivos.guardar_file_id(img.digest, img.file_id)
+    log.info(f"📎 Arquivo enviado à OpenAI. ID: {img.file_id}")
+    return img
+
+def _preparar_fallback(img: "_Imagem", restante) -> "_Imagem":
+    if img.envio is None:
+        img.envio = _preparar_envio(img.buf, img.mime, img.nome, restante() / 2)
+    return img
 
-        while True:
-            status = openai_client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-            if status.status == "completed":
-                break
-            elif status.status == "failed":
-                return "❗Erro ao processar imagem com a IA."
-            time.sleep(1)
+def _sem_file_id(imagens: list) -> list:
+    """Um anexo por conteúdo ainda sem file_id (a mesma foto duas vezes sobe uma vez só)."""
+    unicas = {}
+    for img in imagens:
+        if not img.file_id:
+            unicas.setdefault(img.digest, img)
+    return list(unicas.values())
+
+def _copiar_file_ids(imagens: list):
+    por_digest = {img.digest: img.file_id for img in imagens if img.file_id}
+    for img in imagens:
+        img.file_id = img.file_id or por_digest[img.digest]
+
+def _descartar_do_cache(imagens: list):
+    """Esquece os file_ids que vieram do cache (os enviados agora têm envio pré-processado)."""
+    enviados = {img.digest for img in imagens if img.envio is not None}
+    for digest in {img.digest for img in imagens} - enviados:
+        cache_arquivos.descartar_file_id(digest)
+
+def _pode_usar_assistant(imagens: list) -> bool:
+    """Consulta o cache de file_id; False se um disjuntor necessário estiver aberto."""
+    for img in imagens:
+        img.file_id = cache_arquivos.file_id(img.digest)
+        if img.file_id:
+            log.info(f"📎 Arquivo já enviado antes. ID: {img.file_id}")
+    if not all(img.file_id for img in imagens) and not disjuntor.permitir("files"):
+        log.warning("⚠️ Disjuntor de upload aberto; analisando pelo fallback de visão.")
+        return False
+    if not disjuntor.permitir("runs"):
+        log.warning("⚠️ Disjuntor da Assistants API aberto; analisando pelo fallback de visão.")
+        return False
+    return True
+
+def _analisar_no_assistant(imagens: list, restante):
+    """
+    Upload em paralelo dos anexos sem file_id em cache + um run do assistant com todos.
+    Retorna o texto, ou None se falhou (os envios pré-processados ficam nas imagens,
+    para o fallback). Com o disjuntor de files ou de runs aberto, nem tenta.
+    """
+    if not _pode_usar_assistant(imagens):
+        return None
+    try:
+        _em_paralelo(lambda img: _enviar_imagem(img, restante), _sem_file_id(imagens))
+    except Exception as e:
+        # openai.APIError, disjuntor aberto no meio do lote, pré-processamento...: vai direto ao fallback
+        log.warning(f"⚠️ Upload dos anexos falhou ({e!r}); analisando pelo fallback de visão.")
+        return None
+    _copiar_file_ids(imagens)
+
+    # Thread + mensagem com as imagens + run numa chamada só, com prazo e cancelamento
+    try:
+        with disjuntor.medir("runs"):
+            res = executar_run(_conteudo_run([img.file_id for img in imagens]), assistant_id=ASSISTANT_ID,
+                               instructions=INSTRUCOES_IMAGEM,
+                               timeout_s=max(1.0, restante() - IMAGEM_RESERVA_FALLBACK_S))
+        cache_arquivos.guardar_analise(_chave_analise(imagens), CHAVE_PROMPT, res.texto)
+        return res.texto
+    except ErroRun as e:
+        log.warning(f"⚠️ Run da imagem não completou: status={e.status} run={e.run_id} last_error={e.last_error}")
+    except requests.exceptions.RequestException as e:
+        log.warning(f"⚠️ Erro no run da imagem: {e}{descrever_erro_http(e)}")
+        _descartar_do_cache(imagens)   # file_id do cache pode ter sido apagado
+    return None
+
+def _analisar_imagens(imagens: list, dialog_id, restante) -> str:
+    """Análise em cache, ou upload + run e, se preciso, o fallback de visão (todas as imagens juntas)."""
+    analise = cache_arquivos.analise(_chave_analise(imagens), CHAVE_PROMPT)
+    if analise:
+        log.info(f"⚡ Análise reaproveitada do cache ({_chave_analise(imagens)[:12]}).")
+        return analise
+
+    # Upload + run e, se preciso, o fallback disputam vagas no limitador da OpenAI
+    try:
+        with limitador.vaga(dialog_id, OPENAI_TOKENS_RUN, espera_max_s=_espera_vaga(restante())):
+            texto = _analisar_no_assistant(imagens, restante)
+        if texto:
+            return texto
+
+        if restante() < 2:
+            return MSG_ERRO_IA
+        _em_paralelo(lambda img: _preparar_fallback(img, restante), imagens)
+        with limitador.vaga(dialog_id, OPENAI_TOKENS_RUN, espera_max_s=_espera_vaga(restante(), 2)):
+            return _fallback_visao([img.envio for img in imagens], restante())
+    except LimiteExcedido as e:
+        log.warning(f"⚠️ Sem vaga na OpenAI para a imagem: {e}")
+        return MSG_IA_OCUPADA
+
+def processar_arquivos_do_bitrix(arquivos: list, dialog_id: str = None) -> str:
+    """
+    Baixa, valida e analisa os anexos [(url, nome), ...] da mensagem: downloads e
+    uploads em paralelo (ARQUIVOS_PARALELOS) e um único run com todas as imagens,
+    então N fotos levam perto do tempo de uma. Tudo respeita IMAGEM_PRAZO_S: o run
+    recebe o prazo menos a reserva do fallback; se estourar, é cancelado e as
+    imagens vão direto para o Chat Completions com visão.
+    """
+    prazo = time.time() + IMAGEM_PRAZO_S
+    restante = lambda: prazo - time.time()
+    try:
+        imagens = _lista_de_arquivos(arquivos)
+        for img in imagens:
+            log.debug(f"🔗 URL: {img.url}")
+        _em_paralelo(lambda img: _baixar_e_validar(img, restante), imagens)
+
+        validas = [img for img in imagens if not img.recusa]
+        texto = _analisar_imagens(validas, dialog_id, restante) if validas else None
+        return _resposta_final(texto, imagens)
+
+    except Exception as e:
+        log.exception(f"❌ Erro em processar_arquivos_do_bitrix: {e}")
+        return "❗Ocorreu um erro ao processar o arquivo."
+
+
+# =========================
+# Versão async (app_async.py)
+# =========================
+async def baixar_imagem_async(arquivo_url: str, timeout_s: float = ARQUIVO_TIMEOUT_S):
+    """Mesmas regras de baixar_imagem, com httpx em streaming."""
+    validador = _ValidadorDownload(timeout_s)
+    with metricas.medir("arquivo_download"):
+        async with cliente_async("bitrix").stream("GET", arquivo_url, timeout=timeout_async(timeout_s)) as response:
+            validador.resposta(response.status_code, response.headers)
+            async for chunk in response.aiter_bytes(ARQUIVO_CHUNK):
+                validador.chunk(chunk)
+    return validador.fim()
+
+def _validar_e_hashear(buf: BytesIO):
+    return is_image(buf), hash_conteudo(buf)
+
+async def _em_paralelo_async(fn, imagens: list):
+    """`await fn(imagem)` para cada anexo, no máximo ARQUIVOS_PARALELOS ao mesmo tempo."""
+    vagas = asyncio.Semaphore(ARQUIVOS_PARALELOS)
+
+    async def com_vaga(img):
+        async with vagas:
+            return await fn(img)
+
+    return await asyncio.gather(*(com_vaga(img) for img in imagens))
+
+async def _baixar_e_validar_async(img: "_Imagem", restante) -> "_Imagem":
+    import httpx
+    log.info(f"🔽 Baixando arquivo: {img.nome}")
+    try:
+        img.buf, img.mime = await baixar_imagem_async(img.url, timeout_s=min(ARQUIVO_TIMEOUT_S, restante()))
+    except ArquivoRecusado as e:
+        img.recusa = str(e)
+        return img
+    except httpx.HTTPError as e:
+        log.warning(f"❌ Download de {img.nome} falhou: {e}")
+        img.recusa = MSG_ERRO_DOWNLOAD
+        return img
+    valida, img.digest = await asyncio.to_thread(perfil.envolver(_validar_e_hashear, "arquivos"), img.buf)
+    if not valida:
+        img.recusa = MSG_NAO_IMAGEM
+    return img
+
+async def _enviar_arquivo_async(envio, timeout_s: float) -> str:
+    """Upload multipart direto no /files (o SDK da OpenAI é síncrono)."""
+    buf, mime, nome = envio
+    headers = {k: v for k, v in cliente_assistants._headers_no_beta().items() if k != "Content-Type"}
+    r = await cliente_async("openai").post(
+        f"{cliente_assistants.OPENAI_BASE_URL}/files",
+        headers=headers,
+        data={"purpose": "assistants"},
+        files={"file": (nome, buf.getvalue(), mime)},
+        timeout=timeout_async(timeout_s)
+    )
+    r.raise_for_status()
+    return r.json()["id"]
+
+async def _enviar_imagem_async(img: "_Imagem", restante) -> "_Imagem":
+    img.envio = await asyncio.to_thread(perfil.envolver(_preparar_envio, "arquivos"), img.buf, img.mime,
+                                        img.nome, restante() - IMAGEM_RESERVA_FALLBACK_S)
+    with disjuntor.medir("files"), metricas.medir("arquivo_upload"):
+        img.file_id = await _enviar_arquivo_async(img.envio, max(1.0, restante() - IMAGEM_RESERVA_FALLBACK_S))
+    await fora_do_loop(cache_arquivos, cache_arquivos.guardar_file_id, img.digest, img.file_id)
+    log.info(f"📎 Arquivo enviado à OpenAI. ID: {img.file_id}")
+    return img
+
+async def _preparar_fallback_async(img: "_Imagem", restante) -> "_Imagem":
+    return await asyncio.to_thread(perfil.envolver(_preparar_fallback, "arquivos"), img, restante)
+
+async def _fallback_visao_async(envios: list, timeout_s: float) -> str:
+    t0 = time.perf_counter()
+    resposta = await _fallback_visao_medido_async(envios, timeout_s)
+    _registrar_fallback_visao(resposta, t0)
+    return resposta
+
+async def _fallback_visao_medido_async(envios: list, timeout_s: float) -> str:
+    import httpx
+    if not disjuntor.permitir("chat"):
+        log.warning("⚠️ Disjuntor do chat completions aberto; sem fallback de visão.")
+        return MSG_ERRO_IA
+    try:
+        with disjuntor.medir("chat"):
+            r = await cliente_async("openai").post(
+                f"{cliente_assistants.OPENAI_BASE_URL}/chat/completions",
+                headers=cliente_assistants._headers_no_beta(),
+                json=_corpo_visao(envios),
+                timeout=timeout_async(timeout_s)
+            )
+            r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"].strip()
+    except (httpx.HTTPError, KeyError, IndexError) as e:
+        detalhe = descrever_erro_http(e) if isinstance(e, httpx.HTTPError) else ""
+        log.error(f"❌ Fallback de visão falhou: {e}{detalhe}")
+        return MSG_ERRO_IA
+
+async def _analisar_no_assistant_async(imagens: list, restante):
+    import httpx
+    if not await fora_do_loop(cache_arquivos, _pode_usar_assistant, imagens):
+        return None
+    try:
+        await _em_paralelo_async(lambda img: _enviar_imagem_async(img, restante), _sem_file_id(imagens))
+    except Exception as e:
+        log.warning(f"⚠️ Upload dos anexos falhou ({e!r}); analisando pelo fallback de visão.")
+        return None
+    _copiar_file_ids(imagens)
+
+    try:
+        with disjuntor.medir("runs"):
+            res = await executar_run_async(_conteudo_run([img.file_id for img in imagens]),
+                                           assistant_id=ASSISTANT_ID, instructions=INSTRUCOES_IMAGEM,
+                                           timeout_s=max(1.0, restante() - IMAGEM_RESERVA_FALLBACK_S))
+        cache_arquivos.guardar_analise(_chave_analise(imagens), CHAVE_PROMPT, res.texto)
+        return res.texto
+    except ErroRun as e:
+        log.warning(f"⚠️ Run da imagem não completou: status={e.status} run={e.run_id} last_error={e.last_error}")
+    except httpx.HTTPError as e:
+        log.warning(f"⚠️ Erro no run da imagem: {e}{descrever_erro_http(e)}")
+        await fora_do_loop(cache_arquivos, _descartar_do_cache, imagens)
+    return None
+
+async def _analisar_imagens_async(imagens: list, dialog_id, restante) -> str:
+    analise = cache_arquivos.analise(_chave_analise(imagens), CHAVE_PROMPT)
+    if analise:
+        log.info(f"⚡ Análise reaproveitada do cache ({_chave_analise(imagens)[:12]}).")
+        return analise
+
+    try:
+        async with limitador.vaga_async(dialog_id, OPENAI_TOKENS_RUN, espera_max_s=_espera_vaga(restante())):
+            texto = await _analisar_no_assistant_async(imagens, restante)
+        if texto:
+            return texto
+
+        if restante() < 2:
+            return MSG_ERRO_IA
+        await _em_paralelo_async(lambda img: _preparar_fallback_async(img, restante), imagens)
+        async with limitador.vaga_async(dialog_id, OPENAI_TOKENS_RUN, espera_max_s=_espera_vaga(restante(), 2)):
+            return await _fallback_visao_async([img.envio for img in imagens], restante())
+    except LimiteExcedido as e:
+        log.warning(f"⚠️ Sem vaga na OpenAI para a imagem: {e}")
+        return MSG_IA_OCUPADA
+
+async def processar_arquivos_do_bitrix_async(arquivos: list, dialog_id: str = None) -> str:
+    """
+    Mesmo fluxo e prazo de processar_arquivos_do_bitrix. Rede em httpx; Pillow, hash e
+    pré-processamento (que espera o pool de processos) vão para threads do executor.
+    """
+    prazo = time.time() + IMAGEM_PRAZO_S
+    restante = lambda: prazo - time.time()
+    try:
+        imagens = _lista_de_arquivos(arquivos)
+        for img in imagens:
+            log.debug(f"🔗 URL: {img.url}")
+        await _em_paralelo_async(lambda img: _baixar_e_validar_async(img, restante), imagens)
 
-        resposta = openai_client.beta.threads.messages.list(thread_id=thread.id)
-        return resposta.data[0].content[0].text.value.strip()
+        validas = [img for img in imagens if not img.recusa]
+        texto = await _analisar_imagens_async(validas, dialog_id, restante) if validas else None
+        return _resposta_final(texto, imagens)
 
     except Exception as e:
-        print("❌ Erro em processar_arquivo_do_bitrix:", e)
+        log.exception(f"❌ Erro em processar_arquivos_do_bitrix_async: {e}")
         return "❗Ocorreu um erro ao processar o arquivo."
@@ -0,0 +1,149 @@
+"""
+Parser do stream SSE e caminho de fallback do executar_run, contra o stub da
+OpenAI (bench/stub_servidor.py).
+"""
+import asyncio, time
+
+import pytest
+import requests
+
+import cliente_assistants
+from cliente_assistants import ControleRun, ErroRun, _EstadoStream, _LeitorSSE, _fim_do_stream, executar_run, executar_run_async
+from stub_servidor import RESPOSTA_PADRAO, iniciar_stub
+
+
+@pytest.fixture(scope="module")
+def stub():
+    servidor, base = iniciar_stub(duracao_run=0.2)
+    servidor.base = base
+    yield servidor
+    servidor.shutdown()
+
+
+@pytest.fixture
+def api(stub, monkeypatch):
+    monkeypatch.setattr(cliente_assistants, "OPENAI_BASE_URL", stub.base)
+    monkeypatch.setattr(cliente_assistants, "OPENAI_API_KEY", "sk-teste")
+    stub.estado.zerar_contadores()
+    stub.estado.cortes_stream = 0
+    stub.estado.atraso_stream = 0.0
+    return stub.estado
+
+
+def _eventos(linhas):
+    leitor = _LeitorSSE()
+    for linha in linhas:
+        ev = leitor.linha(linha)
+        if ev:
+            yield ev
+
+
+# ---------- parser ----------
+def test_parser_ignora_steps_e_entrega_deltas():
+    parciais = []
+    estado = _EstadoStream(30, ao_texto=parciais.append)
+    run = '{"id": "run_1", "object": "thread.run", "thread_id": "thread_1", "status": "%s"}'
+    linhas = [
+        "event: thread.run.created", "data: " + run % "queued", "",
+        "event: thread.run.step.created",
+        'data: {"id": "step_1", "object": "thread.run.step", "run_id": "run_1", "status": "in_progress"}', "",
+        "event: thread.message.delta", 'data: {"delta": {"content": [{"type": "text", "text": {"value": "Olá "}}]}}', "",
+        "event: thread.message.delta", 'data: {"delta": {"content": [{"type": "text", "text": {"value": "mundo"}}]}}', "",
+        "event: thread.message.completed",
+        'data: {"role": "assistant", "content": [{"type": "text", "text": {"value": "Olá mundo"}}]}', "",
+        "event: thread.run.step.completed",
+        'data: {"id": "step_1", "object": "thread.run.step", "run_id": "run_1", "status": "completed"}', "",
+        "event: thread.run.completed", "data: " + run % "completed", "",
+    ]
+    fim = None
+    for ev in _eventos(linhas):
+        fim = estado.processar(*ev)
+        if fim:
+            break
+    assert fim[0] == "completed" and fim[2] == "Olá mundo"
+    assert estado.run_obj["id"] == "run_1"
+    assert parciais == ["Olá", "Olá mundo"]
+
+
+def test_timeout_antes_do_run_nao_devolve_run():
+    estado = _EstadoStream(0.01)
+    estado.t0 = time.time() - 1
+    fim = estado.processar("thread.message.delta", '{"delta": {"content": []}}')
+    assert fim[0] == "timeout"
+    with pytest.raises(ErroRun) as erro:
+        _fim_do_stream(estado, fim)
+    assert erro.value.status == "timeout"
+
+
+def test_run_descartado_para_de_ler_o_stream(monkeypatch):
+    monkeypatch.setattr(cliente_assistants, "cancelar_run", lambda thread_id, run_id: None)
+    parciais = []
+    controle = ControleRun()
+    estado = _EstadoStream(30, controle, ao_texto=parciais.append)
+    estado.processar("thread.run.created", '{"id": "run_1", "thread_id": "thread_1", "status": "queued"}')
+    controle.cancelar()
+    fim = estado.processar("thread.message.delta",
+                           '{"delta": {"content": [{"type": "text", "text": {"value": "tarde"}}]}}')
+    assert fim[0] == "cancelled" and fim[1]["id"] == "run_1"
+    assert parciais == []
+
+
+# ---------- executar_run contra o stub ----------
+def test_stream_completo_sem_polling(api):
+    res = executar_run("oi", assistant_id="asst_x", timeout_s=5, stream=True)
+    assert res.texto == RESPOSTA_PADRAO
+    assert api.requisicoes["threads.runs.create"] == 1
+    assert api.requisicoes["runs.retrieve"] == 0
+
+
+def test_stream_cortado_antes_do_run_nao_cria_outro(api):
+    api.cortes_stream = 1
+    with pytest.raises(ErroRun) as erro:
+        executar_run("oi", assistant_id="asst_x", timeout_s=5, stream=True)
+    assert erro.value.status == "stream_interrompido"
+    assert api.requisicoes["threads.runs.create"] == 1
+
+
+def test_timeout_de_leitura_antes_do_run_nao_cria_outro(api):
+    api.atraso_stream = 1.5
+    with pytest.raises(ErroRun):
+        executar_run("oi", assistant_id="asst_x", timeout_s=0.5, stream=True)
+    assert api.requisicoes["threads.runs.create"] == 1
+
+
+def test_erro_de_conexao_cai_no_polling(api, monkeypatch):
+    sessao = cliente_assistants.sessao_openai()
+    post_original = sessao.post
+
+    def post(url, **kw):
+        if kw.get("stream"):
+            raise requests.exceptions.ConnectTimeout("conexão recusada (simulada)")
+        return post_original(url, **kw)
+
+    monkeypatch.setattr(sessao, "post", post)
+    res = executar_run("oi", assistant_id="asst_x", timeout_s=5, stream=True)
+    assert res.texto == RESPOSTA_PADRAO
+    assert api.requisicoes["threads.runs.create"] == 1
+    assert api.requisicoes["runs.retrieve"] >= 1
+
+
+# ---------- versão async ----------
+def test_async_stream_completo(api):
+    res = asyncio.run(executar_run_async("oi", assistant_id="asst_x", timeout_s=5, stream=True))
+    assert res.texto == RESPOSTA_PADRAO
+    assert api.requisicoes["runs.retrieve"] == 0
+
+
+def test_async_stream_cortado_nao_cria_outro(api):
+    api.cortes_stream = 1
+    with pytest.raises(ErroRun) as erro:
+        asyncio.run(executar_run_async("oi", assistant_id="asst_x", timeout_s=5, stream=True))
+    assert erro.value.status == "stream_interrompido"
+    assert api.requisicoes["threads.runs.create"] == 1
+
+
+def test_async_timeout_de_leitura_nao_cria_outro(api):
+    api.atraso_stream = 1.5
+    with pytest.raises(ErroRun):
+        asyncio.run(executar_run_async("oi", assistant_id="asst_x", timeout_s=0.5, stream=True))
+    assert api.requisicoes["threads.runs.create"] == 1